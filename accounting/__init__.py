@@ -7,5 +7,20 @@ app = Flask(__name__)
 app.config.from_pyfile('config.py')
 db = SQLAlchemy(app)
 
+# Tune every SQLite connection with the profile in config.py.
+import engines
+engines.init_sqlite_profile(app, db.engine)
+
+# Separate engine for read-only paths, configured by READ_ENGINE.
+import readonly
+read_engine = readonly.init_app(app, db)
+
+# Count and time SQL statements and requests for /metrics.
+import metrics
+metrics.instrument_engine(db.engine)
+if read_engine is not None:
+    metrics.instrument_engine(read_engine)
+metrics.init_app(app)
+
 # Import the views file for routing.
 import views
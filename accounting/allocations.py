@@ -0,0 +1,184 @@
+#!/user/bin/env python2.7
+import logging
+
+from itertools import groupby
+
+from accounting import db
+from models import Invoice, InvoiceAllocation, Payment, PaymentAllocation, Policy
+
+"""
+#######################################################
+Payment allocation. Payments are applied to a policy's
+open invoices, oldest bill date first. Each invoice has
+one InvoiceAllocation row holding how much of it has been
+paid and how much remains, and each piece of a payment
+applied to an invoice is stored as a PaymentAllocation.
+
+The tables are kept up to date by every payment and every
+change to a policy's invoices, but balances and status
+checks do not read them yet; they go through the ledger.
+open_invoices and invoice_allocation are for callers that
+need per-invoice detail. If the tables drift, rebuild
+them from the invoices and payments:
+
+    python -m accounting.allocations
+    python -m accounting.allocations --policy-id 1 --policy-id 2
+#######################################################
+"""
+
+# Number of policies rebuilt per transaction by rebuild_allocations
+REBUILD_CHUNK_SIZE = 500
+
+
+def apply_payment(payment):
+    """
+     Apply a new payment to its policy's open invoices, oldest first.
+     The payment must already be flushed so it has an id. The caller
+     is responsible for committing.
+    """
+    remaining = payment.amount_paid
+
+    open_allocations = InvoiceAllocation.query\
+        .join(Invoice, Invoice.id == InvoiceAllocation.invoice_id)\
+        .filter(InvoiceAllocation.policy_id == payment.policy_id)\
+        .filter(InvoiceAllocation.amount_remaining > 0)\
+        .filter(Invoice.deleted == False)\
+        .order_by(Invoice.bill_date, Invoice.id)\
+        .all()
+
+    for allocation in open_allocations:
+        if remaining <= 0:
+            break
+
+        amount = min(remaining, allocation.amount_remaining)
+        allocation.amount_paid += amount
+        allocation.amount_remaining -= amount
+        db.session.add(PaymentAllocation(payment.id, allocation.invoice_id, amount))
+        remaining -= amount
+
+    return remaining
+
+
+def allocate_policy(policy_id):
+    """
+     Rebuild one policy's allocations from its invoices and payments,
+     for example after its invoices were regenerated. The caller is
+     responsible for committing.
+    """
+    allocate_policies([policy_id])
+
+
+def allocate_policies(policy_ids):
+    """
+     Rebuild the allocations of many policies without committing.
+    """
+    db.session.flush()
+    _rebuild(policy_ids)
+
+
+def rebuild_allocations(policy_ids=None):
+    """
+     Rebuild the allocation tables from the invoices and payments
+     already in the db. Runs one transaction per chunk of policies.
+    """
+    if policy_ids is None:
+        policy_ids = [policy_id for policy_id, in db.session.query(Policy.id).order_by(Policy.id)]
+
+    policy_ids = sorted(set(policy_ids))
+    for start in range(0, len(policy_ids), REBUILD_CHUNK_SIZE):
+        _rebuild(policy_ids[start:start + REBUILD_CHUNK_SIZE])
+        db.session.commit()
+
+    logging.info('Rebuilt allocations for %d policies', len(policy_ids))
+
+
+def invoice_allocation(invoice_id):
+    """
+     Return the allocation row for one invoice.
+    """
+    return InvoiceAllocation.query.get(invoice_id)
+
+
+def open_invoices(policy_id):
+    """
+     Return the non-deleted invoices on a policy that are not paid in full.
+    """
+    return Invoice.query\
+        .join(InvoiceAllocation, InvoiceAllocation.invoice_id == Invoice.id)\
+        .filter(InvoiceAllocation.policy_id == policy_id)\
+        .filter(InvoiceAllocation.amount_remaining > 0)\
+        .filter(Invoice.deleted == False)\
+        .order_by(Invoice.bill_date, Invoice.id)\
+        .all()
+
+
+def _rebuild(policy_ids):
+    invoice_allocations = InvoiceAllocation.__table__
+    payment_allocations = PaymentAllocation.__table__
+    invoices = Invoice.__table__
+    payments = Payment.__table__
+
+    # Clear what was allocated before
+    invoice_ids = db.session.query(Invoice.id).filter(Invoice.policy_id.in_(policy_ids))
+    db.session.execute(payment_allocations.delete()
+                                          .where(payment_allocations.c.invoice_id.in_(invoice_ids.subquery())))
+    db.session.execute(invoice_allocations.delete()
+                                          .where(invoice_allocations.c.policy_id.in_(policy_ids)))
+
+    invoice_rows = db.session.execute(
+        invoices.select()
+                .where(invoices.c.policy_id.in_(policy_ids))
+                .where(invoices.c.deleted == False)
+                .order_by(invoices.c.policy_id, invoices.c.bill_date, invoices.c.id))
+    payment_rows = db.session.execute(
+        payments.select()
+                .where(payments.c.policy_id.in_(policy_ids))
+                .order_by(payments.c.policy_id, payments.c.id))
+
+    invoices_by_policy = dict((policy_id, list(rows)) for policy_id, rows
+                              in groupby(invoice_rows, lambda row: row.policy_id))
+    payments_by_policy = dict((policy_id, list(rows)) for policy_id, rows
+                              in groupby(payment_rows, lambda row: row.policy_id))
+
+    new_invoice_allocations = []
+    new_payment_allocations = []
+    for policy_id, policy_invoices in invoices_by_policy.items():
+        remaining = [invoice.amount_due for invoice in policy_invoices]
+
+        # Fill invoices oldest first with each payment in the order posted
+        position = 0
+        for payment in payments_by_policy.get(policy_id, []):
+            unapplied = payment.amount_paid
+            while unapplied > 0 and position < len(policy_invoices):
+                amount = min(unapplied, remaining[position])
+                if amount > 0:
+                    new_payment_allocations.append({'payment_id': payment.id,
+                                                    'invoice_id': policy_invoices[position].id,
+                                                    'amount': amount})
+                    remaining[position] -= amount
+                    unapplied -= amount
+                if remaining[position] <= 0:
+                    position += 1
+
+        for invoice, amount_remaining in zip(policy_invoices, remaining):
+            new_invoice_allocations.append({'invoice_id': invoice.id,
+                                            'policy_id': policy_id,
+                                            'amount_paid': invoice.amount_due - amount_remaining,
+                                            'amount_remaining': amount_remaining})
+
+    if new_invoice_allocations:
+        db.session.execute(invoice_allocations.insert(), new_invoice_allocations)
+    if new_payment_allocations:
+        db.session.execute(payment_allocations.insert(), new_payment_allocations)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Rebuild the payment allocation tables.')
+    parser.add_argument('--policy-id', type=int, action='append', dest='policy_ids',
+                        help='rebuild only this policy; may be repeated. Defaults to every policy.')
+    args = parser.parse_args()
+
+    rebuild_allocations(args.policy_ids)
+    print 'Allocations rebuilt'
@@ -0,0 +1,125 @@
+#!/user/bin/env python2.7
+import hashlib
+import threading
+import uuid
+
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import select
+
+from accounting import db
+from models import PolicyVersion
+
+"""
+#######################################################
+Response cache for the policy view. Serialized responses
+are kept per policy and date. Every write to a policy
+gives it a new version, which makes all of its cached
+responses unreachable at once, so any backend with get and
+set works; stale entries simply age out.
+
+Versions are rows of the policy_versions table, written in
+the same transaction as the write, so writes from any
+process (the importer, the nightly job, a cron sweep)
+invalidate the responses cached by the web processes. A
+lookup reads the version by primary key, one query
+instead of serializing the whole policy.
+#######################################################
+"""
+
+# Number of entries kept by the default in-process backend
+CACHE_SIZE = 1024
+
+
+class MemoryBackend(object):
+    """
+     Bounded in-process least-recently-used backend. Another backend
+     (e.g. memcached) only needs the same get, set and clear methods.
+    """
+    def __init__(self, max_size=CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CachedResponse(object):
+    """
+     A serialized response body with its validators.
+    """
+    def __init__(self, body, last_modified):
+        self.body = body
+        self.etag = hashlib.md5(body).hexdigest()
+        self.last_modified = last_modified
+
+
+class PolicyResponseCache(object):
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryBackend()
+
+    def lookup(self, policy_id, variant):
+        """
+         Return (key, cached response or None) for one variant of a
+         policy's response, e.g. its date. The version is read before
+         the response is built, so pass the key to store and a response
+         built while the policy was written to is stored under the
+         version it was read from and never served.
+        """
+        key = ('response', policy_id, policy_version(policy_id), variant)
+        return key, self.backend.get(key)
+
+    def store(self, key, body):
+        # Last-Modified is the time of the policy's last write
+        _, _, (_, last_modified), _ = key
+        cached = CachedResponse(body, last_modified)
+        self.backend.set(key, cached)
+        return cached
+
+
+policy_cache = PolicyResponseCache()
+
+
+def policy_version(policy_id):
+    """
+     Return a policy's (version, time of its last write), or
+     (None, None) if it was never written to since versions were kept.
+    """
+    versions = PolicyVersion.__table__
+    row = db.session.execute(select([versions.c.version, versions.c.modified_at])
+                             .where(versions.c.policy_id == policy_id)).fetchone()
+    return tuple(row) if row else (None, None)
+
+
+def invalidate_policies(policy_ids):
+    """
+     Give policies a new version, which drops every cached response of
+     them in every process. Call it in the write's transaction; the
+     caller is responsible for committing.
+    """
+    if not policy_ids:
+        return
+    modified_at = datetime.utcnow().replace(microsecond=0)
+    db.session.execute(PolicyVersion.__table__.insert().prefix_with('OR REPLACE'),
+                       [{'policy_id': policy_id, 'version': uuid.uuid4().hex, 'modified_at': modified_at}
+                        for policy_id in policy_ids])
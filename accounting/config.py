@@ -1,3 +1,67 @@
 import os
 
-SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.abspath("accounting.sqlite")
+SQLALCHEMY_DATABASE_URI = os.environ.get('ACCOUNTING_DATABASE_URI',
+                                         'sqlite:///' + os.path.abspath("accounting.sqlite"))
+
+# Largest number of policies one POST /policies/balances request may ask for
+BATCH_POLICY_LIMIT = 1000
+
+# Largest page GET /policies returns
+SEARCH_PAGE_LIMIT = 500
+
+# Statements slower than this many seconds are sampled on /metrics
+SLOW_QUERY_SECONDS = 0.1
+
+# Add an X-Query-Count header with the request's statement count to responses
+METRICS_DEBUG_HEADER = os.environ.get('ACCOUNTING_METRICS_DEBUG_HEADER') == '1'
+
+# Worker processes and policy ids per shard for the nightly evaluation
+NIGHTLY_WORKERS = 4
+NIGHTLY_SHARD_SIZE = 2000
+
+# Months after its effective date the nightly run expires an active policy,
+# None to never expire, and the status code expired policies get
+NIGHTLY_EXPIRE_AFTER_MONTHS = None
+NIGHTLY_EXPIRE_STATUS_CODE = u'Underwriting'  # Fraud, Non-Payment or Underwriting
+
+# PRAGMAs run on every new SQLite connection, in order. WAL is kept in
+# the db file; set journal_mode to DELETE to switch an existing db back.
+SQLITE_PRAGMAS = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),  # FULL fsyncs on every commit
+    ('busy_timeout', 5000),  # milliseconds
+    ('cache_size', -20000),  # negative is KiB, so 20 MB
+    ('mmap_size', 268435456),  # bytes
+]
+
+# Group commit: most writes per transaction, and longest a write waits
+# in seconds for others to join its transaction
+GROUP_COMMIT_MAX_BATCH = 200
+GROUP_COMMIT_MAX_LATENCY = 0.01
+
+# Policies aged together by the aging report
+AGING_CHUNK_SIZE = 20000
+
+# Longest range in days GET /policy/<id>/balances returns daily points for
+BALANCE_HISTORY_DAY_LIMIT = 3660
+
+# Rows read and compressed together by table exports
+EXPORT_CHUNK_SIZE = 5000
+
+# Engine for reports, views and bulk reads: 'ro' opens the db file
+# read-only, 'snapshot' reads a copy refreshed by python -m
+# accounting.readonly, 'primary' shares the writer's session
+READ_ENGINE = os.environ.get('ACCOUNTING_READ_ENGINE', 'ro')
+# Seconds between the snapshot refreshes of python -m accounting.readonly
+READ_SNAPSHOT_SECONDS = 60
+# Defaults to the db file's path plus .snapshot
+READ_SNAPSHOT_PATH = os.environ.get('ACCOUNTING_READ_SNAPSHOT_PATH')
+
+# PRAGMAs run on every new read-only connection. journal_mode is left
+# to the writer, which owns the file.
+READ_SQLITE_PRAGMAS = [
+    ('query_only', 'ON'),
+    ('busy_timeout', 5000),  # milliseconds
+    ('cache_size', -20000),  # negative is KiB, so 20 MB
+    ('mmap_size', 268435456),  # bytes
+]
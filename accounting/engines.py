@@ -0,0 +1,31 @@
+#!/user/bin/env python2.7
+from sqlalchemy import event
+
+"""
+#######################################################
+SQLite engine profile. The PRAGMAs in the SQLITE_PRAGMAS
+setting are run on every new connection: WAL journaling
+lets readers keep going while one writer commits, a
+lower synchronous level fsyncs at checkpoints instead of
+on every commit, and the busy timeout makes a blocked
+writer wait instead of failing.
+#######################################################
+"""
+
+
+def init_sqlite_profile(app, engine, setting='SQLITE_PRAGMAS'):
+    """
+     Apply app.config[setting] to each new connection of a SQLite
+     engine. The setting is read on every connect, so changing it
+     affects connections opened afterwards.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in app.config.get(setting, []):
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+    event.listen(engine, 'connect', set_pragmas)
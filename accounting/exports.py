@@ -0,0 +1,148 @@
+#!/user/bin/env python2.7
+import csv
+import json
+import zlib
+
+from collections import OrderedDict
+from StringIO import StringIO
+
+from sqlalchemy import Date, and_, func, select
+
+from accounting import app, db
+from models import Invoice, Payment, Policy
+from readonly import read_session
+from serializers import date_text
+
+"""
+#######################################################
+Warehouse exports. A table is read in chunks of
+EXPORT_CHUNK_SIZE rows in primary key order, each chunk
+starting after the last id of the one before, and written
+as gzip-compressed CSV or newline-delimited JSON one chunk
+at a time, so memory use does not grow with the table.
+Soft-deleted invoices are included, with their deleted
+column.
+
+An export covers the ids up to the watermark taken when it
+starts. Passing that watermark's last_id as after_id to the
+next export only exports the rows added in between. Ids
+only grow, so this also picks up payments posted later
+with an earlier or the same transaction date. since only
+narrows a payments export to the dates on or after it, and
+is no substitute for after_id.
+
+    python -m accounting.exports invoices --format ndjson --after-id 1000
+#######################################################
+"""
+
+EXPORT_TABLES = {'policies': Policy.__table__,
+                 'invoices': Invoice.__table__,
+                 'payments': Payment.__table__}
+
+EXPORT_FORMATS = ['csv', 'ndjson']
+
+
+def export_watermark(table_name, after_id=0, since=None, session=None):
+    """
+     Return the watermark of an export, a dict with the last id it
+     covers, None when there is nothing new to export. Queries run on
+     session, db.session by default.
+    """
+    session = session or db.session
+    table = _table(table_name)
+    last_id = session.execute(select([func.max(table.c.id)])
+                              .where(_conditions(table_name, after_id, since))).scalar()
+    return {'last_id': last_id}
+
+
+def export_chunks(table_name, format='csv', after_id=0, since=None, through_id=None, chunk_size=None,
+                  session=None):
+    """
+     Yield a gzip-compressed export of a table's rows with ids after
+     after_id and up to through_id, a piece per chunk of rows. since
+     only exports payments with a transaction date on or after it.
+     Queries run on session, db.session by default.
+    """
+    session = session or db.session
+    table = _table(table_name)
+    if format not in EXPORT_FORMATS:
+        raise ValueError('Format must be one of ' + ', '.join(EXPORT_FORMATS))
+    chunk_size = chunk_size or app.config['EXPORT_CHUNK_SIZE']
+
+    # Dates as their stored text, so no date objects are built
+    names = [column.name for column in table.c]
+    columns = [date_text(column) if isinstance(column.type, Date) else column for column in table.c]
+    encode = _csv_chunk if format == 'csv' else _ndjson_chunk
+
+    # 16 + MAX_WBITS writes a gzip header and trailer
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if format == 'csv':
+        yield compressor.compress(_csv_chunk(names, [names]))
+
+    last_id = after_id
+    while True:
+        conditions = _conditions(table_name, last_id, since)
+        if through_id is not None:
+            conditions = and_(conditions, table.c.id <= through_id)
+        rows = session.execute(select(columns).where(conditions)
+                                              .order_by(table.c.id)
+                                              .limit(chunk_size)).fetchall()
+        if not rows:
+            break
+        yield compressor.compress(encode(names, rows))
+        last_id = rows[-1][0]
+
+    yield compressor.flush()
+
+
+def _table(table_name):
+    if table_name not in EXPORT_TABLES:
+        raise ValueError('Table must be one of ' + ', '.join(sorted(EXPORT_TABLES)))
+    return EXPORT_TABLES[table_name]
+
+
+def _conditions(table_name, after_id, since):
+    table = EXPORT_TABLES[table_name]
+    conditions = [table.c.id > (after_id or 0)]
+    if since is not None:
+        if table_name != 'payments':
+            raise ValueError('Only payments can be exported since a date')
+        conditions.append(table.c.transaction_date >= since)
+    return and_(*conditions)
+
+
+def _csv_chunk(names, rows):
+    output = StringIO()
+    writer = csv.writer(output)
+    for row in rows:
+        writer.writerow([value.encode('utf-8') if isinstance(value, unicode) else value
+                         for value in row])
+    return output.getvalue()
+
+
+def _ndjson_chunk(names, rows):
+    return ''.join(json.dumps(OrderedDict(zip(names, row))) + '\n' for row in rows)
+
+
+if __name__ == '__main__':
+    import argparse
+    from datetime import datetime
+
+    parser = argparse.ArgumentParser(description='Export a table as gzip-compressed CSV or NDJSON.')
+    parser.add_argument('table', choices=sorted(EXPORT_TABLES))
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+    parser.add_argument('--after-id', type=int, default=0, help='last id of the previous export')
+    parser.add_argument('--since', help='payments only: first transaction date to export, YYYY-MM-DD')
+    parser.add_argument('--output', help='defaults to <table>.<format>.gz')
+    args = parser.parse_args()
+
+    since = datetime.strptime(args.since, '%Y-%m-%d').date() if args.since else None
+    output = args.output or '%s.%s.gz' % (args.table, args.format)
+    session = read_session()
+    watermark = export_watermark(args.table, args.after_id, since, session=session)
+    watermark['last_id'] = watermark['last_id'] or args.after_id
+    with open(output, 'wb') as export_file:
+        for piece in export_chunks(args.table, args.format, args.after_id, since, watermark['last_id'],
+                                   session=session):
+            export_file.write(piece)
+    print 'Wrote %s, watermark %s' % (output, json.dumps(watermark))
@@ -0,0 +1,198 @@
+#!/user/bin/env python2.7
+import csv
+import logging
+
+from datetime import datetime
+from itertools import islice
+
+from accounting import db
+from allocations import allocate_policies
+from cache import invalidate_policies
+from ledger import rebuild_entries
+from models import Contact, Payment, Policy
+from tracking import mark_dirty
+from utils import policies_pending_cancellation
+
+"""
+#######################################################
+Lockbox payment importer. Streams a CSV payment file with
+the columns policy_id, contact_id, amount and
+transaction_date (YYYY-MM-DD), validates it a chunk at a
+time with the same rules as make_payment and posts each
+chunk of payments in one transaction. Rows that fail are
+written to a reject file with the reason. Only one chunk
+is held in memory at a time.
+
+    python -m accounting.importer lockbox.csv rejects.csv
+#######################################################
+"""
+
+FIELDS = ['policy_id', 'contact_id', 'amount', 'transaction_date']
+
+# Number of rows validated and committed together
+CHUNK_SIZE = 1000
+
+
+def import_payments(payment_file, reject_file=None, chunk_size=CHUNK_SIZE):
+    """
+     Import payments from an open CSV file. Rejected rows are written
+     to reject_file, if given, with an error column. Returns a
+     (posted, rejected) tuple of row counts.
+
+     The pending-cancel check of a whole chunk runs before any of its
+     rows are posted, so it sees the payments of earlier chunks but not
+     those of its own. Unlike posting the rows one at a time with
+     make_payment, a non-agent payment is still rejected when an
+     earlier row of the same chunk would have brought its policy out
+     of pending cancel; a smaller chunk_size narrows the gap.
+    """
+    rows = read_payments(payment_file)
+
+    rejects = None
+    if reject_file is not None:
+        rejects = csv.DictWriter(reject_file, FIELDS + ['error'], extrasaction='ignore')
+        rejects.writeheader()
+
+    posted = rejected = 0
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        payments, errors = validate_payments(chunk)
+        post_payments(payments)
+
+        posted += len(payments)
+        rejected += len(errors)
+        if rejects is not None:
+            for row, error in errors:
+                row['error'] = error
+                rejects.writerow(row)
+
+    logging.info('Imported %d payments, rejected %d', posted, rejected)
+    return posted, rejected
+
+
+def read_payments(payment_file):
+    """
+     Yield each row of a payment file as a dict.
+    """
+    for row in csv.DictReader(payment_file):
+        yield row
+
+
+def validate_payments(rows):
+    """
+     Check a chunk of rows. Returns a list of payment dicts ready to
+     insert and a list of (row, error) for the rows that failed.
+    """
+    parsed = []
+    errors = []
+    for row in rows:
+        try:
+            parsed.append((row, _parse(row)))
+        except ValueError as error:
+            errors.append((row, str(error)))
+
+    policy_ids = set(payment['policy_id'] for _, payment in parsed)
+    insureds = {}
+    if policy_ids:
+        insureds = dict(db.session.query(Policy.id, Policy.named_insured)
+                                  .filter(Policy.id.in_(policy_ids)))
+
+    # Payments with no contact are made by the named insured
+    for _, payment in parsed:
+        if payment['contact_id'] is None:
+            payment['contact_id'] = insureds.get(payment['policy_id'])
+
+    contact_ids = set(payment['contact_id'] for _, payment in parsed) - set([None])
+    roles = {}
+    if contact_ids:
+        roles = dict(db.session.query(Contact.id, Contact.role)
+                               .filter(Contact.id.in_(contact_ids)))
+
+    # Pending-cancel flags for every policy on each payment date
+    pending = {}
+    for _, payment in parsed:
+        pending.setdefault(payment['transaction_date'], set()).add(payment['policy_id'])
+    for transaction_date, date_policy_ids in pending.items():
+        pending[transaction_date] = policies_pending_cancellation(transaction_date,
+                                                                  date_policy_ids & set(insureds))
+
+    payments = []
+    for row, payment in parsed:
+        if payment['policy_id'] not in insureds:
+            errors.append((row, 'Policy not found'))
+        elif payment['contact_id'] not in roles:
+            errors.append((row, 'Contact not found'))
+        elif pending[payment['transaction_date']].get(payment['policy_id']) \
+                and roles[payment['contact_id']] != 'Agent':
+            errors.append((row, 'Due to the current status of this policy, an agent is needed to make payment'))
+        else:
+            payments.append(payment)
+
+    return payments, errors
+
+
+def post_payments(payments):
+    """
+     Insert a chunk of payments, apply them to invoices and post them
+     to the ledger, in one transaction.
+    """
+    if not payments:
+        return
+
+    db.session.execute(Payment.__table__.insert(), payments)
+
+    policy_ids = sorted(set(payment['policy_id'] for payment in payments))
+    allocate_policies(policy_ids)
+    rebuild_entries(policy_ids)
+    mark_dirty(policy_ids)
+    invalidate_policies(policy_ids)
+    db.session.commit()
+
+
+def _parse(row):
+    try:
+        policy_id = int(row.get('policy_id') or '')
+    except ValueError:
+        raise ValueError('Invalid policy_id')
+
+    contact_id = None
+    if row.get('contact_id'):
+        try:
+            contact_id = int(row['contact_id'])
+        except ValueError:
+            raise ValueError('Invalid contact_id')
+
+    try:
+        amount = int(row.get('amount') or '')
+    except ValueError:
+        raise ValueError('Invalid amount')
+    if amount <= 0:
+        raise ValueError('Invalid amount')
+
+    try:
+        transaction_date = datetime.strptime(row.get('transaction_date') or '', '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError('Invalid transaction_date')
+
+    return {'policy_id': policy_id,
+            'contact_id': contact_id,
+            'amount_paid': amount,
+            'transaction_date': transaction_date}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Import a lockbox payment file.')
+    parser.add_argument('payment_file')
+    parser.add_argument('reject_file')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    with open(args.payment_file, 'rb') as payment_file:
+        with open(args.reject_file, 'wb') as reject_file:
+            posted, rejected = import_payments(payment_file, reject_file, args.chunk_size)
+    print 'Posted %d payments, rejected %d' % (posted, rejected)
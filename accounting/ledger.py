@@ -0,0 +1,214 @@
+#!/user/bin/env python2.7
+import logging
+
+from itertools import groupby
+
+from sqlalchemy import and_
+
+from accounting import db
+from models import Invoice, LedgerEntry, Payment, Policy
+
+"""
+#######################################################
+Running-balance ledger. Every invoice, soft-deleted
+invoice and payment appends a dated balance delta for its
+policy, and each entry stores the policy's balance as of
+its date, so a balance lookup reads a single row.
+
+Entries are dated the way return_account_balance counts
+them: invoices on their bill_date and payments on their
+transaction_date. A soft-deleted invoice is reversed on its
+bill_date too, because deleted invoices never count towards
+a balance, even for dates before they were deleted. Writes
+that replace all of a policy's invoices rebuild its entries
+instead, which leaves out the deleted invoices altogether.
+
+Hard-deleting invoices or payments removes their entries
+without adjusting later balances; run rebuild_ledger after.
+check_ledger compares the ledger with a recomputation:
+
+    python -m accounting.ledger --check
+    python -m accounting.ledger --rebuild
+#######################################################
+"""
+
+# Number of policies rebuilt per transaction by rebuild_ledger
+REBUILD_CHUNK_SIZE = 500
+
+
+def balance_as_of(policy_id, date_cursor):
+    """
+     Return a policy's balance as of date_cursor from the latest
+     ledger entry on or before that date.
+    """
+    entry = db.session.query(LedgerEntry.balance)\
+                      .filter(LedgerEntry.policy_id == policy_id)\
+                      .filter(LedgerEntry.entry_date <= date_cursor)\
+                      .order_by(LedgerEntry.entry_date.desc(), LedgerEntry.id.desc())\
+                      .first()
+    return entry[0] if entry else 0
+
+
+def record_invoice_deleted(invoice):
+    """
+     Append the reversal of a soft-deleted invoice.
+    """
+    _append(invoice.policy_id, invoice.bill_date, u'Invoice Deleted', -invoice.amount_due,
+            invoice_id=invoice.id)
+
+
+def record_payment(payment):
+    """
+     Append an entry for a new payment. The payment must be flushed.
+    """
+    _append(payment.policy_id, payment.transaction_date, u'Payment', -payment.amount_paid,
+            payment_id=payment.id)
+
+
+def rebuild_ledger(policy_ids=None):
+    """
+     Rebuild the ledger from the invoices and payments already in
+     the db. Runs one transaction per chunk of policies.
+    """
+    policy_ids = _all_policy_ids(policy_ids)
+    for start in range(0, len(policy_ids), REBUILD_CHUNK_SIZE):
+        rebuild_entries(policy_ids[start:start + REBUILD_CHUNK_SIZE])
+        db.session.commit()
+
+    logging.info('Rebuilt ledger for %d policies', len(policy_ids))
+
+
+def rebuild_entries(policy_ids):
+    """
+     Replace the ledger entries of the given policies. The caller is
+     responsible for committing.
+    """
+    ledger = LedgerEntry.__table__
+    db.session.flush()
+    db.session.execute(ledger.delete().where(ledger.c.policy_id.in_(policy_ids)))
+
+    entries = []
+    for policy_id, policy_events in groupby(_events(policy_ids), lambda event: event[0]):
+        balance = 0
+        for _, entry_date, entry_type, amount, invoice_id, payment_id in policy_events:
+            balance += amount
+            entries.append({'policy_id': policy_id,
+                            'entry_date': entry_date,
+                            'entry_type': entry_type,
+                            'invoice_id': invoice_id,
+                            'payment_id': payment_id,
+                            'amount': amount,
+                            'balance': balance})
+
+    if entries:
+        db.session.execute(ledger.insert(), entries)
+
+
+def check_ledger(policy_ids=None):
+    """
+     Compare the ledger with a full recomputation from invoices and
+     payments. Returns a list of (policy_id, date, ledger_balance,
+     expected_balance) tuples for every date where they disagree;
+     an empty list means the ledger is consistent.
+    """
+    mismatches = []
+    policy_ids = _all_policy_ids(policy_ids)
+    for start in range(0, len(policy_ids), REBUILD_CHUNK_SIZE):
+        chunk = policy_ids[start:start + REBUILD_CHUNK_SIZE]
+
+        # Expected balance change per policy and date
+        expected = {}
+        for policy_id, entry_date, _, amount, _, _ in _events(chunk):
+            dates = expected.setdefault(policy_id, {})
+            dates[entry_date] = dates.get(entry_date, 0) + amount
+
+        # Ledger balance at the end of each date
+        recorded = {}
+        entries = db.session.query(LedgerEntry.policy_id, LedgerEntry.entry_date, LedgerEntry.balance)\
+                            .filter(LedgerEntry.policy_id.in_(chunk))\
+                            .order_by(LedgerEntry.policy_id, LedgerEntry.entry_date, LedgerEntry.id)
+        for policy_id, entry_date, balance in entries:
+            recorded.setdefault(policy_id, {})[entry_date] = balance
+
+        for policy_id in chunk:
+            changes = expected.get(policy_id, {})
+            balances = recorded.get(policy_id, {})
+            expected_balance = 0
+            ledger_balance = 0
+            for entry_date in sorted(set(changes) | set(balances)):
+                expected_balance += changes.get(entry_date, 0)
+                ledger_balance = balances.get(entry_date, ledger_balance)
+                if ledger_balance != expected_balance:
+                    mismatches.append((policy_id, entry_date, ledger_balance, expected_balance))
+
+    return mismatches
+
+
+def _append(policy_id, entry_date, entry_type, amount, invoice_id=None, payment_id=None):
+    ledger = LedgerEntry.__table__
+
+    balance = balance_as_of(policy_id, entry_date) + amount
+
+    # Entries dated after this one already include earlier balances
+    db.session.execute(ledger.update()
+                             .where(and_(ledger.c.policy_id == policy_id,
+                                         ledger.c.entry_date > entry_date))
+                             .values(balance=ledger.c.balance + amount))
+    db.session.execute(ledger.insert(), {'policy_id': policy_id,
+                                         'entry_date': entry_date,
+                                         'entry_type': entry_type,
+                                         'invoice_id': invoice_id,
+                                         'payment_id': payment_id,
+                                         'amount': amount,
+                                         'balance': balance})
+
+
+def _events(policy_ids):
+    """
+     Return (policy_id, date, entry_type, amount, invoice_id, payment_id)
+     for the non-deleted invoices and the payments on the given policies,
+     sorted by policy and date.
+    """
+    invoices = db.session.query(Invoice.policy_id, Invoice.bill_date, Invoice.amount_due, Invoice.id)\
+                         .filter(Invoice.policy_id.in_(policy_ids))\
+                         .filter(Invoice.deleted == False)
+    payments = db.session.query(Payment.policy_id, Payment.transaction_date, Payment.amount_paid, Payment.id)\
+                         .filter(Payment.policy_id.in_(policy_ids))
+
+    events = [(policy_id, bill_date, u'Invoice', amount_due, invoice_id, None)
+              for policy_id, bill_date, amount_due, invoice_id in invoices]
+    events.extend((policy_id, transaction_date, u'Payment', -amount_paid, None, payment_id)
+                  for policy_id, transaction_date, amount_paid, payment_id in payments)
+    events.sort(key=lambda event: (event[0], event[1]))
+    return events
+
+
+def _all_policy_ids(policy_ids):
+    if policy_ids is None:
+        return [policy_id for policy_id, in db.session.query(Policy.id).order_by(Policy.id)]
+    return sorted(set(policy_ids))
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Check or rebuild the running-balance ledger.')
+    parser.add_argument('--check', action='store_true', help='report dates where the ledger is wrong')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the ledger from invoices and payments')
+    parser.add_argument('--policy-id', type=int, action='append', dest='policy_ids',
+                        help='only this policy; may be repeated. Defaults to every policy.')
+    args = parser.parse_args()
+    if not (args.check or args.rebuild):
+        parser.error('pass --check, --rebuild or both')
+
+    if args.rebuild:
+        rebuild_ledger(args.policy_ids)
+        print 'Ledger rebuilt'
+    if args.check:
+        mismatches = check_ledger(args.policy_ids)
+        for policy_id, entry_date, ledger_balance, expected_balance in mismatches:
+            print 'Policy %d on %s: ledger %d, expected %d' % (policy_id, entry_date, ledger_balance,
+                                                              expected_balance)
+        print '%d mismatches' % len(mismatches)
+        sys.exit(1 if mismatches else 0)
@@ -0,0 +1,177 @@
+#!/user/bin/env python2.7
+import functools
+import re
+import threading
+import time
+
+from collections import deque
+
+from flask import g, request
+from sqlalchemy import event
+
+"""
+#######################################################
+SQL and latency instrumentation. Every SQL statement is
+counted and timed against each scope that is active when
+it runs: the Flask route handling the request and any
+PolicyAccounting method on the call stack. Totals and
+samples of slow statements are rendered in the Prometheus
+text format by the /metrics view.
+#######################################################
+"""
+
+
+class Metrics(object):
+    def __init__(self, slow_query_seconds=0.1, slow_query_samples=50):
+        self.slow_query_seconds = slow_query_seconds
+        self.totals = {}
+        self.slow_queries = deque(maxlen=slow_query_samples)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def start(self, kind, name):
+        """
+         Open a scope and return it; pass it to finish when done.
+        """
+        scope = {'key': (kind, name), 'statements': 0, 'db_seconds': 0.0, 'start': time.time()}
+        self._scopes().append(scope)
+        return scope
+
+    def finish(self, scope):
+        scopes = self._scopes()
+        if scope not in scopes:
+            return
+        scopes.remove(scope)
+        wall_seconds = time.time() - scope['start']
+
+        with self._lock:
+            totals = self.totals.setdefault(scope['key'], {'calls': 0,
+                                                           'statements': 0,
+                                                           'db_seconds': 0.0,
+                                                           'wall_seconds': 0.0})
+            totals['calls'] += 1
+            totals['statements'] += scope['statements']
+            totals['db_seconds'] += scope['db_seconds']
+            totals['wall_seconds'] += wall_seconds
+
+    def record_statement(self, statement, seconds):
+        scopes = self._scopes()
+        for scope in scopes:
+            scope['statements'] += 1
+            scope['db_seconds'] += seconds
+
+        if seconds >= self.slow_query_seconds:
+            kind, name = scopes[-1]['key'] if scopes else ('none', '')
+            with self._lock:
+                self.slow_queries.append((kind, name, ' '.join(statement.split())[:200], seconds))
+
+    def reset(self):
+        with self._lock:
+            self.totals.clear()
+            self.slow_queries.clear()
+
+    def render(self):
+        """
+         Return all metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            totals = sorted(self.totals.items())
+            slow_queries = list(self.slow_queries)
+
+        lines = []
+        for metric, field, metric_type, description in [
+                ('accounting_calls_total', 'calls', 'counter', 'Completed requests or method calls.'),
+                ('accounting_sql_statements_total', 'statements', 'counter', 'SQL statements executed.'),
+                ('accounting_db_seconds_total', 'db_seconds', 'counter', 'Time spent executing SQL.'),
+                ('accounting_wall_seconds_total', 'wall_seconds', 'counter', 'Wall-clock time.')]:
+            lines.append('# HELP %s %s' % (metric, description))
+            lines.append('# TYPE %s %s' % (metric, metric_type))
+            for (kind, name), values in totals:
+                lines.append('%s{kind="%s",name="%s"} %s' % (metric, kind, _escape(name), values[field]))
+
+        lines.append('# HELP accounting_slow_query_seconds Recent statements slower than %s seconds.'
+                     % self.slow_query_seconds)
+        lines.append('# TYPE accounting_slow_query_seconds gauge')
+        for kind, name, statement, seconds in slow_queries:
+            lines.append('accounting_slow_query_seconds{kind="%s",name="%s",statement="%s"} %s'
+                         % (kind, _escape(name), _escape(statement), seconds))
+
+        return '\n'.join(lines) + '\n'
+
+    def _scopes(self):
+        scopes = getattr(self._local, 'scopes', None)
+        if scopes is None:
+            scopes = self._local.scopes = []
+        return scopes
+
+
+metrics = Metrics()
+
+
+def instrument_engine(engine):
+    """
+     Count and time every statement executed on an engine.
+    """
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.time())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info['query_start_time'].pop()
+        metrics.record_statement(statement, time.time() - start)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def init_app(app):
+    """
+     Time every request as a scope named after its endpoint. With
+     METRICS_DEBUG_HEADER set, responses carry an X-Query-Count header.
+    """
+    metrics.slow_query_seconds = app.config.get('SLOW_QUERY_SECONDS', metrics.slow_query_seconds)
+
+    @app.before_request
+    def start_request_scope():
+        g.metrics_scope = metrics.start('route', request.endpoint or 'unknown')
+
+    @app.after_request
+    def finish_request_scope(response):
+        scope = getattr(g, 'metrics_scope', None)
+        if scope is not None:
+            if app.config.get('METRICS_DEBUG_HEADER'):
+                response.headers['X-Query-Count'] = str(scope['statements'])
+            metrics.finish(scope)
+        return response
+
+    @app.teardown_request
+    def close_request_scope(exception=None):
+        # after_request does not run when the view raised
+        scope = getattr(g, 'metrics_scope', None)
+        if scope is not None:
+            metrics.finish(scope)
+
+
+def instrument_methods(cls):
+    """
+     Class decorator that makes each public method, and __init__, a
+     scope named after the class and method.
+    """
+    for name, method in cls.__dict__.items():
+        if callable(method) and (name == '__init__' or not name.startswith('_')):
+            setattr(cls, name, _instrumented('%s.%s' % (cls.__name__, name), method))
+    return cls
+
+
+def _instrumented(name, method):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        scope = metrics.start('method', name)
+        try:
+            return method(*args, **kwargs)
+        finally:
+            metrics.finish(scope)
+    return wrapper
+
+
+def _escape(value):
+    return re.sub(r'(["\\])', r'\\\1', value).replace('\n', '\\n')
@@ -0,0 +1,63 @@
+#!/user/bin/env python2.7
+import logging
+
+from accounting import db
+from allocations import rebuild_allocations
+from ledger import rebuild_ledger
+from models import InvoiceAllocation, LedgerEntry
+
+"""
+#######################################################
+Schema migration for an existing accounting.sqlite.
+Adds the tables and indexes declared on the models that
+the db does not have yet, without touching existing data.
+
+    python -m accounting.migrations
+#######################################################
+"""
+
+
+def migrate_db():
+    """
+     Bring an existing db up to date with the models. Safe to run
+     more than once. Returns the names of the tables and indexes
+     that were created.
+    """
+    existing_tables = _sqlite_names('table')
+    existing_indexes = _sqlite_names('index')
+    created = []
+
+    # New tables are created together with their indexes
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            table.create(db.engine)
+            created.append(table.name)
+            existing_indexes.update(index.name for index in table.indexes)
+
+    # Indexes added to tables that already existed
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(db.engine)
+                created.append(index.name)
+
+    # Derived tables have to be filled from the existing data
+    if InvoiceAllocation.__tablename__ in created:
+        rebuild_allocations()
+    if LedgerEntry.__tablename__ in created:
+        rebuild_ledger()
+
+    for name in created:
+        logging.info('Created %s', name)
+    return created
+
+
+def _sqlite_names(object_type):
+    rows = db.engine.execute("SELECT name FROM sqlite_master WHERE type = ?", object_type)
+    return set(row[0] for row in rows)
+
+
+if __name__ == '__main__':
+    for name in migrate_db():
+        print 'Created %s' % name
+    print "DB Migrated!"
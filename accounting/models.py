@@ -40,7 +40,11 @@ class Policy(db.Model):
                  'invoices': [i.serialize() for i in self.invoices]
              }
 
-    invoices = db.relation('Invoice', primaryjoin="Invoice.policy_id==Policy.id")
+    invoices = db.relation('Invoice', primaryjoin="Invoice.policy_id==Policy.id", order_by='Invoice.id')
+    payments = db.relation('Payment', primaryjoin="Payment.policy_id==Policy.id", order_by='Payment.id')
+    insured_contact = db.relation('Contact', primaryjoin="Contact.id==Policy.named_insured")
+    agent_contact = db.relation('Contact', primaryjoin="Contact.id==Policy.agent")
+    dirty = db.relation('DirtyPolicy', uselist=False, cascade='all')
 
 
 
@@ -62,7 +66,11 @@ class Contact(db.Model):
 class Invoice(db.Model):
     __tablename__ = 'invoices'
 
-    __table_args__ = {}
+    __table_args__ = (db.Index('ix_invoices_policy_deleted_bill_date', 'policy_id', 'deleted', 'bill_date'),
+                      db.Index('ix_invoices_policy_deleted_cancel_date', 'policy_id', 'deleted', 'cancel_date'),
+                      db.Index('ix_invoices_due_date', 'due_date'),
+                      db.Index('ix_invoices_cancel_date', 'cancel_date'),
+                      {})
 
     #column definitions
     id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
@@ -90,11 +98,16 @@ class Invoice(db.Model):
             'amount_due': self.amount_due
         }
 
+    allocation = db.relation('InvoiceAllocation', uselist=False, cascade='all')
+    payment_allocations = db.relation('PaymentAllocation', cascade='all')
+    ledger_entries = db.relation('LedgerEntry', cascade='all')
+
 
 class Payment(db.Model):
     __tablename__ = 'payments'
 
-    __table_args__ = {}
+    __table_args__ = (db.Index('ix_payments_policy_transaction_date', 'policy_id', 'transaction_date'),
+                      {})
 
     #column definitions
     id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
@@ -116,3 +129,131 @@ class Payment(db.Model):
             'amount_paid': self.amount_paid,
             'transaction_date': str(self.transaction_date)
         }
+
+    allocations = db.relation('PaymentAllocation', cascade='all')
+    ledger_entries = db.relation('LedgerEntry', cascade='all')
+
+
+class InvoiceAllocation(db.Model):
+    __tablename__ = 'invoice_allocations'
+
+    __table_args__ = {}
+
+    #column definitions
+    invoice_id = db.Column(u'invoice_id', db.INTEGER(), db.ForeignKey('invoices.id'), primary_key=True, nullable=False)
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), index=True, nullable=False)
+    amount_paid = db.Column(u'amount_paid', db.INTEGER(), default=0, nullable=False)
+    amount_remaining = db.Column(u'amount_remaining', db.INTEGER(), nullable=False)
+
+    def __init__(self, invoice_id, policy_id, amount_paid, amount_remaining):
+        self.invoice_id = invoice_id
+        self.policy_id = policy_id
+        self.amount_paid = amount_paid
+        self.amount_remaining = amount_remaining
+
+    def serialize(self):
+        return {
+            'invoice_id': self.invoice_id,
+            'policy_id': self.policy_id,
+            'amount_paid': self.amount_paid,
+            'amount_remaining': self.amount_remaining
+        }
+
+
+class PaymentAllocation(db.Model):
+    __tablename__ = 'payment_allocations'
+
+    __table_args__ = {}
+
+    #column definitions
+    id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
+    payment_id = db.Column(u'payment_id', db.INTEGER(), db.ForeignKey('payments.id'), index=True, nullable=False)
+    invoice_id = db.Column(u'invoice_id', db.INTEGER(), db.ForeignKey('invoices.id'), index=True, nullable=False)
+    amount = db.Column(u'amount', db.INTEGER(), nullable=False)
+
+    def __init__(self, payment_id, invoice_id, amount):
+        self.payment_id = payment_id
+        self.invoice_id = invoice_id
+        self.amount = amount
+
+    def serialize(self):
+        return {
+            'payment_id': self.payment_id,
+            'invoice_id': self.invoice_id,
+            'amount': self.amount
+        }
+
+
+class LedgerEntry(db.Model):
+    __tablename__ = 'ledger_entries'
+
+    __table_args__ = (db.Index('ix_ledger_entries_policy_date', 'policy_id', 'entry_date', 'id'), {})
+
+    #column definitions
+    id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
+    entry_date = db.Column(u'entry_date', db.DATE(), nullable=False)
+    entry_type = db.Column(u'entry_type', db.Enum(u'Invoice', u'Invoice Deleted', u'Payment'), nullable=False)
+    invoice_id = db.Column(u'invoice_id', db.INTEGER(), db.ForeignKey('invoices.id'), nullable=True)
+    payment_id = db.Column(u'payment_id', db.INTEGER(), db.ForeignKey('payments.id'), nullable=True)
+    amount = db.Column(u'amount', db.INTEGER(), nullable=False)
+    balance = db.Column(u'balance', db.INTEGER(), nullable=False)
+
+    def __init__(self, policy_id, entry_date, entry_type, amount, balance):
+        self.policy_id = policy_id
+        self.entry_date = entry_date
+        self.entry_type = entry_type
+        self.amount = amount
+        self.balance = balance
+
+    def serialize(self):
+        return {
+            'policy_id': self.policy_id,
+            'entry_date': str(self.entry_date),
+            'entry_type': self.entry_type,
+            'amount': self.amount,
+            'balance': self.balance
+        }
+
+
+class DirtyPolicy(db.Model):
+    __tablename__ = 'dirty_policies'
+
+    __table_args__ = {}
+
+    #column definitions
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), primary_key=True, nullable=False)
+    marked_at = db.Column(u'marked_at', db.DateTime(), nullable=False)
+
+    def __init__(self, policy_id, marked_at):
+        self.policy_id = policy_id
+        self.marked_at = marked_at
+
+    def serialize(self):
+        return {
+            'policy_id': self.policy_id,
+            'marked_at': str(self.marked_at)
+        }
+
+
+class PolicyVersion(db.Model):
+    __tablename__ = 'policy_versions'
+
+    __table_args__ = {}
+
+    #column definitions
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), primary_key=True, nullable=False)
+    version = db.Column(u'version', db.VARCHAR(length=32), nullable=False)
+    modified_at = db.Column(u'modified_at', db.DateTime(), nullable=False)
+
+    def __init__(self, policy_id, version, modified_at):
+        self.policy_id = policy_id
+        self.version = version
+        self.modified_at = modified_at
+
+    def serialize(self):
+        return {
+            'policy_id': self.policy_id,
+            'version': self.version,
+            'modified_at': str(self.modified_at)
+        }
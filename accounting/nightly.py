@@ -0,0 +1,243 @@
+#!/user/bin/env python2.7
+import json
+import logging
+import multiprocessing
+import os
+
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+from accounting import app, db
+from cache import invalidate_policies
+from engines import init_sqlite_profile
+from models import Policy
+from tracking import mark_dirty
+from utils import cancel_policies, policies_pending_cancellation, policies_to_cancel
+
+"""
+#######################################################
+Nightly status evaluation. The policy id space is split
+into shards of consecutive ids, and each shard of active
+policies is evaluated for pending cancellation, cancel for
+non-payment and, if NIGHTLY_EXPIRE_AFTER_MONTHS is set,
+expiration by a pool of worker processes, each with its own
+engine and session. Workers only read; the parent process
+is the single writer and applies each shard's results in
+one transaction as they arrive.
+
+Each shard's results are recorded in a state file before
+they are applied, so a run that was interrupted picks up
+where it stopped when it is started again with the same
+settings and state file, and first applies again the
+results that may not have been committed.
+
+    python -m accounting.nightly --date 2015-06-01 --workers 4 --apply
+#######################################################
+"""
+
+# Result lists, in the order they are reported
+RESULT_KEYS = ['pending', 'cancel', 'expire']
+
+# Session of the current worker process
+_worker_session = None
+
+
+def run_nightly(date_cursor=None, workers=None, shard_size=None, apply=False,
+                state_file=None, progress=None, expire_after_months=None):
+    """
+     Evaluate every active policy as of date_cursor and return a dict
+     of sorted policy id lists: pending (past due, not yet at the
+     cancel date), cancel (should cancel for non-payment) and expire
+     (expire_after_months past the effective date and not cancelled,
+     NIGHTLY_EXPIRE_AFTER_MONTHS by default; empty when that is None).
+
+     With apply set, policies to cancel are cancelled like
+     cancellation_sweep does and policies to expire are cancelled the
+     same way with the Expired status. workers=1 evaluates in this
+     process without a pool. progress, if given, is called with
+     (shards done, shard count) after each shard.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    workers = workers or app.config['NIGHTLY_WORKERS']
+    shard_size = shard_size or app.config['NIGHTLY_SHARD_SIZE']
+    progress = progress or _log_progress
+    if expire_after_months is None:
+        expire_after_months = app.config['NIGHTLY_EXPIRE_AFTER_MONTHS']
+
+    shards = _shards(shard_size)
+    state = _load_state(state_file, date_cursor, shard_size, apply, expire_after_months)
+    for start in state['unwritten']:
+        _write(state['shards'][start])
+    if state['unwritten']:
+        state['unwritten'] = []
+        _save_state(state_file, state)
+    remaining = [shard for shard in shards if str(shard[0]) not in state['shards']]
+    if len(remaining) < len(shards):
+        logging.info('Resuming nightly run, %d of %d shards already done',
+                     len(shards) - len(remaining), len(shards))
+
+    tasks = [(date_cursor, start, end, expire_after_months) for start, end in remaining]
+    if workers == 1:
+        pool = None
+        results = (_evaluate_task(task, db.session) for task in tasks)
+    else:
+        # Workers must not share the parent's connections
+        db.session.commit()
+        pool = multiprocessing.Pool(workers, _init_worker, (app.config['SQLALCHEMY_DATABASE_URI'],))
+        results = pool.imap_unordered(_evaluate_in_worker, tasks)
+
+    try:
+        for start, result in results:
+            # Saved first, so a crash before the commit leaves it to be written again
+            state['shards'][str(start)] = result
+            if apply:
+                state['unwritten'] = [str(start)]
+            _save_state(state_file, state)
+            if apply:
+                _write(result)
+                state['unwritten'] = []
+                _save_state(state_file, state)
+            progress(len(state['shards']), len(shards))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    totals = dict((key, []) for key in RESULT_KEYS)
+    for result in state['shards'].values():
+        for key in RESULT_KEYS:
+            totals[key].extend(result[key])
+    for key in RESULT_KEYS:
+        totals[key].sort()
+    return totals
+
+
+def evaluate_shard(session, date_cursor, start, end, expire_after_months=None):
+    """
+     Evaluate the active policies with ids from start to end inclusive.
+     Policies are only found to expire when expire_after_months is
+     given. Only reads, so any session will do.
+    """
+    policy_ids = [policy_id for policy_id, in session.query(Policy.id)
+                                                     .filter(Policy.id.between(start, end))
+                                                     .filter(Policy.status == u'Active')]
+    if not policy_ids:
+        return dict((key, []) for key in RESULT_KEYS)
+
+    pending = policies_pending_cancellation(date_cursor, policy_ids, session=session)
+    cancel = policies_to_cancel(date_cursor, policy_ids, session=session)
+
+    # Cancelling for non-payment comes first
+    expire = set()
+    if expire_after_months is not None:
+        term_start = date_cursor - relativedelta(months=expire_after_months)
+        expire = set(policy_id for policy_id, in session.query(Policy.id)
+                                                        .filter(Policy.id.in_(policy_ids))
+                                                        .filter(Policy.effective_date <= term_start))
+
+    return {'pending': sorted(policy_id for policy_id, flag in pending.items() if flag),
+            'cancel': cancel,
+            'expire': sorted(expire - set(cancel))}
+
+
+def _evaluate_task(task, session):
+    date_cursor, start, end, expire_after_months = task
+    return start, evaluate_shard(session, date_cursor, start, end, expire_after_months)
+
+
+def _init_worker(database_uri):
+    global _worker_session
+    engine = create_engine(database_uri)
+    init_sqlite_profile(app, engine)
+    _worker_session = sessionmaker(bind=engine)()
+
+
+def _evaluate_in_worker(task):
+    try:
+        return _evaluate_task(task, _worker_session)
+    finally:
+        # End the read transaction so the writer is never blocked
+        _worker_session.rollback()
+
+
+def _write(result):
+    # The same changes cancel_policy makes, in one transaction. Writing
+    # a result again is harmless, so a resumed run can redo one.
+    today = datetime.now().date()
+    if result['cancel']:
+        cancel_policies(result['cancel'], {'status': u'Canceled',
+                                           'status_code': u'Non-Payment',
+                                           'cancel_date': today})
+    if result['expire']:
+        cancel_policies(result['expire'], {'status': u'Expired',
+                                           'status_code': app.config['NIGHTLY_EXPIRE_STATUS_CODE'],
+                                           'cancel_date': today})
+    written = result['cancel'] + result['expire']
+    if written:
+        mark_dirty(written)
+        invalidate_policies(written)
+    db.session.commit()
+
+
+def _shards(shard_size):
+    """
+     Return (first id, last id) ranges covering every policy id.
+    """
+    first_id, last_id = db.session.query(func.min(Policy.id), func.max(Policy.id)).one()
+    if first_id is None:
+        return []
+    return [(start, min(start + shard_size - 1, last_id))
+            for start in range(first_id, last_id + 1, shard_size)]
+
+
+def _load_state(state_file, date_cursor, shard_size, apply, expire_after_months):
+    state = {'date': str(date_cursor), 'shard_size': shard_size, 'apply': apply,
+             'expire_after_months': expire_after_months, 'shards': {}, 'unwritten': []}
+    if state_file and os.path.exists(state_file):
+        with open(state_file) as saved_file:
+            saved = json.load(saved_file)
+        # Only resume a run with the same settings
+        if all(saved.get(key) == state[key] for key in ('date', 'shard_size', 'apply', 'expire_after_months')):
+            state['shards'] = saved['shards']
+            state['unwritten'] = saved.get('unwritten', [])
+    return state
+
+
+def _save_state(state_file, state):
+    if not state_file:
+        return
+    # Write a new file and rename it so an interrupted write leaves the old state
+    with open(state_file + '.tmp', 'w') as new_file:
+        json.dump(state, new_file)
+    os.rename(state_file + '.tmp', state_file)
+
+
+def _log_progress(done, total):
+    logging.info('Nightly evaluation: %d of %d shards done', done, total)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the nightly policy status evaluation.')
+    parser.add_argument('--date', help='evaluation date, YYYY-MM-DD; defaults to today')
+    parser.add_argument('--workers', type=int, default=app.config['NIGHTLY_WORKERS'])
+    parser.add_argument('--shard-size', type=int, default=app.config['NIGHTLY_SHARD_SIZE'])
+    parser.add_argument('--state-file', default='nightly_state.json',
+                        help='records finished shards so an interrupted run can resume')
+    parser.add_argument('--apply', action='store_true', help='cancel and expire the policies found')
+    parser.add_argument('--expire-after-months', type=int, default=app.config['NIGHTLY_EXPIRE_AFTER_MONTHS'],
+                        help='expire policies this many months after their effective date; off by default')
+    args = parser.parse_args()
+
+    def print_progress(done, total):
+        print '%d/%d shards' % (done, total)
+
+    date_cursor = datetime.strptime(args.date, '%Y-%m-%d').date() if args.date else None
+    totals = run_nightly(date_cursor, args.workers, args.shard_size, args.apply,
+                         args.state_file, print_progress, args.expire_after_months)
+    print 'Pending cancellation: %d, to cancel: %d, to expire: %d' % tuple(
+        len(totals[key]) for key in RESULT_KEYS)
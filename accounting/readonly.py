@@ -0,0 +1,163 @@
+#!/user/bin/env python2.7
+import logging
+import os
+import sqlite3
+import threading
+import time
+import urllib
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import NullPool
+
+from engines import init_sqlite_profile
+
+"""
+#######################################################
+Read-only engine. Reports, the policy views and bulk reads
+run on a session of their own, so a long read never holds
+the writer's connection or transaction. READ_ENGINE picks
+what that session reads:
+
+  'ro'        the db file itself, opened with mode=ro and
+              query_only. In WAL mode readers never block
+              the writer and each read transaction sees
+              every commit made before it started, so it
+              is never stale.
+  'snapshot'  a copy of the db written with VACUUM INTO by
+              a process of its own, never by a request:
+
+                  python -m accounting.readonly
+
+              refreshes it every READ_SNAPSHOT_SECONDS, or
+              once with --once, e.g. from cron. What a read
+              sees is as far behind the writer as the last
+              copy. Reads that need every commit ask for
+              read_session(fresh=True) and use db.session
+              instead, as do reads before the first copy.
+  'primary'   no separate engine; reads share db.session.
+
+The db is opened read-only with a file: URI, which needs
+SQLite built with USE_URI. Without it, connect would
+create a file named 'file:...', so the read engine opens
+the path itself and relies on query_only instead.
+
+Code that must see its own uncommitted writes, like
+PolicyAccounting, keeps using db.session. Read paths take
+the session explicitly:
+
+    balances_as_of(date_cursor, policy_ids, session=read_session())
+#######################################################
+"""
+
+READ_ENGINES = ['ro', 'snapshot', 'primary']
+
+_app = None
+_db = None
+_session = None
+_use_uri = False
+_snapshot_lock = threading.Lock()
+
+
+def init_app(app, db):
+    """
+     Create the read-only engine and remove its session at the end of
+     each request. READ_ENGINE is read whenever a read session is asked
+     for or connects, so changing it applies to later reads. Returns
+     the engine, or None when the db is not a SQLite file and reads
+     always share db.session.
+    """
+    global _app, _db, _session, _use_uri
+    _app, _db = app, db
+
+    if app.config['READ_ENGINE'] not in READ_ENGINES:
+        raise ValueError('READ_ENGINE must be one of ' + ', '.join(READ_ENGINES))
+    # Only a SQLite db file can be opened read-only or copied
+    if db.engine.dialect.name != 'sqlite' or db.engine.url.database in (None, '', ':memory:'):
+        return None
+
+    _use_uri = _uri_filenames()
+    if not _use_uri:
+        logging.warning('SQLite was built without USE_URI; read connections rely on query_only')
+    engine = create_engine('sqlite://', poolclass=NullPool, creator=_connect)
+    init_sqlite_profile(app, engine, 'READ_SQLITE_PRAGMAS')
+    _session = scoped_session(sessionmaker(bind=engine))
+
+    @app.teardown_request
+    def remove_read_session(exception=None):
+        _session.remove()
+
+    return engine
+
+
+def read_session(fresh=False):
+    """
+     Return the session read-only paths should run on. With fresh set,
+     reads that must see every commit, e.g. responses cached until the
+     next write, never come from a snapshot.
+    """
+    mode = _app.config['READ_ENGINE']
+    if _session is None or mode == 'primary':
+        return _db.session
+    if mode == 'snapshot' and (fresh or not os.path.exists(snapshot_path())):
+        return _db.session
+    return _session
+
+
+def _uri_filenames():
+    connection = sqlite3.connect(':memory:')
+    try:
+        return 'USE_URI' in [option for option, in connection.execute('PRAGMA compile_options')]
+    finally:
+        connection.close()
+
+
+def _connect():
+    if _use_uri:
+        return sqlite3.connect('file:%s?mode=ro' % urllib.quote(_read_path()))
+    return sqlite3.connect(_read_path())
+
+
+def _read_path():
+    if _app.config['READ_ENGINE'] == 'snapshot':
+        return snapshot_path()
+    return _db.engine.url.database
+
+
+def snapshot_path():
+    return _app.config['READ_SNAPSHOT_PATH'] or _db.engine.url.database + '.snapshot'
+
+
+def refresh_snapshot():
+    """
+     Copy the db to the snapshot. The copy is written to a new file and
+     renamed over the old one, so reads already running finish on the
+     old copy and later ones open the new one.
+    """
+    with _snapshot_lock:
+        path = snapshot_path()
+        if os.path.exists(path + '.tmp'):
+            os.remove(path + '.tmp')
+        connection = sqlite3.connect(_db.engine.url.database)
+        try:
+            connection.execute('VACUUM INTO ?', (path + '.tmp',))
+        finally:
+            connection.close()
+        os.rename(path + '.tmp', path)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from accounting import app, db
+
+    parser = argparse.ArgumentParser(description='Refresh the read snapshot every READ_SNAPSHOT_SECONDS.')
+    parser.add_argument('--once', action='store_true', help='refresh it once, e.g. from cron')
+    args = parser.parse_args()
+
+    init_app(app, db)
+    while True:
+        refresh_snapshot()
+        if args.once:
+            break
+        time.sleep(app.config['READ_SNAPSHOT_SECONDS'])
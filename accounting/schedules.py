@@ -0,0 +1,90 @@
+#!/user/bin/env python2.7
+import threading
+
+from collections import OrderedDict
+from dateutil.relativedelta import relativedelta
+
+"""
+#######################################################
+Billing schedule templates. The bill, due and cancel dates
+of a policy's invoices only depend on its billing schedule
+and effective date, and most policies share effective
+dates, so the dates are computed once per pair and kept in
+a bounded least-recently-used cache.
+#######################################################
+"""
+
+BILLING_SCHEDULES = {'Annual': 1, 'Two-Pay': 2, 'Quarterly': 4, 'Monthly': 12}
+
+# Number of (billing schedule, effective date) templates kept in memory
+TEMPLATE_CACHE_SIZE = 4096
+
+
+class ScheduleTemplates(object):
+    """
+     Least-recently-used cache of invoice date templates.
+    """
+    def __init__(self, max_size=TEMPLATE_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, billing_schedule, effective_date):
+        """
+         Return a tuple of (bill_date, due_date, cancel_date) for each
+         invoice, or None if the billing schedule is not valid.
+        """
+        num_of_payments = BILLING_SCHEDULES.get(billing_schedule)
+        if not num_of_payments:
+            return None
+
+        key = (billing_schedule, effective_date)
+        with self._lock:
+            template = self._templates.pop(key, None)
+            if template is not None:
+                self.hits += 1
+                self._templates[key] = template
+                return template
+
+        template = _build_template(num_of_payments, effective_date)
+
+        with self._lock:
+            self.misses += 1
+            self._templates[key] = template
+            while len(self._templates) > self.max_size:
+                self._templates.popitem(last=False)
+        return template
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._templates)
+
+
+templates = ScheduleTemplates()
+
+
+def split_premium(annual_premium, num_of_payments):
+    """
+     Split a premium into num_of_payments whole amounts that add up
+     to the premium. Any remainder is billed on the first invoice.
+    """
+    amount, remainder = divmod(annual_premium, num_of_payments)
+    return [amount + remainder] + [amount] * (num_of_payments - 1)
+
+
+def _build_template(num_of_payments, effective_date):
+    dates = []
+    for i in range(num_of_payments):
+        # Add months after effective date to get bill date
+        bill_date = effective_date + relativedelta(months=i*(12/num_of_payments))
+        dates.append((bill_date,
+                      bill_date + relativedelta(months=1),  # due date
+                      bill_date + relativedelta(months=1, days=14)))  # cancellation date
+    return tuple(dates)
@@ -0,0 +1,153 @@
+#!/user/bin/env python2.7
+from sqlalchemy import String, select
+from sqlalchemy.sql.expression import type_coerce
+
+from accounting import db
+from models import Contact, Invoice, Payment, Policy
+
+"""
+#######################################################
+ORM-free serialization. The serialize methods on the
+models need loaded instances and call str() on every
+date. The functions here read column tuples from core
+selects instead, and read dates as the ISO text SQLite
+stores them in, which is exactly what str() gives for a
+date, so no date objects are built or formatted.
+
+The dicts have the same keys, values and key order as
+the serialize methods, so jsonify produces byte-identical
+JSON from either.
+#######################################################
+"""
+
+policies = Policy.__table__
+invoices = Invoice.__table__
+payments = Payment.__table__
+insureds = Contact.__table__.alias('insureds')
+agents = Contact.__table__.alias('agents')
+
+
+def date_text(column, label=None):
+    """
+     Select a date column as its stored text instead of a date.
+    """
+    return type_coerce(column, String).label(label or column.name)
+
+
+# Columns of each row encoding, in the order the encoders unpack them
+POLICY_COLUMNS = [policies.c.id, policies.c.policy_number,
+                  date_text(policies.c.effective_date), date_text(policies.c.cancel_date),
+                  policies.c.status, policies.c.billing_schedule, policies.c.annual_premium,
+                  policies.c.named_insured, policies.c.agent]
+INVOICE_COLUMNS = [invoices.c.id, invoices.c.policy_id,
+                   date_text(invoices.c.bill_date), date_text(invoices.c.due_date),
+                   date_text(invoices.c.cancel_date), invoices.c.amount_due]
+PAYMENT_COLUMNS = [payments.c.policy_id, payments.c.contact_id, payments.c.amount_paid,
+                   date_text(payments.c.transaction_date)]
+
+
+def encode_policy(row, serialized_invoices):
+    # Same as Policy.serialize; str() of a missing date is 'None'
+    id, policy_number, effective_date, cancel_date, status, billing_schedule, \
+        annual_premium, named_insured, agent = row
+    return {
+        'id': id,
+        'policy_number': policy_number,
+        'effective_date': effective_date,
+        'cancel_date': 'None' if cancel_date is None else cancel_date,
+        'status': status,
+        'billing_schedule': billing_schedule,
+        'annual_premium': annual_premium,
+        'named_insured': named_insured,
+        'agent': agent,
+        'invoices': serialized_invoices
+    }
+
+
+def encode_invoice(row):
+    # Same as Invoice.serialize
+    id, policy_id, bill_date, due_date, cancel_date, amount_due = row
+    return {
+        'id': id,
+        'policy_id': policy_id,
+        'bill_date': bill_date,
+        'due_date': due_date,
+        'cancel_date': cancel_date,
+        'amount_due': amount_due
+    }
+
+
+def encode_payment(row):
+    # Same as Payment.serialize
+    policy_id, contact_id, amount_paid, transaction_date = row
+    return {
+        'policy_id': policy_id,
+        'contact_id': contact_id,
+        'amount_paid': amount_paid,
+        'transaction_date': transaction_date
+    }
+
+
+def policy_response(policy_id, date_cursor, session=None):
+    """
+     Return the policy view's response dict for a policy as of
+     date_cursor, the same dict the view builds from the ORM. Returns
+     None if the policy does not exist; a missing insured or agent
+     leaves insured or agent_name None for the view to report. Queries
+     run on session, db.session by default.
+    """
+    session = session or db.session
+
+    # The policy, its contacts' names and its invoices in one query
+    fields = len(POLICY_COLUMNS)
+    query = select(POLICY_COLUMNS + [insureds.c.name, agents.c.name, invoices.c.deleted] + INVOICE_COLUMNS,
+                   from_obj=policies.outerjoin(insureds, insureds.c.id == policies.c.named_insured)
+                                    .outerjoin(agents, agents.c.id == policies.c.agent)
+                                    .outerjoin(invoices, invoices.c.policy_id == policies.c.id))\
+        .where(policies.c.id == policy_id)\
+        .order_by(invoices.c.id)
+    rows = session.execute(query).fetchall()
+    if not rows:
+        return None
+
+    # ISO dates compare in date order as text
+    cursor_text = str(date_cursor)
+    serialized_invoices = []
+    due_now = 0
+    for row in rows:
+        if row[fields + 3] is None:
+            # No invoices, only the outer-joined policy
+            continue
+        invoice = encode_invoice(row[fields + 3:])
+        serialized_invoices.append(invoice)
+        if not row[fields + 2] and invoice['bill_date'] <= cursor_text:
+            due_now += invoice['amount_due']
+
+    payment_rows = session.execute(select(PAYMENT_COLUMNS)
+                                   .where(payments.c.policy_id == policy_id)
+                                   .order_by(payments.c.id)).fetchall()
+    paid = sum(amount_paid for _, _, amount_paid, transaction_date in payment_rows
+               if transaction_date <= cursor_text)
+
+    # Keys in the order the view adds them
+    insured_name, agent_name = rows[0][fields], rows[0][fields + 1]
+    response = encode_policy(rows[0][:fields], serialized_invoices)
+    response['balance'] = due_now - paid
+    response['agent_name'] = agent_name
+    response['insured'] = insured_name
+    response['payments'] = [encode_payment(row) for row in payment_rows]
+    return response
+
+
+def invoice_dicts(policy_ids=None, session=None):
+    """
+     Return serialized invoices, deleted ones included like
+     Policy.serialize, of the given policies or of the whole book when
+     policy_ids is None, ordered by id. Queries run on session,
+     db.session by default.
+    """
+    session = session or db.session
+    query = select(INVOICE_COLUMNS).order_by(invoices.c.id)
+    if policy_ids is not None:
+        query = query.where(invoices.c.policy_id.in_(policy_ids))
+    return [encode_invoice(row) for row in session.execute(query)]
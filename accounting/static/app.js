@@ -12,6 +12,7 @@ function PolicyViewModel(data) {
     self.invoices = ko.observableArray(data.invoices);
     self.payments = ko.observableArray(data.payments);
     self.status = ko.observable(data.status);
+    self.statement = ko.observableArray([]);
 }
 
 function AppViewModel() {
@@ -40,6 +41,7 @@ function AppViewModel() {
             success: function (data) {
                 console.log(data);
                 self.policy(new PolicyViewModel(data));
+                self.loadStatement(self.policy());
                 return;
             },
             error: function (response) {
@@ -50,6 +52,24 @@ function AppViewModel() {
             }
         });
     }
+
+    // Every invoice and payment up to the search date with the running
+    // balance, in one request
+    self.loadStatement = function (policy) {
+        $.ajax({
+            url: '/policy/' + policy.id() + '/balances?by=event&end=' + self.policy_date(),
+            contentType: 'application/json',
+            type: 'GET',
+            success: function (data) {
+                policy.statement(data.points);
+                return;
+            },
+            error: function (response) {
+                console.log(JSON.stringify(response))
+                return;
+            }
+        });
+    }
 }
 
 appViewModel = new AppViewModel();
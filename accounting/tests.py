@@ -1,12 +1,39 @@
 #!/user/bin/env python2.7
 
+import csv
+import gzip
+import json
+import os
+import sqlite3
+import threading
 import unittest
+import uuid
+from StringIO import StringIO
 from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
-
-from accounting import db
-from models import Contact, Invoice, Payment, Policy
-from utils import PolicyAccounting
+from flask import jsonify
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+from accounting import aging, app, db, read_engine, readonly
+from allocations import invoice_allocation, open_invoices, rebuild_allocations
+from cache import MemoryBackend, PolicyResponseCache, invalidate_policies, policy_cache, policy_version
+from exports import export_chunks, export_watermark
+from importer import import_payments
+from ledger import check_ledger, rebuild_ledger
+from metrics import Metrics, metrics
+from migrations import migrate_db
+from readonly import read_session, refresh_snapshot, snapshot_path
+from schedules import ScheduleTemplates, split_premium
+from serializers import invoice_dicts, policy_response
+from tracking import _crossed_dates, clear_dirty, crossed_date_policies, dirty_policies
+from nightly import _shards, _write, run_nightly
+from models import Contact, DirtyPolicy, Invoice, InvoiceAllocation, LedgerEntry, Payment, PaymentAllocation, Policy, \
+                   PolicyVersion
+from writer import GroupCommitWriter
+from utils import PolicyAccounting, _pending_cancellation_entries, balance_history, \
+                  balances_as_of, cancellation_sweep, onboard_policies, policies_pending_cancellation, \
+                  policies_to_cancel
 
 """
 #######################################################
@@ -14,6 +41,39 @@ Test Suite for Accounting
 #######################################################
 """
 
+
+class count_queries(object):
+    """
+     Context manager that records the SQL statements executed inside it.
+
+         with count_queries() as queries:
+             ...
+         self.assertTrue(len(queries) <= 2)
+    """
+    active = []
+
+    def __init__(self):
+        self.statements = []
+
+    def __enter__(self):
+        count_queries.active.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        count_queries.active.remove(self)
+
+    def __len__(self):
+        return len(self.statements)
+
+    @classmethod
+    def record(cls, conn, cursor, statement, parameters, context, executemany):
+        for counter in cls.active:
+            counter.statements.append(statement)
+
+event.listen(db.engine, 'before_cursor_execute', count_queries.record)
+if read_engine is not None:
+    event.listen(read_engine, 'before_cursor_execute', count_queries.record)
+
 class TestCancelPolicy(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -370,3 +430,2083 @@ class TestReturnAccountBalance(unittest.TestCase):
         self.payments.append(pa.make_payment(contact_id=self.policy.agent,
                                              date_cursor=invoices[1].bill_date, amount=600))
         self.assertEquals(pa.return_account_balance(date_cursor=invoices[1].bill_date), 0)
+
+
+class TestBalancesAsOf(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        cls.policy.billing_schedule = "Quarterly"
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        cls.empty_policy = Policy('Test Empty Policy', date(2015, 1, 1), 1200)
+        cls.empty_policy.named_insured = cls.test_insured.id
+        cls.empty_policy.agent = cls.test_agent.id
+        db.session.add(cls.policy)
+        db.session.add(cls.empty_policy)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.delete(cls.policy)
+        db.session.delete(cls.empty_policy)
+        db.session.commit()
+
+    def setUp(self):
+        self.payments = []
+
+    def tearDown(self):
+        for invoice in self.policy.invoices:
+            db.session.delete(invoice)
+        for payment in self.payments:
+            db.session.delete(payment)
+        db.session.commit()
+
+    def test_matches_return_account_balance(self):
+        pa = PolicyAccounting(self.policy.id)
+        self.payments.append(pa.make_payment(contact_id=self.policy.agent,
+                                             date_cursor=date(2015, 2, 1), amount=300))
+        self.payments.append(pa.make_payment(contact_id=self.policy.agent,
+                                             date_cursor=date(2015, 4, 15), amount=250))
+        # A deleted invoice must not count towards the balance
+        pa.delete_invoice(self.policy.invoices[3])
+        db.session.commit()
+
+        for date_cursor in [date(2014, 12, 31), date(2015, 1, 1), date(2015, 2, 1),
+                            date(2015, 4, 1), date(2015, 4, 15), date(2015, 10, 1)]:
+            balances = balances_as_of(date_cursor, [self.policy.id])
+            self.assertEquals(balances[self.policy.id],
+                              pa.return_account_balance(date_cursor))
+
+    def test_whole_book(self):
+        PolicyAccounting(self.policy.id)
+        balances = balances_as_of(date(2015, 4, 1))
+
+        self.assertEquals(balances[self.policy.id], 600)
+        self.assertEquals(balances[self.empty_policy.id], 0)
+        for policy in Policy.query.all():
+            self.assertTrue(policy.id in balances)
+
+    def test_no_policy_ids(self):
+        self.assertEquals(balances_as_of(date(2015, 4, 1), []), {})
+
+
+class TestCancellationSweep(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.unpaid_policy = Policy('Test Unpaid Policy', date(2015, 1, 1), 1200)
+        cls.paid_policy = Policy('Test Paid Policy', date(2015, 1, 1), 1200)
+        for policy in [cls.unpaid_policy, cls.paid_policy]:
+            policy.billing_schedule = "Quarterly"
+            policy.named_insured = cls.test_insured.id
+            policy.agent = cls.test_agent.id
+            db.session.add(policy)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.delete(cls.unpaid_policy)
+        db.session.delete(cls.paid_policy)
+        db.session.commit()
+
+    def setUp(self):
+        self.payments = []
+        self.unpaid_pa = PolicyAccounting(self.unpaid_policy.id)
+        self.paid_pa = PolicyAccounting(self.paid_policy.id)
+        self.payments.append(self.paid_pa.make_payment(contact_id=self.paid_policy.agent,
+                                                       date_cursor=date(2015, 1, 15),
+                                                       amount=300))
+        self.policy_ids = [self.unpaid_policy.id, self.paid_policy.id]
+
+    def tearDown(self):
+        for policy in [self.unpaid_policy, self.paid_policy]:
+            for invoice in policy.invoices:
+                db.session.delete(invoice)
+            policy.status = 'Active'
+            policy.status_code = None
+            policy.status_desc = None
+            policy.cancel_date = None
+        for payment in self.payments:
+            db.session.delete(payment)
+        db.session.commit()
+
+    def test_matches_evaluate_cancel(self):
+        for date_cursor in [date(2015, 2, 1), date(2015, 2, 15), date(2015, 5, 15),
+                            date(2015, 8, 15), date(2016, 1, 1)]:
+            expected = [pa.policy.id for pa in [self.unpaid_pa, self.paid_pa]
+                        if pa.evaluate_cancel(date_cursor)]
+            self.assertEquals(policies_to_cancel(date_cursor, self.policy_ids), sorted(expected))
+
+    def test_sweep_without_apply(self):
+        self.assertEquals(cancellation_sweep(date(2015, 2, 15), self.policy_ids),
+                          [self.unpaid_policy.id])
+        self.assertEquals(self.unpaid_policy.status, 'Active')
+
+    def test_sweep_with_apply(self):
+        canceled = cancellation_sweep(date(2015, 2, 15), self.policy_ids,
+                                      apply=True, description='Sweep')
+
+        self.assertEquals(canceled, [self.unpaid_policy.id])
+        self.assertEquals(self.unpaid_policy.status, 'Canceled')
+        self.assertEquals(self.unpaid_policy.status_code, 'Non-Payment')
+        self.assertEquals(self.unpaid_policy.status_desc, 'Sweep')
+        self.assertEquals(self.unpaid_policy.cancel_date, datetime.now().date())
+        for invoice in self.unpaid_policy.invoices:
+            self.assertEquals(invoice.deleted, True)
+        self.assertEquals(self.paid_policy.status, 'Active')
+
+        # Canceled policies are not picked up again
+        self.assertEquals(policies_to_cancel(date(2015, 2, 15), self.policy_ids), [])
+
+    def test_sweep_invalid_reason(self):
+        self.assertEquals(cancellation_sweep(date(2015, 2, 15), self.policy_ids,
+                                             apply=True, status_code='Random'), [])
+        self.assertEquals(self.unpaid_policy.status, 'Active')
+
+
+class TestCancellationPending(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        cls.policy.billing_schedule = "Quarterly"
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        db.session.add(cls.policy)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.delete(cls.policy)
+        db.session.commit()
+
+    def setUp(self):
+        self.payments = []
+        self.pa = PolicyAccounting(self.policy.id)
+
+    def tearDown(self):
+        for invoice in self.policy.invoices:
+            db.session.delete(invoice)
+        for payment in self.payments:
+            db.session.delete(payment)
+        db.session.commit()
+
+    def pay(self, transaction_date):
+        payment = Payment(self.policy.id, self.policy.agent, 300, transaction_date)
+        db.session.add(payment)
+        db.session.commit()
+        self.payments.append(payment)
+
+    def test_unpaid_between_due_and_cancel_date(self):
+        self.assertFalse(self.pa.evaluate_cancellation_pending_due_to_non_pay(date(2015, 2, 1)))
+        self.assertTrue(self.pa.evaluate_cancellation_pending_due_to_non_pay(date(2015, 2, 2)))
+        self.assertFalse(self.pa.evaluate_cancellation_pending_due_to_non_pay(date(2015, 2, 15)))
+
+    def test_paid_on_time(self):
+        self.pay(date(2015, 2, 1))
+        self.assertFalse(self.pa.evaluate_cancellation_pending_due_to_non_pay(date(2015, 2, 2)))
+
+    def test_paid_late(self):
+        self.pay(date(2015, 2, 3))
+        self.assertTrue(self.pa.evaluate_cancellation_pending_due_to_non_pay(date(2015, 2, 5)))
+
+    def test_paid_before_bill_date(self):
+        # A payment before the second invoice was billed does not pay it
+        self.pay(date(2015, 1, 15))
+        self.assertTrue(self.pa.evaluate_cancellation_pending_due_to_non_pay(date(2015, 5, 5)))
+
+    def test_batch_matches_single_policy(self):
+        self.pay(date(2015, 1, 15))
+        for date_cursor in [date(2015, 2, 2), date(2015, 5, 5), date(2015, 5, 20)]:
+            pending = policies_pending_cancellation(date_cursor, [self.policy.id, 1])
+            self.assertEquals(pending[self.policy.id],
+                              self.pa.evaluate_cancellation_pending_due_to_non_pay(date_cursor))
+            self.assertEquals(pending[1],
+                              PolicyAccounting(1).evaluate_cancellation_pending_due_to_non_pay(date_cursor))
+
+
+class TestAllocations(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        db.session.add(cls.policy)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.delete(cls.policy)
+        db.session.commit()
+
+    def setUp(self):
+        self.payments = []
+        self.policy.billing_schedule = "Quarterly"
+        self.pa = PolicyAccounting(self.policy.id)
+
+    def tearDown(self):
+        for invoice in self.policy.invoices:
+            db.session.delete(invoice)
+        for payment in self.payments:
+            db.session.delete(payment)
+        db.session.commit()
+
+    def allocations(self):
+        return [(invoice_allocation(invoice.id).amount_paid,
+                 invoice_allocation(invoice.id).amount_remaining)
+                for invoice in open_invoices(self.policy.id)]
+
+    def test_new_invoices_are_open(self):
+        self.assertEquals(self.allocations(), [(0, 300)] * 4)
+
+    def test_payment_applied_oldest_first(self):
+        self.payments.append(self.pa.make_payment(contact_id=self.policy.agent,
+                                                  date_cursor=date(2015, 1, 15), amount=450))
+
+        self.assertEquals(self.allocations(), [(150, 150), (0, 300), (0, 300)])
+        payment_allocations = PaymentAllocation.query.filter_by(payment_id=self.payments[0].id)\
+                                                     .order_by(PaymentAllocation.id).all()
+        self.assertEquals([allocation.amount for allocation in payment_allocations], [300, 150])
+
+    def test_change_billing_schedule_reallocates(self):
+        self.payments.append(self.pa.make_payment(contact_id=self.policy.agent,
+                                                  date_cursor=date(2015, 1, 15), amount=450))
+        self.pa.change_billing_schedule("Monthly")
+
+        self.assertEquals(self.allocations(), [(50, 50)] + [(0, 100)] * 7)
+
+    def test_rebuild_matches_incremental(self):
+        self.payments.append(self.pa.make_payment(contact_id=self.policy.agent,
+                                                  date_cursor=date(2015, 1, 15), amount=450))
+        self.payments.append(self.pa.make_payment(contact_id=self.policy.agent,
+                                                  date_cursor=date(2015, 4, 15), amount=400))
+        incremental = self.allocations()
+
+        rebuild_allocations([self.policy.id])
+
+        self.assertEquals(self.allocations(), incremental)
+        self.assertEquals(InvoiceAllocation.query.filter_by(policy_id=self.policy.id).count(), 4)
+
+    def test_delete_invoice_reallocates(self):
+        self.payments.append(self.pa.make_payment(contact_id=self.policy.agent,
+                                                  date_cursor=date(2015, 1, 15), amount=300))
+        version = policy_version(self.policy.id)
+        self.pa.delete_invoice(self.policy.invoices[0])
+
+        # The payment moves on to the next invoice, as a rebuild would put it
+        self.assertEquals(self.allocations(), [(0, 300), (0, 300)])
+        rebuild_allocations([self.policy.id])
+        self.assertEquals(self.allocations(), [(0, 300), (0, 300)])
+        self.assertEquals(self.pa.return_account_balance(date(2015, 12, 1)), 600)
+        self.assertNotEquals(policy_version(self.policy.id), version)
+        self.assertTrue(self.policy.id in dirty_policies())
+
+
+class TestLedger(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        db.session.add(cls.policy)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.delete(cls.policy)
+        db.session.commit()
+
+    def setUp(self):
+        self.payments = []
+        self.policy.billing_schedule = "Quarterly"
+        self.pa = PolicyAccounting(self.policy.id)
+        self.dates = [date(2014, 12, 31), date(2015, 1, 1), date(2015, 2, 1), date(2015, 3, 1),
+                      date(2015, 4, 1), date(2015, 6, 15), date(2015, 12, 31)]
+
+    def tearDown(self):
+        for invoice in self.policy.invoices:
+            db.session.delete(invoice)
+        for payment in self.payments:
+            db.session.delete(payment)
+        db.session.commit()
+
+    def assertMatchesRecomputation(self):
+        self.assertEquals(check_ledger([self.policy.id]), [])
+        for date_cursor in self.dates:
+            self.assertEquals(self.pa.return_account_balance(date_cursor),
+                              balances_as_of(date_cursor, [self.policy.id])[self.policy.id])
+
+    def test_invoices(self):
+        self.assertEquals(self.pa.return_account_balance(date(2015, 4, 1)), 600)
+        self.assertMatchesRecomputation()
+
+    def test_backdated_payment(self):
+        self.payments.append(self.pa.make_payment(contact_id=self.policy.agent,
+                                                  date_cursor=date(2015, 4, 1), amount=300))
+        self.payments.append(self.pa.make_payment(contact_id=self.policy.agent,
+                                                  date_cursor=date(2015, 2, 1), amount=300))
+
+        self.assertEquals(self.pa.return_account_balance(date(2015, 3, 1)), 0)
+        self.assertEquals(self.pa.return_account_balance(date(2015, 4, 1)), 0)
+        self.assertMatchesRecomputation()
+
+    def test_change_billing_schedule(self):
+        self.payments.append(self.pa.make_payment(contact_id=self.policy.agent,
+                                                  date_cursor=date(2015, 2, 1), amount=300))
+        self.pa.change_billing_schedule("Monthly")
+
+        self.assertEquals(self.pa.return_account_balance(date(2015, 4, 1)), 100)
+        self.assertMatchesRecomputation()
+
+    def test_cancel_policy(self):
+        self.pa.cancel_policy('Canceled', 'Underwriting')
+
+        self.assertEquals(self.pa.return_account_balance(date(2015, 12, 31)), 0)
+        self.assertMatchesRecomputation()
+
+    def test_check_ledger_reports_mismatch(self):
+        entry = LedgerEntry.query.filter_by(policy_id=self.policy.id)\
+                                 .order_by(LedgerEntry.entry_date).first()
+        entry.balance += 1
+        db.session.commit()
+
+        self.assertEquals(check_ledger([self.policy.id]),
+                          [(self.policy.id, date(2015, 1, 1), 301, 300)])
+
+        rebuild_ledger([self.policy.id])
+        self.assertMatchesRecomputation()
+
+
+class TestIndexes(unittest.TestCase):
+
+    def query_plan(self, statement):
+        """
+         Return the EXPLAIN QUERY PLAN output for a query or select as one string.
+        """
+        statement = getattr(statement, 'statement', statement)
+        compiled = statement.compile(dialect=db.engine.dialect)
+        params = [compiled.params[name] for name in compiled.positiontup]
+
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('EXPLAIN QUERY PLAN ' + str(compiled), params)
+            return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+        finally:
+            connection.close()
+
+    def assertUsesIndex(self, statement, index_name):
+        plan = self.query_plan(statement)
+        self.assertTrue('INDEX %s ' % index_name in plan, plan)
+
+    def test_invoices_by_bill_date(self):
+        query = Invoice.query.filter_by(policy_id=1)\
+                             .filter(Invoice.deleted == False)\
+                             .filter(Invoice.bill_date <= date(2015, 5, 1))
+        self.assertUsesIndex(query, 'ix_invoices_policy_deleted_bill_date')
+
+    def test_invoices_by_cancel_date(self):
+        query = Invoice.query.filter_by(policy_id=1)\
+                             .filter(Invoice.deleted == False)\
+                             .filter(Invoice.cancel_date <= date(2015, 5, 1))\
+                             .order_by(Invoice.bill_date)
+        self.assertUsesIndex(query, 'ix_invoices_policy_deleted_cancel_date')
+
+    def test_payments_by_transaction_date(self):
+        query = Payment.query.filter_by(policy_id=1)\
+                             .filter(Payment.transaction_date <= date(2015, 5, 1))
+        self.assertUsesIndex(query, 'ix_payments_policy_transaction_date')
+
+    def test_pending_cancellation_entries(self):
+        statement = _pending_cancellation_entries(date(2015, 5, 1), [1, 2])
+        self.assertUsesIndex(statement, 'ix_invoices_policy_deleted_cancel_date')
+        self.assertUsesIndex(statement, 'ix_payments_policy_transaction_date')
+
+    def test_ledger_balance(self):
+        query = db.session.query(LedgerEntry.balance)\
+                          .filter(LedgerEntry.policy_id == 1)\
+                          .filter(LedgerEntry.entry_date <= date(2015, 5, 1))\
+                          .order_by(LedgerEntry.entry_date.desc(), LedgerEntry.id.desc())\
+                          .limit(1)
+        self.assertUsesIndex(query, 'ix_ledger_entries_policy_date')
+
+    def test_crossed_dates(self):
+        statement = _crossed_dates(date(2015, 5, 1), date(2015, 5, 2))
+        self.assertUsesIndex(statement, 'ix_invoices_due_date')
+        self.assertUsesIndex(statement, 'ix_invoices_cancel_date')
+
+    def test_migrate_db_adds_missing_index(self):
+        db.engine.execute('DROP INDEX ix_payments_policy_transaction_date')
+
+        self.assertEquals(migrate_db(), ['ix_payments_policy_transaction_date'])
+        self.assertEquals(migrate_db(), [])
+
+
+class TestOnboardPolicies(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.commit()
+
+    def setUp(self):
+        self.policies = []
+
+    def tearDown(self):
+        for policy in self.policies:
+            for invoice in policy.invoices:
+                db.session.delete(invoice)
+            db.session.delete(policy)
+        db.session.commit()
+
+    def spec(self, billing_schedule, effective_date=date(2015, 1, 31), annual_premium=1000):
+        return {'policy_number': 'Test Onboarded Policy',
+                'effective_date': effective_date,
+                'annual_premium': annual_premium,
+                'billing_schedule': billing_schedule,
+                'named_insured': self.test_insured.id,
+                'agent': self.test_agent.id}
+
+    def invoice_rows(self, policy):
+        return [(invoice.bill_date, invoice.due_date, invoice.cancel_date, invoice.amount_due, invoice.deleted)
+                for invoice in policy.invoices]
+
+    def test_matches_make_invoices(self):
+        specs = [self.spec(schedule) for schedule in ['Annual', 'Two-Pay', 'Quarterly', 'Monthly']]
+        policy_ids = onboard_policies(specs)
+        self.policies.extend(Policy.query.get(policy_id) for policy_id in policy_ids)
+
+        for spec, onboarded in zip(specs, self.policies):
+            policy = Policy(spec['policy_number'], spec['effective_date'], spec['annual_premium'])
+            policy.billing_schedule = spec['billing_schedule']
+            policy.named_insured = spec['named_insured']
+            policy.agent = spec['agent']
+            db.session.add(policy)
+            db.session.commit()
+            self.policies.append(policy)
+            PolicyAccounting(policy.id)
+
+            self.assertEquals(onboarded.status, 'Active')
+            self.assertEquals(self.invoice_rows(onboarded), self.invoice_rows(policy))
+            self.assertEquals(PolicyAccounting(onboarded.id).return_account_balance(date(2015, 12, 31)),
+                              PolicyAccounting(policy.id).return_account_balance(date(2015, 12, 31)))
+
+        self.assertEquals(check_ledger(policy_ids), [])
+        self.assertEquals(len(open_invoices(policy_ids[3])), 12)
+
+    def test_rejects_bad_specs(self):
+        policy_ids = onboard_policies([self.spec('Weekly'), self.spec('Annual')], batch_size=1)
+        self.policies.append(Policy.query.get(policy_ids[1]))
+
+        self.assertEquals(policy_ids[0], None)
+        self.assertEquals(len(self.policies[0].invoices), 1)
+
+    def test_rejects_incomplete_specs(self):
+        missing_date = self.spec('Annual', effective_date=None)
+        missing_premium = self.spec('Annual', annual_premium=None)
+        negative_premium = self.spec('Annual', annual_premium=-100)
+        missing_number = self.spec('Annual')
+        del missing_number['policy_number']
+
+        policy_ids = onboard_policies([missing_date, missing_premium, self.spec('Monthly'),
+                                       negative_premium, missing_number])
+        self.policies.append(Policy.query.get(policy_ids[2]))
+
+        self.assertEquals([policy_id is None for policy_id in policy_ids], [True, True, False, True, True])
+        self.assertEquals(self.policies[0].billing_schedule, 'Monthly')
+        self.assertEquals(len(self.policies[0].invoices), 12)
+
+
+class TestScheduleTemplates(unittest.TestCase):
+
+    def test_template_is_reused(self):
+        templates = ScheduleTemplates()
+        template = templates.get('Quarterly', date(2015, 1, 1))
+
+        self.assertTrue(templates.get('Quarterly', date(2015, 1, 1)) is template)
+        self.assertEquals((templates.hits, templates.misses), (1, 1))
+        self.assertEquals(template[1], (date(2015, 4, 1), date(2015, 5, 1), date(2015, 5, 15)))
+
+    def test_bad_billing_schedule(self):
+        self.assertEquals(ScheduleTemplates().get('Weekly', date(2015, 1, 1)), None)
+
+    def test_least_recently_used_is_evicted(self):
+        templates = ScheduleTemplates(max_size=2)
+        templates.get('Annual', date(2015, 1, 1))
+        templates.get('Monthly', date(2015, 1, 1))
+        templates.get('Annual', date(2015, 1, 1))
+        templates.get('Two-Pay', date(2015, 1, 1))
+
+        self.assertEquals(len(templates), 2)
+        templates.get('Annual', date(2015, 1, 1))
+        self.assertEquals(templates.misses, 3)
+        templates.get('Monthly', date(2015, 1, 1))
+        self.assertEquals(templates.misses, 4)
+
+    def test_split_premium(self):
+        self.assertEquals(split_premium(1200, 4), [300, 300, 300, 300])
+        self.assertEquals(split_premium(1000, 12), [87] + [83] * 11)
+        self.assertEquals(sum(split_premium(365, 2)), 365)
+
+
+class TestPolicyView(unittest.TestCase):
+    """
+     Each request ends by removing the db session, so fixtures are
+     looked up again by id instead of being kept on the class.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        test_agent = Contact('Test Agent', 'Agent')
+        test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(test_agent)
+        db.session.add(test_insured)
+        db.session.commit()
+
+        policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        policy.named_insured = test_insured.id
+        policy.agent = test_agent.id
+        db.session.add(policy)
+        db.session.commit()
+
+        cls.contact_ids = [test_agent.id, test_insured.id]
+        cls.policy_id = policy.id
+
+    @classmethod
+    def tearDownClass(cls):
+        for contact_id in cls.contact_ids:
+            db.session.delete(Contact.query.get(contact_id))
+        db.session.delete(Policy.query.get(cls.policy_id))
+        db.session.commit()
+
+    def setUp(self):
+        self.client = app.test_client()
+        policy_cache.backend.clear()
+
+    def tearDown(self):
+        policy = Policy.query.get(self.policy_id)
+        for invoice in policy.invoices:
+            db.session.delete(invoice)
+        for payment in policy.payments:
+            db.session.delete(payment)
+        db.session.commit()
+
+    def get_policy(self, policy_id, date_string):
+        with count_queries() as queries:
+            response = self.client.get('/policy/%s/%s' % (policy_id, date_string))
+        return response, queries
+
+    def make_payments(self, billing_schedule):
+        policy = Policy.query.get(self.policy_id)
+        policy.billing_schedule = billing_schedule
+        pa = PolicyAccounting(self.policy_id)
+        for invoice in policy.invoices:
+            pa.make_payment(contact_id=policy.agent,
+                            date_cursor=invoice.bill_date,
+                            amount=invoice.amount_due - 1)
+        return pa.return_account_balance(date(2015, 7, 1))
+
+    def test_policy_details(self):
+        balance = self.make_payments('Quarterly')
+
+        response, queries = self.get_policy(self.policy_id, '2015-07-01')
+        data = json.loads(response.data)
+
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(data['balance'], balance)
+        self.assertEquals(data['agent_name'], 'Test Agent')
+        self.assertEquals(data['insured'], 'Test Insured')
+        self.assertEquals(len(data['invoices']), 4)
+        self.assertEquals([payment['amount_paid'] for payment in data['payments']], [299] * 4)
+
+    def test_query_count_does_not_grow(self):
+        self.make_payments('Annual')
+        small, small_queries = self.get_policy(self.policy_id, '2015-07-01')
+        self.tearDown()
+
+        self.make_payments('Monthly')
+        large, large_queries = self.get_policy(self.policy_id, '2015-07-01')
+
+        self.assertEquals(small.status_code, 200)
+        self.assertEquals(large.status_code, 200)
+        self.assertTrue(len(large_queries) <= 3, large_queries.statements)
+        self.assertEquals(len(small_queries), len(large_queries))
+
+    def test_policy_not_found(self):
+        response, _ = self.get_policy(999999, '2015-07-01')
+        self.assertEquals(response.status_code, 404)
+
+    def test_invalid_date(self):
+        response, queries = self.get_policy(self.policy_id, '07-01-2015')
+        self.assertEquals(response.status_code, 404)
+        self.assertEquals(len(queries), 0)
+
+    def test_cached_response(self):
+        self.make_payments('Quarterly')
+        first, _ = self.get_policy(self.policy_id, '2015-07-01')
+        second, queries = self.get_policy(self.policy_id, '2015-07-01')
+
+        # Only the policy's version is read
+        self.assertEquals(len(queries), 1)
+        self.assertEquals(first.data, second.data)
+        self.assertEquals(first.headers['ETag'], second.headers['ETag'])
+        self.assertTrue(first.headers['Last-Modified'])
+
+    def test_conditional_get(self):
+        self.make_payments('Quarterly')
+        first, _ = self.get_policy(self.policy_id, '2015-07-01')
+
+        response = self.client.get('/policy/%s/2015-07-01' % self.policy_id,
+                                   headers={'If-None-Match': first.headers['ETag']})
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(response.data, '')
+
+    def test_payment_invalidates_cache(self):
+        self.make_payments('Annual')
+        first, _ = self.get_policy(self.policy_id, '2015-07-01')
+
+        policy = Policy.query.get(self.policy_id)
+        PolicyAccounting(self.policy_id).make_payment(contact_id=policy.agent,
+                                                      date_cursor=date(2015, 6, 1), amount=1)
+        second, queries = self.get_policy(self.policy_id, '2015-07-01')
+
+        self.assertTrue(len(queries) > 0)
+        self.assertEquals(json.loads(second.data)['balance'], json.loads(first.data)['balance'] - 1)
+        self.assertNotEquals(first.headers['ETag'], second.headers['ETag'])
+
+        response = self.client.get('/policy/%s/2015-07-01' % self.policy_id,
+                                   headers={'If-None-Match': first.headers['ETag']})
+        self.assertEquals(response.status_code, 200)
+
+
+class TestPolicyResponseCache(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policies = [Policy('Test Cache Policy %d' % i, date(2015, 1, 1), 1200) for i in range(2)]
+        for policy in cls.policies:
+            policy.named_insured = cls.test_insured.id
+            policy.agent = cls.test_agent.id
+            db.session.add(policy)
+        db.session.commit()
+        cls.policy_id, cls.other_policy_id = [policy.id for policy in cls.policies]
+
+    @classmethod
+    def tearDownClass(cls):
+        for policy in cls.policies:
+            db.session.delete(policy)
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.commit()
+
+    def tearDown(self):
+        # Drop the uncommitted versions and the committed ones
+        db.session.rollback()
+        db.session.execute(PolicyVersion.__table__.delete()
+                           .where(PolicyVersion.policy_id.in_([self.policy_id, self.other_policy_id])))
+        db.session.commit()
+
+    def test_invalidate(self):
+        cache = PolicyResponseCache()
+        key, cached = cache.lookup(self.policy_id, '2015-01-01')
+        self.assertEquals(cached, None)
+        cache.store(key, '{}')
+
+        self.assertEquals(cache.lookup(self.policy_id, '2015-01-01')[1].body, '{}')
+        invalidate_policies([self.other_policy_id])
+        self.assertEquals(cache.lookup(self.policy_id, '2015-01-01')[1].body, '{}')
+        invalidate_policies([self.policy_id])
+        self.assertEquals(cache.lookup(self.policy_id, '2015-01-01')[1], None)
+
+    def test_stale_store_is_never_served(self):
+        cache = PolicyResponseCache()
+        key, _ = cache.lookup(self.policy_id, '2015-01-01')
+        invalidate_policies([self.policy_id])
+        cache.store(key, '{}')
+
+        self.assertEquals(cache.lookup(self.policy_id, '2015-01-01')[1], None)
+
+    def test_write_from_another_process(self):
+        cache = PolicyResponseCache()
+        key, _ = cache.lookup(self.policy_id, '2015-01-01')
+        cache.store(key, '{}')
+
+        # A write committed on a connection of its own, like the importer's
+        connection = sqlite3.connect(db.engine.url.database)
+        try:
+            connection.execute("INSERT OR REPLACE INTO policy_versions VALUES (?, ?, '2015-01-01 00:00:00')",
+                               (self.policy_id, uuid.uuid4().hex))
+            connection.commit()
+        finally:
+            connection.close()
+
+        self.assertEquals(cache.lookup(self.policy_id, '2015-01-01')[1], None)
+
+    def test_memory_backend_is_bounded(self):
+        backend = MemoryBackend(max_size=2)
+        backend.set('a', 1)
+        backend.set('b', 2)
+        backend.get('a')
+        backend.set('c', 3)
+
+        self.assertEquals(len(backend), 2)
+        self.assertEquals(backend.get('b'), None)
+        self.assertEquals(backend.get('a'), 1)
+
+
+class TestImportPayments(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        cls.policy.billing_schedule = "Quarterly"
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        db.session.add(cls.policy)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.delete(cls.policy)
+        db.session.commit()
+
+    def setUp(self):
+        self.pa = PolicyAccounting(self.policy.id)
+
+    def tearDown(self):
+        for invoice in self.policy.invoices:
+            db.session.delete(invoice)
+        for payment in Payment.query.filter_by(policy_id=self.policy.id):
+            db.session.delete(payment)
+        db.session.commit()
+
+    def lockbox(self, *rows):
+        lines = ['policy_id,contact_id,amount,transaction_date']
+        lines.extend(','.join(str(value) for value in row) for row in rows)
+        return StringIO('\n'.join(lines) + '\n')
+
+    def test_import(self):
+        payment_file = self.lockbox((self.policy.id, '', 300, '2015-01-15'),
+                                    (self.policy.id, self.test_agent.id, 300, '2015-04-15'),
+                                    (self.policy.id, '', 300, '2015-07-15'))
+        reject_file = StringIO()
+
+        self.assertEquals(import_payments(payment_file, reject_file, chunk_size=2), (3, 0))
+        payments = Payment.query.filter_by(policy_id=self.policy.id).order_by(Payment.id).all()
+        self.assertEquals([payment.contact_id for payment in payments],
+                          [self.test_insured.id, self.test_agent.id, self.test_insured.id])
+        self.assertEquals(self.pa.return_account_balance(date(2015, 7, 15)), 0)
+        self.assertEquals(check_ledger([self.policy.id]), [])
+        self.assertEquals(open_invoices(self.policy.id)[0].bill_date, date(2015, 10, 1))
+        self.assertEquals(reject_file.getvalue().splitlines(),
+                          ['policy_id,contact_id,amount,transaction_date,error'])
+
+    def test_rejects(self):
+        payment_file = self.lockbox((self.policy.id, '', 'ten', '2015-01-15'),
+                                    (self.policy.id, '', 300, '01/15/2015'),
+                                    (999999, '', 300, '2015-01-15'),
+                                    (self.policy.id, 999999, 300, '2015-01-15'),
+                                    (self.policy.id, '', 300, '2015-02-05'),
+                                    (self.policy.id, self.test_agent.id, 300, '2015-02-05'))
+        reject_file = StringIO()
+
+        self.assertEquals(import_payments(payment_file, reject_file), (1, 5))
+        reject_file.seek(0)
+        errors = [row['error'] for row in csv.DictReader(reject_file)]
+        self.assertEquals(errors, ['Invalid amount',
+                                   'Invalid transaction_date',
+                                   'Policy not found',
+                                   'Contact not found',
+                                   'Due to the current status of this policy, an agent is needed to make payment'])
+
+
+class TestPolicyBalancesView(unittest.TestCase):
+    """
+     Each request ends by removing the db session, so fixtures are
+     looked up again by id instead of being kept on the class.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        test_agent = Contact('Test Agent', 'Agent')
+        test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(test_agent)
+        db.session.add(test_insured)
+        db.session.commit()
+
+        cls.contact_ids = [test_agent.id, test_insured.id]
+        cls.agent_id = test_agent.id
+        cls.policy_ids = []
+        for billing_schedule in ['Annual', 'Quarterly']:
+            policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+            policy.billing_schedule = billing_schedule
+            policy.named_insured = test_insured.id
+            policy.agent = test_agent.id
+            db.session.add(policy)
+            db.session.commit()
+            PolicyAccounting(policy.id)
+            cls.policy_ids.append(policy.id)
+
+    @classmethod
+    def tearDownClass(cls):
+        for policy_id in cls.policy_ids:
+            policy = Policy.query.get(policy_id)
+            for invoice in policy.invoices:
+                db.session.delete(invoice)
+            db.session.delete(policy)
+        for contact_id in cls.contact_ids:
+            db.session.delete(Contact.query.get(contact_id))
+        db.session.commit()
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def post(self, data):
+        return self.client.post('/policies/balances', data=json.dumps(data),
+                                content_type='application/json')
+
+    def test_policy_ids(self):
+        response = self.post({'date': '2015-02-05', 'policy_ids': self.policy_ids + [999999, 'x']})
+        data = json.loads(response.data)
+
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(data['policies'],
+                          [{'id': self.policy_ids[0], 'balance': 1200, 'status': 'Active',
+                            'pending_cancellation': True},
+                           {'id': self.policy_ids[1], 'balance': 300, 'status': 'Active',
+                            'pending_cancellation': True}])
+        self.assertEquals(data['errors'], [{'id': 'x', 'error': 'Invalid policy id'},
+                                           {'id': 999999, 'error': 'Policy not found'}])
+
+    def test_agent_id(self):
+        with count_queries() as queries:
+            response = self.post({'date': '2015-04-01', 'agent_id': self.agent_id})
+        data = json.loads(response.data)
+
+        self.assertEquals([policy['id'] for policy in data['policies']], self.policy_ids)
+        self.assertEquals([policy['balance'] for policy in data['policies']], [1200, 600])
+        self.assertTrue(len(queries) <= 4, queries.statements)
+
+    def test_request_size_limit(self):
+        limit = app.config['BATCH_POLICY_LIMIT']
+        response = self.post({'date': '2015-04-01', 'policy_ids': range(1, limit + 2)})
+        self.assertEquals(response.status_code, 413)
+
+    def test_bad_requests(self):
+        self.assertEquals(self.post({'policy_ids': self.policy_ids}).status_code, 400)
+        self.assertEquals(self.post({'date': '2015-04-01'}).status_code, 400)
+        self.assertEquals(self.post([1, 2]).status_code, 400)
+        self.assertEquals(self.post({'date': '2015-04-01', 'agent_id': [1]}).status_code, 400)
+        self.assertEquals(self.post({'date': '2015-04-01', 'agent_id': {'id': 1}}).status_code, 400)
+        self.assertEquals(self.post({'date': '2015-04-01', 'agent_id': '1'}).status_code, 400)
+
+    def test_ids_out_of_range(self):
+        response = self.post({'date': '2015-04-01', 'policy_ids': [2 ** 63, -2 ** 63 - 1, self.policy_ids[0]]})
+        data = json.loads(response.data)
+
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals([policy['id'] for policy in data['policies']], [self.policy_ids[0]])
+        self.assertEquals(data['errors'], [{'id': 2 ** 63, 'error': 'Invalid policy id'},
+                                           {'id': -2 ** 63 - 1, 'error': 'Invalid policy id'}])
+        self.assertEquals(self.post({'date': '2015-04-01', 'agent_id': 2 ** 64}).status_code, 400)
+
+
+class TestSearchPoliciesView(unittest.TestCase):
+    """
+     Each request ends by removing the db session, so fixtures are
+     looked up again by id instead of being kept on the class.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        test_agent = Contact('Test Agent', 'Agent')
+        test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(test_agent)
+        db.session.add(test_insured)
+        db.session.commit()
+
+        cls.contact_ids = [test_agent.id, test_insured.id]
+        cls.agent_id = test_agent.id
+        cls.policy_ids = []
+        for policy_number, billing_schedule in [('Search 100%', 'Annual'),
+                                                ('Search 1001', 'Quarterly'),
+                                                ('Search 2001', 'Monthly')]:
+            policy = Policy(policy_number, date(2015, 1, 1), 1200)
+            policy.billing_schedule = billing_schedule
+            policy.named_insured = test_insured.id
+            policy.agent = test_agent.id
+            db.session.add(policy)
+            db.session.commit()
+            PolicyAccounting(policy.id)
+            cls.policy_ids.append(policy.id)
+
+    @classmethod
+    def tearDownClass(cls):
+        for policy_id in cls.policy_ids:
+            policy = Policy.query.get(policy_id)
+            for invoice in policy.invoices:
+                db.session.delete(invoice)
+            db.session.delete(policy)
+        for contact_id in cls.contact_ids:
+            db.session.delete(Contact.query.get(contact_id))
+        db.session.commit()
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def search(self, query):
+        response = self.client.get('/policies?' + query)
+        return response.status_code, json.loads(response.data) if response.status_code == 200 else None
+
+    def test_prefix_and_summary(self):
+        status, data = self.search('policy_number=Search')
+
+        self.assertEquals(status, 200)
+        self.assertEquals([policy['id'] for policy in data['policies']], self.policy_ids)
+        self.assertEquals([policy['invoice_count'] for policy in data['policies']], [1, 4, 12])
+        self.assertEquals([policy['invoice_total'] for policy in data['policies']], [1200] * 3)
+        self.assertEquals(data['next'], None)
+        self.assertFalse('invoices' in data['policies'][0])
+
+    def test_prefix_is_literal(self):
+        status, data = self.search('policy_number=Search%20100%25')
+        self.assertEquals([policy['id'] for policy in data['policies']], self.policy_ids[:1])
+
+    def test_filters(self):
+        status, data = self.search('agent=%d&billing_schedule=Monthly&status=Active&invoices=none' % self.agent_id)
+
+        self.assertEquals([policy['id'] for policy in data['policies']], self.policy_ids[2:])
+        self.assertFalse('invoice_count' in data['policies'][0])
+
+    def test_keyset_pagination(self):
+        found = []
+        after = 0
+        while after is not None:
+            status, data = self.search('agent=%d&limit=2&after=%d' % (self.agent_id, after))
+            found.extend(policy['id'] for policy in data['policies'])
+            after = data['next']
+
+        self.assertEquals(found, self.policy_ids)
+
+    def test_bad_arguments(self):
+        self.assertEquals(self.search('limit=ten')[0], 400)
+        self.assertEquals(self.search('agent=bob')[0], 400)
+        self.assertEquals(self.search('invoices=all')[0], 400)
+
+    def test_ids_out_of_range(self):
+        self.assertEquals(self.search('after=%d' % 2 ** 63)[0], 400)
+        self.assertEquals(self.search('agent=%d' % 2 ** 64)[0], 400)
+        self.assertEquals(self.search('named_insured=%d' % (-2 ** 63 - 1))[0], 400)
+
+
+class TestMetrics(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Test Metrics', date(2015, 1, 1), 1200)
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        db.session.add(cls.policy)
+        db.session.commit()
+        PolicyAccounting(cls.policy.id)
+        cls.policy_id = cls.policy.id
+        cls.contact_ids = [cls.test_agent.id, cls.test_insured.id]
+
+    @classmethod
+    def tearDownClass(cls):
+        policy = Policy.query.get(cls.policy_id)
+        for invoice in policy.invoices:
+            db.session.delete(invoice)
+        db.session.delete(policy)
+        for contact_id in cls.contact_ids:
+            db.session.delete(Contact.query.get(contact_id))
+        db.session.commit()
+
+    def setUp(self):
+        metrics.reset()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['METRICS_DEBUG_HEADER'] = False
+
+    def test_method_scope(self):
+        with count_queries() as queries:
+            PolicyAccounting(self.policy_id).return_account_balance(date(2015, 2, 1))
+
+        init = metrics.totals[('method', 'PolicyAccounting.__init__')]
+        balance = metrics.totals[('method', 'PolicyAccounting.return_account_balance')]
+        self.assertEquals(init['calls'], 1)
+        self.assertEquals(balance['calls'], 1)
+        self.assertEquals(init['statements'] + balance['statements'], len(queries))
+        self.assertTrue(balance['wall_seconds'] >= balance['db_seconds'] > 0)
+
+    def test_nested_scopes_both_count(self):
+        sample = Metrics()
+        outer = sample.start('route', 'outer')
+        inner = sample.start('method', 'inner')
+        sample.record_statement('SELECT 1', 0.01)
+        sample.finish(inner)
+        sample.record_statement('SELECT 2', 0.01)
+        sample.finish(outer)
+
+        self.assertEquals(sample.totals[('route', 'outer')]['statements'], 2)
+        self.assertEquals(sample.totals[('method', 'inner')]['statements'], 1)
+
+    def test_slow_query_samples(self):
+        sample = Metrics(slow_query_seconds=0.5, slow_query_samples=2)
+        scope = sample.start('route', 'view')
+        sample.record_statement('SELECT "a"\n  FROM b', 1.0)
+        sample.record_statement('SELECT fast', 0.1)
+        sample.record_statement('SELECT c', 2.0)
+        sample.record_statement('SELECT d', 3.0)
+        sample.finish(scope)
+
+        self.assertEquals([statement for _, _, statement, _ in sample.slow_queries], ['SELECT c', 'SELECT d'])
+        sample.slow_queries.clear()
+        sample.record_statement('SELECT "a"\n  FROM b', 1.0)
+        self.assertTrue('statement="SELECT \\"a\\" FROM b"} 1.0' in sample.render())
+
+    def test_route_scope_and_endpoint(self):
+        response = self.client.get('/policy/%d/2015-02-01' % self.policy_id)
+        self.assertEquals(response.status_code, 200)
+        self.assertFalse('X-Query-Count' in response.headers)
+
+        route = metrics.totals[('route', 'getPolicyByIdAndDate')]
+        self.assertEquals(route['calls'], 1)
+        self.assertTrue(route['statements'] > 0)
+
+        text = self.client.get('/metrics').data
+        self.assertTrue('# TYPE accounting_sql_statements_total counter' in text)
+        self.assertTrue('accounting_sql_statements_total{kind="route",name="getPolicyByIdAndDate"} %d'
+                        % route['statements'] in text)
+
+    def test_debug_header(self):
+        app.config['METRICS_DEBUG_HEADER'] = True
+        with count_queries() as queries:
+            response = self.client.get('/policy/%d/2015-03-01' % self.policy_id)
+
+        self.assertEquals(response.headers['X-Query-Count'], str(len(queries)))
+
+
+class TestQueryBudgets(unittest.TestCase):
+    """
+     Each operation runs against a small policy and a large one with
+     many more invoices and payments, and must issue the same number
+     of SQL statements for both, within its budget. Attributes are
+     expired first, as they are after a commit.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        test_agent = Contact('Test Agent', 'Agent')
+        test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(test_agent)
+        db.session.add(test_insured)
+        db.session.commit()
+        cls.agent_id = test_agent.id
+        cls.insured_id = test_insured.id
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(Contact.query.get(cls.agent_id))
+        db.session.delete(Contact.query.get(cls.insured_id))
+        db.session.commit()
+
+    def setUp(self):
+        self.client = app.test_client()
+        policy_cache.backend.clear()
+        self.small_id = self.create_policy('Budget Small', 'Annual', [], 1)
+        self.large_id = self.create_policy('Budget Large', 'Quarterly', ['Monthly', 'Two-Pay', 'Monthly'], 24)
+
+    def tearDown(self):
+        for policy_id in (self.small_id, self.large_id):
+            policy = Policy.query.get(policy_id)
+            for invoice in policy.invoices:
+                db.session.delete(invoice)
+            for payment in policy.payments:
+                db.session.delete(payment)
+            db.session.delete(policy)
+        db.session.commit()
+
+    def create_policy(self, policy_number, billing_schedule, schedule_changes, num_payments):
+        policy = Policy(policy_number, date(2015, 1, 1), 1200)
+        policy.billing_schedule = billing_schedule
+        policy.named_insured = self.insured_id
+        policy.agent = self.agent_id
+        db.session.add(policy)
+        db.session.commit()
+        policy_id = policy.id
+
+        pa = PolicyAccounting(policy_id)
+        for new_schedule in schedule_changes:
+            pa.change_billing_schedule(new_schedule)
+        for day in range(num_payments):
+            pa.make_payment(contact_id=self.agent_id, date_cursor=date(2015, 1, 1 + day), amount=10)
+        return policy_id
+
+    def assertQueryBudget(self, budget, operation):
+        counts = []
+        for policy_id in (self.small_id, self.large_id):
+            pa = PolicyAccounting(policy_id)
+            db.session.expire_all()
+            with count_queries() as queries:
+                operation(pa, policy_id)
+            counts.append(len(queries))
+
+        self.assertEquals(counts[0], counts[1], 'statements grew with data size: %s' % counts)
+        self.assertTrue(counts[0] <= budget, '%d statements, budget is %d' % (counts[0], budget))
+
+    def test_init(self):
+        self.assertQueryBudget(2, lambda pa, policy_id: PolicyAccounting(policy_id))
+
+    def test_return_account_balance(self):
+        self.assertQueryBudget(2, lambda pa, policy_id: pa.return_account_balance(date(2015, 6, 1)))
+
+    def test_make_payment(self):
+        self.assertQueryBudget(12, lambda pa, policy_id: pa.make_payment(contact_id=self.agent_id,
+                                                                         date_cursor=date(2015, 3, 1),
+                                                                         amount=5))
+
+    def test_evaluate_cancellation_pending_due_to_non_pay(self):
+        self.assertQueryBudget(2, lambda pa, policy_id:
+                               pa.evaluate_cancellation_pending_due_to_non_pay(date(2015, 6, 1)))
+
+    def test_evaluate_cancel(self):
+        self.assertQueryBudget(2, lambda pa, policy_id: pa.evaluate_cancel(date(2015, 12, 31)))
+
+    def test_change_billing_schedule(self):
+        self.assertQueryBudget(16, lambda pa, policy_id: pa.change_billing_schedule('Quarterly'))
+
+    def test_cancel_policy(self):
+        self.assertQueryBudget(9, lambda pa, policy_id: pa.cancel_policy('Canceled', 'Underwriting'))
+
+    def test_policy_view(self):
+        def view(pa, policy_id):
+            response = self.client.get('/policy/%d/2015-06-01' % policy_id)
+            self.assertEquals(response.status_code, 200)
+        self.assertQueryBudget(3, view)
+
+
+class TestPolicyAccountingForPolicy(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Test For Policy', date(2015, 1, 1), 1200)
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.billing_schedule = 'Quarterly'
+        db.session.add(cls.policy)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.policy)
+        db.session.commit()
+
+    def tearDown(self):
+        for invoice in self.policy.invoices:
+            db.session.delete(invoice)
+        db.session.commit()
+
+    def test_for_policy_does_not_query_or_write(self):
+        policy = Policy.query.get(self.policy.id)
+        with count_queries() as queries:
+            pa = PolicyAccounting.for_policy(policy)
+
+        self.assertEquals(len(queries), 0)
+        self.assertTrue(pa.policy is policy)
+        self.assertEquals(Invoice.query.filter_by(policy_id=self.policy.id).count(), 0)
+        self.assertEquals(pa.return_account_balance(date(2015, 12, 31)), 0)
+
+    def test_ensure_invoices(self):
+        pa = PolicyAccounting.for_policy(Policy.query.get(self.policy.id))
+        pa.ensure_invoices()
+        self.assertEquals(len(self.policy.invoices), 4)
+
+        # A second call finds the invoices and leaves them alone
+        with count_queries() as queries:
+            pa.ensure_invoices()
+        self.assertEquals(len(queries), 1)
+        self.assertEquals(pa.return_account_balance(date(2015, 4, 1)), 600)
+
+
+class TestNightly(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.unpaid_policy = Policy('Test Nightly Unpaid', date(2015, 1, 1), 1200)
+        cls.paid_policy = Policy('Test Nightly Paid', date(2015, 1, 1), 1200)
+        cls.unpaid_policy.billing_schedule = "Quarterly"
+        for policy in [cls.unpaid_policy, cls.paid_policy]:
+            policy.named_insured = cls.test_insured.id
+            policy.agent = cls.test_agent.id
+            db.session.add(policy)
+        db.session.commit()
+
+        PolicyAccounting(cls.unpaid_policy.id)
+        cls.payment = PolicyAccounting(cls.paid_policy.id).make_payment(contact_id=cls.test_agent.id,
+                                                                       date_cursor=date(2015, 1, 15),
+                                                                       amount=1200)
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.payment)
+        for policy in [cls.unpaid_policy, cls.paid_policy]:
+            for invoice in policy.invoices:
+                db.session.delete(invoice)
+            db.session.delete(policy)
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.commit()
+
+    def setUp(self):
+        self.state_file = 'test_nightly_state.json'
+
+    def tearDown(self):
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+
+    def active_policy_ids(self):
+        return [policy_id for policy_id, in db.session.query(Policy.id).filter(Policy.status == 'Active')]
+
+    def test_parallel_matches_serial(self):
+        for date_cursor in [date(2015, 2, 15), date(2015, 6, 1), date(2016, 2, 1)]:
+            serial = run_nightly(date_cursor, workers=1, shard_size=3, expire_after_months=12)
+            parallel = run_nightly(date_cursor, workers=2, shard_size=3, expire_after_months=12)
+            self.assertEquals(parallel, serial)
+
+            pending = policies_pending_cancellation(date_cursor, self.active_policy_ids())
+            self.assertEquals(serial['pending'], sorted(policy_id for policy_id, flag in pending.items() if flag))
+            self.assertEquals(serial['cancel'], policies_to_cancel(date_cursor, self.active_policy_ids()))
+
+        self.assertTrue(self.unpaid_policy.id in serial['cancel'])
+        self.assertTrue(self.paid_policy.id in serial['expire'])
+
+    def test_expiry_is_off_by_default(self):
+        self.assertEquals(app.config['NIGHTLY_EXPIRE_AFTER_MONTHS'], None)
+        self.assertEquals(run_nightly(date(2016, 2, 1), workers=1)['expire'], [])
+
+    def test_resume(self):
+        calls = []
+
+        def interrupt(done, total):
+            calls.append(done)
+            if done == 1:
+                raise KeyboardInterrupt()
+
+        self.assertRaises(KeyboardInterrupt, run_nightly, date(2015, 6, 1), 1, 2,
+                          state_file=self.state_file, progress=interrupt)
+
+        # The finished shard is not evaluated again
+        del calls[:]
+        resumed = run_nightly(date(2015, 6, 1), 1, 2, state_file=self.state_file,
+                              progress=lambda done, total: calls.append((done, total)))
+
+        self.assertEquals(calls[0][0], 2)
+        self.assertEquals(len(calls), calls[0][1] - 1)
+        self.assertEquals(resumed, run_nightly(date(2015, 6, 1), 1, 2))
+
+    def restore_policies(self):
+        for policy in [self.unpaid_policy, self.paid_policy]:
+            policy.status = 'Active'
+            policy.status_code = None
+            policy.cancel_date = None
+            for invoice in policy.invoices:
+                invoice.deleted = False
+        db.session.commit()
+        rebuild_ledger([self.unpaid_policy.id, self.paid_policy.id])
+
+    def test_write(self):
+        _write({'pending': [], 'cancel': [self.unpaid_policy.id], 'expire': [self.paid_policy.id]})
+        try:
+            self.assertEquals(self.unpaid_policy.status, 'Canceled')
+            self.assertEquals(self.unpaid_policy.status_code, 'Non-Payment')
+            for invoice in self.unpaid_policy.invoices:
+                self.assertTrue(invoice.deleted)
+            self.assertEquals(PolicyAccounting(self.unpaid_policy.id).return_account_balance(date(2015, 6, 1)), 0)
+
+            # Expired like cancel_policy('Expired', ...)
+            self.assertEquals(self.paid_policy.status, 'Expired')
+            self.assertEquals(self.paid_policy.status_code, app.config['NIGHTLY_EXPIRE_STATUS_CODE'])
+            self.assertEquals(self.paid_policy.cancel_date, datetime.now().date())
+            for invoice in self.paid_policy.invoices:
+                self.assertTrue(invoice.deleted)
+            self.assertTrue(set([self.unpaid_policy.id, self.paid_policy.id]) <= set(dirty_policies()))
+        finally:
+            self.restore_policies()
+
+    def test_resume_writes_saved_results(self):
+        # As if the run stopped after saving its only shard but before committing it
+        (start, _), = _shards(10 ** 9)
+        result = {'pending': [], 'cancel': [self.unpaid_policy.id], 'expire': []}
+        with open(self.state_file, 'w') as state_file:
+            json.dump({'date': '2015-06-01', 'shard_size': 10 ** 9, 'apply': True, 'expire_after_months': None,
+                       'shards': {str(start): result}, 'unwritten': [str(start)]}, state_file)
+
+        try:
+            totals = run_nightly(date(2015, 6, 1), 1, 10 ** 9, apply=True, state_file=self.state_file)
+
+            self.assertEquals(totals['cancel'], [self.unpaid_policy.id])
+            self.assertEquals(Policy.query.get(self.unpaid_policy.id).status, 'Canceled')
+            with open(self.state_file) as state_file:
+                self.assertEquals(json.load(state_file)['unwritten'], [])
+        finally:
+            self.restore_policies()
+
+
+class TestDirtyPolicies(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.commit()
+
+    def setUp(self):
+        self.payments = []
+        self.policies = []
+        for policy_number in ['Test Dirty', 'Test Quiet']:
+            policy = Policy(policy_number, date(2015, 1, 1), 1200)
+            policy.billing_schedule = 'Quarterly'
+            policy.named_insured = self.test_insured.id
+            policy.agent = self.test_agent.id
+            db.session.add(policy)
+            db.session.commit()
+            PolicyAccounting(policy.id)
+            self.policies.append(policy)
+        self.dirty_policy, self.quiet_policy = self.policies
+        self.policy_ids = [policy.id for policy in self.policies]
+        self.other_marks = {}
+
+        # Start these policies from a clean slate, as after a sweep
+        db.session.execute(DirtyPolicy.__table__.delete().where(DirtyPolicy.policy_id.in_(self.policy_ids)))
+        db.session.commit()
+
+    def tearDown(self):
+        for payment in self.payments:
+            db.session.delete(payment)
+        for policy in self.policies:
+            for invoice in policy.invoices:
+                db.session.delete(invoice)
+            db.session.delete(policy)
+        db.session.execute(DirtyPolicy.__table__.delete().where(DirtyPolicy.policy_id.in_(self.policy_ids)))
+        if self.other_marks:
+            db.session.execute(DirtyPolicy.__table__.insert().prefix_with('OR REPLACE'),
+                               [{'policy_id': policy_id, 'marked_at': marked_at}
+                                for policy_id, marked_at in self.other_marks.items()])
+        db.session.commit()
+
+    def set_aside_other_marks(self):
+        # Keep a sweep off the other policies in the db; tearDown puts their marks back
+        self.other_marks = dict((policy_id, marked_at) for policy_id, marked_at in dirty_policies().items()
+                                if policy_id not in self.policy_ids)
+        clear_dirty(self.other_marks)
+        db.session.commit()
+
+    def test_writes_mark_policy(self):
+        pa = PolicyAccounting(self.dirty_policy.id)
+        self.payments.append(pa.make_payment(contact_id=self.test_agent.id,
+                                             date_cursor=date(2015, 1, 15), amount=300))
+        self.assertTrue(self.dirty_policy.id in dirty_policies())
+        self.assertFalse(self.quiet_policy.id in dirty_policies())
+
+        first_mark = dirty_policies()[self.dirty_policy.id]
+        pa.change_billing_schedule('Monthly')
+        self.assertTrue(dirty_policies()[self.dirty_policy.id] >= first_mark)
+
+        PolicyAccounting(self.quiet_policy.id).cancel_policy('Canceled', 'Underwriting')
+        self.assertTrue(self.quiet_policy.id in dirty_policies())
+
+    def test_crossed_date_policies(self):
+        # Quarterly invoices are due on 2015-05-01 and cancel on 2015-05-15
+        self.assertTrue(self.quiet_policy.id in crossed_date_policies(date(2015, 5, 1), date(2015, 5, 1)))
+        self.assertTrue(self.quiet_policy.id in crossed_date_policies(date(2015, 5, 10), date(2015, 5, 20)))
+        self.assertFalse(self.quiet_policy.id in crossed_date_policies(date(2015, 5, 2), date(2015, 5, 14)))
+
+    def test_sweep_since(self):
+        # Both policies are unpaid past their first cancel date, but
+        # between the sweeps only the dirty one changed. No policy in
+        # the db has a due or cancel date from 2015-03-16 to 2015-03-20.
+        self.payments.append(PolicyAccounting(self.dirty_policy.id).make_payment(
+            contact_id=self.test_agent.id, date_cursor=date(2015, 3, 20), amount=100))
+
+        found = cancellation_sweep(date(2015, 3, 20), since=date(2015, 3, 16))
+        self.assertTrue(self.dirty_policy.id in found)
+        self.assertFalse(self.quiet_policy.id in found)
+        self.assertEquals(sorted(cancellation_sweep(date(2015, 3, 20), self.policy_ids)), self.policy_ids)
+
+        # Applying clears the marks that were evaluated
+        self.set_aside_other_marks()
+        cancellation_sweep(date(2015, 3, 20), apply=True, since=date(2015, 3, 16))
+        self.assertEquals(self.dirty_policy.status, 'Canceled')
+        self.assertEquals(self.quiet_policy.status, 'Active')
+        self.assertFalse(self.dirty_policy.id in dirty_policies())
+
+
+class TestSqliteProfile(unittest.TestCase):
+
+    def test_pragmas_applied(self):
+        pragmas = dict(app.config['SQLITE_PRAGMAS'])
+        self.assertEquals(db.engine.execute('PRAGMA journal_mode').scalar(), pragmas['journal_mode'].lower())
+        self.assertEquals(db.engine.execute('PRAGMA busy_timeout').scalar(), pragmas['busy_timeout'])
+        self.assertEquals(db.engine.execute('PRAGMA mmap_size').scalar(), pragmas['mmap_size'])
+
+
+class TestGroupCommitWriter(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        test_agent = Contact('Test Agent', 'Agent')
+        test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(test_agent)
+        db.session.add(test_insured)
+        db.session.commit()
+
+        policy = Policy('Test Group Commit', date(2015, 1, 1), 1200)
+        policy.named_insured = test_insured.id
+        policy.agent = test_agent.id
+        db.session.add(policy)
+        db.session.commit()
+        PolicyAccounting(policy.id)
+
+        cls.agent_id = test_agent.id
+        cls.contact_ids = [test_agent.id, test_insured.id]
+        cls.policy_id = policy.id
+
+    @classmethod
+    def tearDownClass(cls):
+        policy = Policy.query.get(cls.policy_id)
+        for invoice in policy.invoices:
+            db.session.delete(invoice)
+        db.session.delete(policy)
+        for contact_id in cls.contact_ids:
+            db.session.delete(Contact.query.get(contact_id))
+        db.session.commit()
+
+    def setUp(self):
+        self.writer = GroupCommitWriter(max_batch=10, max_latency=0.5).start()
+
+    def tearDown(self):
+        self.writer.stop()
+        for payment in Payment.query.filter_by(policy_id=self.policy_id):
+            db.session.delete(payment)
+        db.session.commit()
+        rebuild_allocations([self.policy_id])
+        rebuild_ledger([self.policy_id])
+
+    def make_payment(self, amount):
+        return PolicyAccounting(self.policy_id).make_payment(self.agent_id, date(2015, 1, 15), amount).id
+
+    def fail(self):
+        raise ValueError('Bad write')
+
+    def submit_blocked(self, writer, num_payments):
+        """
+         Submit payments while the writer is held up by a first write,
+         so they are all waiting when it finishes.
+        """
+        release = threading.Event()
+        pending = [writer.submit(release.wait, 10)]
+        pending.extend(writer.submit(self.make_payment, 100) for _ in range(num_payments))
+        release.set()
+        return [write.result(timeout=10) for write in pending][1:]
+
+    def test_one_transaction_per_batch(self):
+        key, _ = policy_cache.lookup(self.policy_id, 'test')
+
+        payment_ids = self.submit_blocked(self.writer, 5)
+
+        self.assertEquals(self.writer.batches, 1)
+        self.assertEquals(sorted(payment_ids),
+                          [payment.id for payment in Payment.query.filter_by(policy_id=self.policy_id)])
+        self.assertEquals(PolicyAccounting(self.policy_id).return_account_balance(date(2015, 1, 15)), 700)
+        self.assertNotEquals(policy_cache.lookup(self.policy_id, 'test')[0], key)
+
+    def test_max_batch(self):
+        writer = GroupCommitWriter(max_batch=2, max_latency=60).start()
+        try:
+            self.submit_blocked(writer, 4)
+            self.assertEquals(writer.batches, 3)
+        finally:
+            writer.stop()
+
+    def test_failed_write_does_not_fail_batch(self):
+        pending = [self.writer.submit(self.make_payment, 100),
+                   self.writer.submit(self.fail),
+                   self.writer.submit(self.make_payment, 200)]
+
+        self.assertTrue(pending[0].result(timeout=10))
+        self.assertRaises(ValueError, pending[1].result, 10)
+        self.assertTrue(pending[2].result(timeout=10))
+        self.assertEquals(Payment.query.filter_by(policy_id=self.policy_id).count(), 2)
+        self.assertEquals(check_ledger([self.policy_id]), [])
+
+
+class TestAgingReport(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        test_agent = Contact('Test Aging Agent', 'Agent')
+        test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(test_agent)
+        db.session.add(test_insured)
+        db.session.commit()
+
+        cls.policy_ids = []
+        for policy_number, billing_schedule in [('Test Aging Quarterly', 'Quarterly'),
+                                                ('Test Aging Monthly', 'Monthly')]:
+            policy = Policy(policy_number, date(2015, 1, 1), 1200)
+            policy.billing_schedule = billing_schedule
+            policy.named_insured = test_insured.id
+            policy.agent = test_agent.id
+            db.session.add(policy)
+            db.session.commit()
+            PolicyAccounting(policy.id)
+            cls.policy_ids.append(policy.id)
+
+        PolicyAccounting(cls.policy_ids[0]).make_payment(test_agent.id, date(2015, 1, 15), 400)
+        cls.agent_id = test_agent.id
+        cls.contact_ids = [test_agent.id, test_insured.id]
+
+    @classmethod
+    def tearDownClass(cls):
+        for policy_id in cls.policy_ids:
+            policy = Policy.query.get(policy_id)
+            for invoice in policy.invoices:
+                db.session.delete(invoice)
+            for payment in policy.payments:
+                db.session.delete(payment)
+            db.session.delete(policy)
+        for contact_id in cls.contact_ids:
+            db.session.delete(Contact.query.get(contact_id))
+        db.session.commit()
+
+    def agent_row(self, report):
+        return [row for row in report['agents'] if row['agent'] == self.agent_id][0]
+
+    def test_buckets(self):
+        row = self.agent_row(aging.aging_report(date(2015, 6, 1)))
+
+        # Quarterly: 200 left of the invoice due 05-01. Monthly: 100 due
+        # on the first of each month from 02-01, billed up to 06-01.
+        self.assertEquals(row['name'], 'Test Aging Agent')
+        self.assertEquals([row[bucket] for bucket in aging.BUCKETS], [200, 0, 300, 100, 200])
+        self.assertEquals(row['total'], 800)
+
+    def test_totals_match_balances(self):
+        for date_cursor in [date(2015, 2, 15), date(2015, 6, 1), date(2016, 1, 1)]:
+            report = aging.aging_report(date_cursor)
+            balances = balances_as_of(date_cursor)
+
+            self.assertEquals(report['total']['total'], sum(max(0, balance) for balance in balances.values()))
+            self.assertEquals(sum(row['total'] for row in report['agents']), report['total']['total'])
+            self.assertEquals(sum(row['total'] for row in report['billing_schedules']), report['total']['total'])
+
+    def test_chunks_and_python_fallback_agree(self):
+        expected = aging.aging_report(date(2015, 6, 1))
+        self.assertEquals(aging.aging_report(date(2015, 6, 1), chunk_size=2), expected)
+
+        numpy = aging.numpy
+        aging.numpy = None
+        try:
+            self.assertEquals(aging.aging_report(date(2015, 6, 1), chunk_size=2), expected)
+        finally:
+            aging.numpy = numpy
+
+    def test_chunks_are_plain_tuples(self):
+        # NumPy builds arrays from tuples far faster than from row proxies
+        invoices, payments, _ = aging._load_chunk(db.session, date(2015, 6, 1), 1, 10 ** 9)
+        self.assertTrue(invoices and payments)
+        self.assertTrue(all(type(row) is tuple for row in invoices + payments))
+
+    def test_endpoint(self):
+        client = app.test_client()
+
+        data = json.loads(client.get('/reports/aging?date=2015-06-01').data)
+        self.assertEquals(self.agent_row(data)['total'], 800)
+
+        response = client.get('/reports/aging?date=2015-06-01&format=csv')
+        self.assertEquals(response.mimetype, 'text/csv')
+        rows = list(csv.DictReader(StringIO(response.data)))
+        agent_row = [row for row in rows if row['group'] == 'agent' and row['key'] == str(self.agent_id)][0]
+        self.assertEquals(agent_row['31-60'], '300')
+        self.assertEquals(rows[-1]['total'], str(data['total']['total']))
+
+        self.assertEquals(client.get('/reports/aging?date=06/01/2015').status_code, 400)
+        self.assertEquals(client.get('/reports/aging?format=xml').status_code, 400)
+
+
+class TestBalanceHistory(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        test_agent = Contact('Test Agent', 'Agent')
+        test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(test_agent)
+        db.session.add(test_insured)
+        db.session.commit()
+
+        policy = Policy('Test History Policy', date(2015, 1, 1), 1200)
+        policy.billing_schedule = "Quarterly"
+        policy.named_insured = test_insured.id
+        policy.agent = test_agent.id
+        db.session.add(policy)
+        db.session.commit()
+
+        pa = PolicyAccounting(policy.id)
+        pa.make_payment(test_agent.id, date(2015, 2, 10), 300)
+        pa.make_payment(test_agent.id, date(2015, 4, 1), 250)
+        # A deleted invoice must not count towards the balance
+        pa.delete_invoice(policy.invoices[3])
+        db.session.commit()
+
+        cls.policy_id = policy.id
+        cls.contact_ids = [test_agent.id, test_insured.id]
+
+    @classmethod
+    def tearDownClass(cls):
+        policy = Policy.query.get(cls.policy_id)
+        for invoice in policy.invoices:
+            db.session.delete(invoice)
+        for payment in policy.payments:
+            db.session.delete(payment)
+        db.session.delete(policy)
+        for contact_id in cls.contact_ids:
+            db.session.delete(Contact.query.get(contact_id))
+        db.session.commit()
+
+    def test_daily_matches_return_account_balance(self):
+        with count_queries() as queries:
+            history = balance_history(self.policy_id, date(2014, 12, 30), date(2015, 12, 31))
+        self.assertEquals(len(queries), 2)
+
+        pa = PolicyAccounting(self.policy_id)
+        self.assertEquals(history['opening_balance'], 0)
+        self.assertEquals(len(history['points']), 367)
+        for point in history['points']:
+            date_cursor = datetime.strptime(point['date'], '%Y-%m-%d').date()
+            self.assertEquals(point['balance'], pa.return_account_balance(date_cursor))
+
+    def test_events(self):
+        history = balance_history(self.policy_id, date(2015, 2, 1), date(2015, 12, 31), events=True)
+
+        self.assertEquals(history['opening_balance'], 300)
+        self.assertEquals([(point['date'], point['type'], point['amount'], point['balance'])
+                           for point in history['points']],
+                          [('2015-02-10', 'Payment', 300, 0),
+                           ('2015-04-01', 'Invoice', 300, 300),
+                           ('2015-04-01', 'Payment', 250, 50),
+                           ('2015-07-01', 'Invoice', 300, 350)])
+
+    def test_range_after_last_event(self):
+        history = balance_history(self.policy_id, date(2016, 1, 1), date(2016, 1, 3), events=True)
+
+        self.assertEquals(history['opening_balance'], 350)
+        self.assertEquals(history['points'], [])
+
+    def test_range_ending_at_date_max(self):
+        history = balance_history(self.policy_id, date(9999, 12, 30), date.max)
+        self.assertEquals([point['date'] for point in history['points']], ['9999-12-30', '9999-12-31'])
+
+    def test_endpoint(self):
+        client = app.test_client()
+        url = '/policy/%d/balances' % self.policy_id
+
+        data = json.loads(client.get(url + '?start=2015-03-30&end=2015-04-02').data)
+        self.assertEquals([point['balance'] for point in data['points']], [0, 0, 50, 50])
+
+        data = json.loads(client.get(url + '?by=event&end=2015-02-10').data)
+        self.assertEquals(data['start'], '2015-01-01')
+        self.assertEquals([point['balance'] for point in data['points']], [300, 0])
+
+        self.assertEquals(client.get('/policy/0/balances').status_code, 404)
+        self.assertEquals(client.get(url + '?by=week').status_code, 400)
+        self.assertEquals(client.get(url + '?start=2015-04-02&end=2015-03-30').status_code, 400)
+        self.assertEquals(client.get(url + '?start=2000-01-01&end=2015-01-01').status_code, 413)
+        self.assertEquals(client.get(url + '?start=9999-12-01&end=9999-12-31').status_code, 200)
+
+
+class TestSerializers(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        test_agent = Contact(u'Test Agent \xe9', 'Agent')
+        test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(test_agent)
+        db.session.add(test_insured)
+        db.session.commit()
+
+        cls.policy_ids = []
+        for policy_number, billing_schedule in [('Test Serialize Monthly', 'Monthly'),
+                                                ('Test Serialize No Agent', 'Annual')]:
+            policy = Policy(policy_number, date(2015, 1, 1), 1200)
+            policy.billing_schedule = billing_schedule
+            policy.named_insured = test_insured.id
+            db.session.add(policy)
+            db.session.commit()
+            PolicyAccounting(policy.id)
+            cls.policy_ids.append(policy.id)
+
+        policy = Policy.query.get(cls.policy_ids[0])
+        policy.agent = test_agent.id
+        policy.cancel_date = date(2015, 8, 15)
+        pa = PolicyAccounting(policy.id)
+        pa.make_payment(test_agent.id, date(2015, 2, 10), 300)
+        pa.make_payment(test_agent.id, date(2015, 6, 1), 50)
+        pa.delete_invoice(policy.invoices[5])
+        db.session.commit()
+
+        cls.contact_ids = [test_agent.id, test_insured.id]
+
+    @classmethod
+    def tearDownClass(cls):
+        for policy_id in cls.policy_ids:
+            policy = Policy.query.get(policy_id)
+            for invoice in policy.invoices:
+                db.session.delete(invoice)
+            for payment in policy.payments:
+                db.session.delete(payment)
+            db.session.delete(policy)
+        for contact_id in cls.contact_ids:
+            db.session.delete(Contact.query.get(contact_id))
+        db.session.commit()
+
+    def orm_response(self, policy_id, date_cursor):
+        # The policy view's response built from ORM instances
+        policy = Policy.query.get(policy_id)
+        response = policy.serialize()
+        response['balance'] = PolicyAccounting(policy_id).return_account_balance(date_cursor)
+        response['agent_name'] = policy.agent_contact.name
+        response['insured'] = policy.insured_contact.name
+        response['payments'] = [payment.serialize() for payment in policy.payments]
+        return response
+
+    def test_policy_response_matches_orm(self):
+        for date_cursor in [date(2014, 12, 31), date(2015, 6, 1), date(2016, 1, 1)]:
+            for xhr in [False, True]:
+                headers = {'X-Requested-With': 'XMLHttpRequest'} if xhr else {}
+                with app.test_request_context(headers=headers):
+                    expected = jsonify(self.orm_response(self.policy_ids[0], date_cursor)).data
+                    self.assertEquals(jsonify(policy_response(self.policy_ids[0], date_cursor)).data,
+                                      expected)
+
+    def test_policy_response_missing(self):
+        self.assertEquals(policy_response(0, date(2015, 6, 1)), None)
+        self.assertEquals(policy_response(self.policy_ids[1], date(2015, 6, 1))['agent_name'], None)
+
+    def test_invoice_dicts_match_orm(self):
+        expected = [invoice.serialize() for invoice in Invoice.query.order_by(Invoice.id)]
+        self.assertEquals(json.dumps(invoice_dicts()), json.dumps(expected))
+        self.assertEquals(len(invoice_dicts([self.policy_ids[0]])), 12)
+
+    def test_view(self):
+        client = app.test_client()
+        policy_cache.backend.clear()
+
+        response = client.get('/policy/%d/2015-06-01' % self.policy_ids[0])
+        with app.test_request_context():
+            expected = jsonify(self.orm_response(self.policy_ids[0], date(2015, 6, 1))).data
+        self.assertEquals(response.data, expected)
+
+        response = client.get('/policy/%d/2015-06-01' % self.policy_ids[1])
+        self.assertEquals(response.status_code, 404)
+        self.assertEquals(response.data, 'Agent not found!')
+
+
+class TestExports(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        test_agent = Contact('Test Agent', 'Agent')
+        test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(test_agent)
+        db.session.add(test_insured)
+        db.session.commit()
+
+        policy = Policy('Test Export Policy', date(2015, 1, 1), 1200)
+        policy.billing_schedule = "Quarterly"
+        policy.named_insured = test_insured.id
+        policy.agent = test_agent.id
+        db.session.add(policy)
+        db.session.commit()
+
+        pa = PolicyAccounting(policy.id)
+        pa.make_payment(test_agent.id, date(2015, 2, 10), 300)
+        pa.make_payment(test_agent.id, date(2015, 4, 1), 250)
+        pa.delete_invoice(policy.invoices[3])
+        db.session.commit()
+
+        cls.policy_id = policy.id
+        cls.contact_ids = [test_agent.id, test_insured.id]
+
+    @classmethod
+    def tearDownClass(cls):
+        policy = Policy.query.get(cls.policy_id)
+        for invoice in policy.invoices:
+            db.session.delete(invoice)
+        for payment in policy.payments:
+            db.session.delete(payment)
+        db.session.delete(policy)
+        for contact_id in cls.contact_ids:
+            db.session.delete(Contact.query.get(contact_id))
+        db.session.commit()
+
+    def read(self, pieces):
+        return gzip.GzipFile(fileobj=StringIO(''.join(pieces))).read()
+
+    def test_ndjson_includes_deleted_invoices(self):
+        pieces = list(export_chunks('invoices', 'ndjson', chunk_size=2))
+        rows = [json.loads(line) for line in self.read(pieces).splitlines()]
+
+        # One piece per chunk of rows, plus the end of the gzip stream
+        self.assertEquals(len(pieces), (Invoice.query.count() + 1) / 2 + 1)
+        self.assertEquals([row['id'] for row in rows], [invoice.id for invoice in Invoice.query.order_by(Invoice.id)])
+        exported = [row for row in rows if row['policy_id'] == self.policy_id]
+        self.assertEquals([row['deleted'] for row in exported], [False, False, False, True])
+        self.assertEquals(exported[0]['bill_date'], '2015-01-01')
+
+    def test_csv(self):
+        rows = list(csv.DictReader(StringIO(self.read(export_chunks('payments')))))
+
+        self.assertEquals(len(rows), Payment.query.count())
+        exported = [row for row in rows if row['policy_id'] == str(self.policy_id)]
+        self.assertEquals([(row['transaction_date'], row['amount_paid']) for row in exported],
+                          [('2015-02-10', '300'), ('2015-04-01', '250')])
+
+    def test_watermark(self):
+        payment_ids = [payment.id for payment in Policy.query.get(self.policy_id).payments]
+
+        watermark = export_watermark('payments', payment_ids[0] - 1)
+        self.assertEquals(watermark['last_id'], payment_ids[-1])
+        rows = self.read(export_chunks('payments', 'ndjson', payment_ids[0], through_id=watermark['last_id']))
+        self.assertEquals([json.loads(line)['id'] for line in rows.splitlines()], payment_ids[1:])
+
+        # A payment posted later on the date of the last one is still exported
+        agent_id = Policy.query.get(self.policy_id).agent
+        payment = PolicyAccounting(self.policy_id).make_payment(agent_id, date(2015, 4, 1), 10)
+        rows = self.read(export_chunks('payments', 'ndjson', watermark['last_id']))
+        self.assertEquals([json.loads(line)['id'] for line in rows.splitlines()], [payment.id])
+
+        # since is inclusive
+        rows = self.read(export_chunks('payments', 'ndjson', since=date(2015, 4, 1)))
+        exported = [json.loads(line) for line in rows.splitlines()]
+        self.assertTrue(all(row['transaction_date'] >= '2015-04-01' for row in exported))
+        self.assertTrue(payment_ids[-1] in [row['id'] for row in exported])
+
+        self.assertEquals(export_watermark('invoices', after_id=10 ** 9), {'last_id': None})
+        self.assertRaises(ValueError, export_watermark, 'invoices', since=date(2015, 3, 1))
+        self.assertRaises(ValueError, export_watermark, 'contacts')
+
+    def test_endpoint(self):
+        client = app.test_client()
+
+        response = client.get('/exports/invoices?format=ndjson')
+        self.assertEquals(response.mimetype, 'application/gzip')
+        rows = [json.loads(line) for line in self.read([response.data]).splitlines()]
+        self.assertEquals(response.headers['X-Export-Last-Id'], str(rows[-1]['id']))
+
+        response = client.get('/exports/invoices?format=ndjson&after_id=' + str(rows[-1]['id']))
+        self.assertEquals(self.read([response.data]), '')
+
+        response = client.get('/exports/payments?since=2015-03-01')
+        self.assertEquals(response.status_code, 200)
+
+        self.assertEquals(client.get('/exports/contacts').status_code, 404)
+        self.assertEquals(client.get('/exports/invoices?format=xml').status_code, 400)
+        self.assertEquals(client.get('/exports/invoices?since=2015-03-01').status_code, 400)
+        self.assertEquals(client.get('/exports/invoices?after_id=x').status_code, 400)
+        self.assertEquals(client.get('/exports/invoices?after_id=%d' % 2 ** 63).status_code, 400)
+
+
+class TestReadOnlyEngine(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Test Read Policy', date(2015, 1, 1), 1200)
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        db.session.add(cls.policy)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.delete(cls.policy)
+        db.session.commit()
+
+    def setUp(self):
+        self.read_engine = app.config['READ_ENGINE']
+
+    def tearDown(self):
+        if read_session() is not db.session:
+            read_session().remove()
+        app.config['READ_ENGINE'] = self.read_engine
+        if os.path.exists(snapshot_path()):
+            os.remove(snapshot_path())
+        for invoice in self.policy.invoices:
+            db.session.delete(invoice)
+        for payment in self.policy.payments:
+            db.session.delete(payment)
+        db.session.commit()
+
+    def count_payments(self, session):
+        return session.query(Payment).filter_by(policy_id=self.policy.id).count()
+
+    def pay(self):
+        db.session.add(Payment(self.policy.id, self.test_agent.id, 100, date(2015, 2, 1)))
+        db.session.commit()
+
+    def test_reads_see_commits_and_cannot_write(self):
+        app.config['READ_ENGINE'] = 'ro'
+        session = read_session()
+        self.assertFalse(session is db.session)
+
+        self.pay()
+        self.assertEquals(self.count_payments(session), 1)
+        self.assertRaises(OperationalError, session.execute,
+                          Payment.__table__.delete())
+        session.rollback()
+
+    def test_open_read_does_not_block_writes(self):
+        app.config['READ_ENGINE'] = 'ro'
+        session = read_session()
+
+        # Keep a read transaction open while a payment is posted
+        self.assertEquals(self.count_payments(session), 0)
+        PolicyAccounting(self.policy.id).make_payment(self.test_agent.id, date(2015, 2, 1), 100)
+        self.assertEquals(self.count_payments(db.session), 1)
+
+    def test_snapshot(self):
+        app.config['READ_ENGINE'] = 'snapshot'
+        refresh_snapshot()
+        self.pay()
+
+        # Reads never refresh the snapshot, so it does not have the payment yet
+        os.utime(snapshot_path(), (0, 0))
+        self.assertEquals(self.count_payments(read_session()), 0)
+        self.assertEquals(os.path.getmtime(snapshot_path()), 0)
+        self.assertEquals(self.count_payments(read_session(fresh=True)), 1)
+
+        read_session().remove()
+        refresh_snapshot()
+        self.assertEquals(self.count_payments(read_session()), 1)
+
+    def test_snapshot_not_written_yet(self):
+        app.config['READ_ENGINE'] = 'snapshot'
+        self.assertTrue(read_session() is db.session)
+        self.assertFalse(os.path.exists(snapshot_path()))
+
+    def test_without_uri_filenames(self):
+        app.config['READ_ENGINE'] = 'ro'
+        use_uri, readonly._use_uri = readonly._use_uri, False
+        try:
+            session = read_session()
+            self.pay()
+            self.assertEquals(self.count_payments(session), 1)
+            self.assertRaises(OperationalError, session.execute, Payment.__table__.delete())
+            session.rollback()
+            self.assertFalse([name for name in os.listdir('.') if name.startswith('file:')])
+        finally:
+            readonly._use_uri = use_uri
+
+    def test_primary(self):
+        app.config['READ_ENGINE'] = 'primary'
+        self.assertTrue(read_session() is db.session)
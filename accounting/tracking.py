@@ -0,0 +1,69 @@
+#!/user/bin/env python2.7
+from datetime import datetime
+
+from sqlalchemy import and_, bindparam, select, union
+
+from accounting import db
+from models import DirtyPolicy, Invoice
+
+"""
+#######################################################
+Change tracking for the daily sweep. A policy's status can
+only change when it is written to or when one of its
+invoices reaches its due or cancel date. Writes mark the
+policy in the dirty_policies table, in the same transaction
+as the write, and invoice dates are found through their
+own indexes, so a sweep since the last run only needs to
+evaluate the policies in either set.
+#######################################################
+"""
+
+
+def mark_dirty(policy_ids):
+    """
+     Mark policies as changed. The caller is responsible for committing.
+    """
+    now = datetime.now()
+    db.session.execute(DirtyPolicy.__table__.insert().prefix_with('OR REPLACE'),
+                       [{'policy_id': policy_id, 'marked_at': now} for policy_id in policy_ids])
+
+
+def dirty_policies():
+    """
+     Return a {policy_id: marked_at} dict of the policies marked so far.
+    """
+    return dict(db.session.query(DirtyPolicy.policy_id, DirtyPolicy.marked_at))
+
+
+def clear_dirty(marks):
+    """
+     Remove the marks returned by dirty_policies. A policy marked again
+     since then has a newer marked_at and stays dirty. The caller is
+     responsible for committing.
+    """
+    if not marks:
+        return
+    dirty = DirtyPolicy.__table__
+    db.session.execute(dirty.delete().where(and_(dirty.c.policy_id == bindparam('id'),
+                                                 dirty.c.marked_at == bindparam('at'))),
+                       [{'id': policy_id, 'at': marked_at} for policy_id, marked_at in marks.items()])
+
+
+def crossed_date_policies(since, date_cursor):
+    """
+     Return the ids of policies with a non-deleted invoice whose due
+     date or cancel date is from since to date_cursor, inclusive.
+    """
+    return set(row[0] for row in db.session.execute(_crossed_dates(since, date_cursor)))
+
+
+def _crossed_dates(since, date_cursor):
+    # Each branch is a range scan on its own date index
+    invoices = Invoice.__table__
+    due = select([invoices.c.policy_id])\
+        .where(and_(invoices.c.due_date.between(since, date_cursor),
+                    invoices.c.deleted == False))
+    cancel = select([invoices.c.policy_id])\
+        .where(and_(invoices.c.cancel_date.between(since, date_cursor),
+                    invoices.c.deleted == False))
+    return union(due, cancel)
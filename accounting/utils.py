@@ -1,11 +1,20 @@
 #!/user/bin/env python2.7
+import heapq
 import logging
 
-from datetime import date, datetime
-from dateutil.relativedelta import relativedelta
+from datetime import date, datetime, timedelta
+from itertools import groupby
+from sqlalchemy import and_, func, literal, null, select, union_all
 
 from accounting import db
-from models import Contact, Invoice, Payment, Policy
+from allocations import allocate_policies, allocate_policy, apply_payment, rebuild_allocations
+from cache import invalidate_policies
+from metrics import instrument_methods
+from ledger import balance_as_of, rebuild_entries, rebuild_ledger, record_invoice_deleted, record_payment
+from models import Contact, Invoice, LedgerEntry, Payment, Policy
+from schedules import BILLING_SCHEDULES, split_premium, templates
+from tracking import clear_dirty, crossed_date_policies, dirty_policies, mark_dirty
+from writer import commit_write
 
 """
 #######################################################
@@ -13,42 +22,41 @@ This is the base code for the engineer project.
 #######################################################
 """
 
+@instrument_methods
 class PolicyAccounting(object):
     """
      Each policy has its own instance of accounting.
+
+     PolicyAccounting(policy_id) loads the policy and creates its
+     invoices if it has none. Read-only callers that already have the
+     policy should use PolicyAccounting.for_policy(policy), which runs
+     no queries and never writes; call ensure_invoices explicitly when
+     invoices may be missing.
     """
     def __init__(self, policy_id):
         self.policy = Policy.query.filter_by(id=policy_id).one()
-
-        if not self.policy.invoices:
+        self.ensure_invoices()
+
+    @classmethod
+    def for_policy(cls, policy):
+        pa = cls.__new__(cls)
+        pa.policy = policy
+        return pa
+
+    def ensure_invoices(self):
+        # Check for an invoice without loading them all
+        has_invoices = db.session.query(Invoice.id)\
+                                 .filter(Invoice.policy_id == self.policy.id)\
+                                 .first()
+        if not has_invoices:
             self.make_invoices()
 
     def return_account_balance(self, date_cursor=None):
         if not date_cursor:
             date_cursor = datetime.now().date()
 
-        # Retrieve invoices by policy id with date up to date_cursor
-        invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Invoice.deleted == False)\
-                                .filter(Invoice.bill_date <= date_cursor)\
-                                .order_by(Invoice.bill_date)\
-                                .all()
-
-        # Calculate total amount due
-        due_now = 0
-        for invoice in invoices:
-            due_now += invoice.amount_due
-
-        # Retrieve all previous payments
-        payments = Payment.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Payment.transaction_date <= date_cursor)\
-                                .all()
-
-        # Subtract payments from total due
-        for payment in payments:
-            due_now -= payment.amount_paid
-
-        return due_now
+        # Latest running balance on or before date_cursor
+        return balance_as_of(self.policy.id, date_cursor)
 
     def make_payment(self, contact_id=None, date_cursor=None, amount=0):
         if not date_cursor:
@@ -75,7 +83,13 @@ class PolicyAccounting(object):
                           amount,
                           date_cursor)
         db.session.add(payment)
-        db.session.commit()
+        db.session.flush()
+
+        # Apply payment to open invoices and post it to the ledger
+        apply_payment(payment)
+        record_payment(payment)
+        mark_dirty([self.policy.id])
+        commit_write(self.policy.id)
 
         return payment
 
@@ -86,41 +100,34 @@ class PolicyAccounting(object):
          being paid in full. However, it has not necessarily
          made it to the cancel_date yet.
         """
+        if not date_cursor:
+            date_cursor = datetime.now().date()
 
-        # Get all invoices by policy id
-        invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Invoice.deleted == False)\
-                                .order_by(Invoice.bill_date)\
-                                .all()
-
-        # Find payments for each invoice
-        for invoice in invoices:
-            # Retrieve payments made on time
-            payments = Payment.query.filter_by(policy_id=invoice.policy_id)\
-                                    .filter(Payment.transaction_date >= invoice.bill_date and Payment.transaction_date <= invoice.due_date)\
-                                    .all()
-
-            # If no payments made. And date is past due date, but before cancel date. Return true
-            if not payments:
-                if date_cursor > invoice.due_date and date_cursor < invoice.cancel_date:
-                    return True
-
-        return False
+        entries = db.session.execute(_pending_cancellation_entries(date_cursor, [self.policy.id]))
+        return _is_pending_cancellation((entry_date, due_date) for _, entry_date, due_date in entries)
 
     def evaluate_cancel(self, date_cursor=None):
         if not date_cursor:
             date_cursor = datetime.now().date()
 
-        # Retrieve all invoices where cancel date has passed
-        invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Invoice.deleted == False)\
-                                .filter(Invoice.cancel_date <= date_cursor)\
-                                .order_by(Invoice.bill_date)\
-                                .all()
+        # Balance as of each cancel date that has passed, in one query
+        ledger = LedgerEntry.__table__
+        balance_at_cancel = select([ledger.c.balance])\
+            .where(and_(ledger.c.policy_id == Invoice.policy_id,
+                        ledger.c.entry_date <= Invoice.cancel_date))\
+            .order_by(ledger.c.entry_date.desc(), ledger.c.id.desc())\
+            .limit(1)\
+            .as_scalar()
+        balances = db.session.query(balance_at_cancel)\
+                             .select_from(Invoice)\
+                             .filter(Invoice.policy_id == self.policy.id)\
+                             .filter(Invoice.deleted == False)\
+                             .filter(Invoice.cancel_date <= date_cursor)\
+                             .order_by(Invoice.bill_date)
 
         # Returns whether or not a policy should cancel. Based on if there is a balance left on any invoice
-        for invoice in invoices:
-            if not self.return_account_balance(invoice.cancel_date):
+        for balance, in balances:
+            if not balance:
                 continue
             else:
                 return True
@@ -159,75 +166,534 @@ class PolicyAccounting(object):
         # Mark invoices associated with policy as deleted
         self.delete_invoices()
 
-        db.session.commit()
+        mark_dirty([self.policy.id])
+        commit_write(self.policy.id)
 
     def delete_invoices(self):
-        for invoice in self.policy.invoices:
-            invoice.deleted = True
+        # Soft delete every invoice and rebuild the ledger once
+        self._mark_invoices_deleted()
+        rebuild_entries([self.policy.id])
+
+    def delete_invoice(self, invoice):
+        # Soft delete the invoice, move its payments on to the other
+        # invoices and reverse it in the ledger
+        if invoice.deleted:
+            return
+        invoice.deleted = True
+        allocate_policy(self.policy.id)
+        record_invoice_deleted(invoice)
+        mark_dirty([self.policy.id])
+        commit_write(self.policy.id)
 
     def make_invoices(self):
-        billing_schedules = {'Annual': 1, 'Two-Pay': 2, 'Quarterly': 4, 'Monthly': 12}
-
-        invoices = []
-
-        # Create an Invoice.
-        first_invoice = Invoice(self.policy.id,
-                                self.policy.effective_date,  # bill_date
-                                self.policy.effective_date + relativedelta(months=1),  # due date
-                                self.policy.effective_date + relativedelta(months=1, days=14),  # cancellation date
-                                self.policy.annual_premium)
-
-        # Add invoice to array.
-        invoices.append(first_invoice)
+        # Get bill, due and cancel dates and amounts from the billing schedule
+        schedule = invoice_schedule(self.policy.effective_date,
+                                    self.policy.annual_premium,
+                                    self.policy.billing_schedule)
 
-        # Get number of payments from billing_schedules
-        num_of_payments = billing_schedules.get(self.policy.billing_schedule) or None
-
-        if not num_of_payments:
+        if not schedule:
             print "You have chosen a bad billing schedule."
+            return
 
-        # Calculate first invoice amount due by dividing total by number of payments
-        first_invoice.amount_due = first_invoice.amount_due / num_of_payments
-
-        for i in range(1, num_of_payments):
-            # Calculate months after effective date
-            months_after_eff_date = i*(12/num_of_payments)
-
-            # Add months to effective date to get bill date
-            bill_date = self.policy.effective_date + relativedelta(months=months_after_eff_date)
-            invoice = Invoice(self.policy.id,
-                              bill_date,
-                              bill_date + relativedelta(months=1),
-                              bill_date + relativedelta(months=1, days=14),
-                              self.policy.annual_premium / billing_schedules.get(self.policy.billing_schedule))
-            invoices.append(invoice)
-
-        # Add new invoices to db
-        for invoice in invoices:
-            db.session.add(invoice)
-        db.session.commit()
+        # Add new invoices to db in one statement
+        db.session.execute(Invoice.__table__.insert(),
+                           [{'policy_id': self.policy.id,
+                             'bill_date': bill_date,
+                             'due_date': due_date,
+                             'cancel_date': cancel_date,
+                             'amount_due': amount_due,
+                             'deleted': False} for bill_date, due_date, cancel_date, amount_due in schedule])
+        db.session.expire(self.policy, ['invoices'])
+
+        # Apply existing payments to the new invoices and post them to the ledger
+        allocate_policy(self.policy.id)
+        rebuild_entries([self.policy.id])
+        mark_dirty([self.policy.id])
+        commit_write(self.policy.id)
 
     def change_billing_schedule(self, new_schedule=''):
         # If trying to update to same schedule, return
         if(self.policy.billing_schedule == new_schedule):
             return
 
-        billing_schedules = ['Annual', 'Two-Pay', 'Quarterly', 'Monthly']
-
         # If not a correct billing schedule print and return
-        if new_schedule not in billing_schedules:
+        if new_schedule not in BILLING_SCHEDULES:
             print('You have chosen an incorrect billing schedule')
             return
 
-        # Set all invoices to deleted
-        for invoice in self.policy.invoices:
-            invoice.deleted = True
-            db.session.commit()
+        # Set all invoices to deleted; make_invoices rebuilds the ledger
+        self._mark_invoices_deleted()
 
         # Update policy to new billing schedule and call make invoices
         self.policy.billing_schedule = new_schedule
         self.make_invoices()
 
+    def _mark_invoices_deleted(self):
+        # One UPDATE for all invoices, then reload them when next used
+        invoices = Invoice.__table__
+        db.session.execute(invoices.update()
+                                   .where(and_(invoices.c.policy_id == self.policy.id,
+                                               invoices.c.deleted == False))
+                                   .values(deleted=True))
+        for invoice in self.policy.__dict__.get('invoices', []):
+            db.session.expire(invoice, ['deleted'])
+        db.session.expire(self.policy, ['invoices'])
+
+
+def invoice_schedule(effective_date, annual_premium, billing_schedule):
+    """
+     Return the (bill_date, due_date, cancel_date, amount_due) of each
+     invoice a policy gets on its billing schedule, or None if the
+     billing schedule is not valid.
+    """
+    # Invoice dates are shared by every policy with the same schedule and effective date
+    template = templates.get(billing_schedule, effective_date)
+    if not template:
+        return None
+
+    amounts = split_premium(annual_premium, len(template))
+    return [dates + (amount,) for dates, amount in zip(template, amounts)]
+
+
+def balance_history(policy_id, start_date, end_date, events=False, session=None):
+    """
+     Return a policy's balance over a date range, by the same rules as
+     return_account_balance, as a dict with the opening balance (as of
+     the day before start_date) and a list of points.
+
+     By default there is a point with the closing balance of every day
+     from start_date to end_date. With events set there is a point per
+     invoice and payment in the range instead, with its date, type,
+     amount and the balance after it. Either way invoices and payments
+     are read once, each sorted by date, and merged in a single pass.
+     Queries run on session, db.session by default.
+    """
+    session = session or db.session
+    invoices = Invoice.__table__
+    payments = Payment.__table__
+
+    # Invoices before payments on the same date, like a statement lists them
+    billed = session.execute(
+        select([invoices.c.bill_date, invoices.c.id, invoices.c.amount_due])
+        .where(and_(invoices.c.policy_id == policy_id,
+                    invoices.c.deleted == False,
+                    invoices.c.bill_date <= end_date))
+        .order_by(invoices.c.bill_date, invoices.c.id))
+    paid = session.execute(
+        select([payments.c.transaction_date, payments.c.id, payments.c.amount_paid])
+        .where(and_(payments.c.policy_id == policy_id,
+                    payments.c.transaction_date <= end_date))
+        .order_by(payments.c.transaction_date, payments.c.id))
+    merged = heapq.merge(((bill_date, 0, invoice_id, amount) for bill_date, invoice_id, amount in billed),
+                         ((paid_date, 1, payment_id, -amount) for paid_date, payment_id, amount in paid))
+
+    balance = 0
+    opening = None
+    points = []
+    days = _days(start_date, end_date)
+    day = next(days, None)
+    for event_date, order, event_id, amount in merged:
+        if event_date >= start_date and opening is None:
+            opening = balance
+        # Close every day before this event
+        while not events and day is not None and day < event_date:
+            points.append({'date': str(day), 'balance': balance})
+            day = next(days, None)
+        balance += amount
+        if events and event_date >= start_date:
+            points.append({'date': str(event_date),
+                           'type': u'Invoice' if order == 0 else u'Payment',
+                           'id': event_id,
+                           'amount': abs(amount),
+                           'balance': balance})
+    while not events and day is not None:
+        points.append({'date': str(day), 'balance': balance})
+        day = next(days, None)
+
+    return {'policy_id': policy_id,
+            'start': str(start_date),
+            'end': str(end_date),
+            'opening_balance': balance if opening is None else opening,
+            'points': points}
+
+
+def _days(start_date, end_date):
+    # Each date from start_date to end_date, stopping before a step past
+    # end_date could overflow date.max
+    day = start_date
+    while day <= end_date:
+        yield day
+        if day == end_date:
+            break
+        day += timedelta(days=1)
+
+
+# SQLite limits the number of bound parameters per statement,
+# so lists of policy ids are sent in chunks of this size.
+POLICY_ID_CHUNK_SIZE = 500
+
+
+def chunks(items, size):
+    """
+     Yield successive lists of at most size items.
+    """
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def balances_as_of(date_cursor=None, policy_ids=None, session=None):
+    """
+     Return a {policy_id: balance} dict for many policies at once.
+
+     The balance follows the same rules as
+     PolicyAccounting.return_account_balance: every non-deleted invoice
+     billed on or before date_cursor, less every payment made on or
+     before date_cursor. Invoices and payments are summed by one grouped
+     aggregate instead of being loaded per policy. When policy_ids is
+     None every policy in the book is returned. Queries run on session,
+     db.session by default.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    session = session or db.session
+
+    if policy_ids is None:
+        return _balances_as_of(session, date_cursor)
+
+    balances = {}
+    for chunk in chunks(set(policy_ids), POLICY_ID_CHUNK_SIZE):
+        balances.update(_balances_as_of(session, date_cursor, chunk))
+    return balances
+
+
+def _balances_as_of(session, date_cursor, policy_ids=None):
+    invoices = Invoice.__table__
+    payments = Payment.__table__
+
+    # Amounts billed count towards the balance, payments count against it
+    billed = select([invoices.c.policy_id.label('policy_id'),
+                     invoices.c.amount_due.label('amount')])\
+        .where(and_(invoices.c.deleted == False,
+                    invoices.c.bill_date <= date_cursor))
+    paid = select([payments.c.policy_id.label('policy_id'),
+                   (-payments.c.amount_paid).label('amount')])\
+        .where(payments.c.transaction_date <= date_cursor)
+
+    if policy_ids is not None:
+        billed = billed.where(invoices.c.policy_id.in_(policy_ids))
+        paid = paid.where(payments.c.policy_id.in_(policy_ids))
+
+    entries = union_all(billed, paid).alias('entries')
+
+    # Outer join from policies so policies with no activity report 0
+    query = session.query(Policy.id, func.coalesce(func.sum(entries.c.amount), 0))\
+                   .outerjoin(entries, entries.c.policy_id == Policy.id)\
+                   .group_by(Policy.id)
+    if policy_ids is not None:
+        query = query.filter(Policy.id.in_(policy_ids))
+
+    return dict((policy_id, balance) for policy_id, balance in query)
+
+
+def policies_to_cancel(date_cursor=None, policy_ids=None, session=None):
+    """
+     Return the ids of active policies that evaluate_cancel would cancel.
+
+     A policy should cancel when, on the cancel date of any of its
+     non-deleted invoices that is on or before date_cursor, the account
+     balance is not zero. Every candidate invoice's balance is computed
+     by the same grouped query instead of one return_account_balance
+     call per invoice. Queries run on session, db.session by default.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    session = session or db.session
+
+    if policy_ids is None:
+        return _policies_to_cancel(session, date_cursor)
+
+    policies = []
+    for chunk in chunks(set(policy_ids), POLICY_ID_CHUNK_SIZE):
+        policies.extend(_policies_to_cancel(session, date_cursor, chunk))
+    return sorted(policies)
+
+
+def _policies_to_cancel(session, date_cursor, policy_ids=None):
+    policies = Policy.__table__
+    candidate = Invoice.__table__.alias('candidate')
+    billed = Invoice.__table__.alias('billed')
+    paid = Payment.__table__.alias('paid')
+
+    # Invoices whose cancel date has passed on active policies
+    conditions = [candidate.c.deleted == False,
+                  candidate.c.cancel_date <= date_cursor,
+                  policies.c.status == u'Active']
+    if policy_ids is not None:
+        conditions.append(candidate.c.policy_id.in_(policy_ids))
+    candidates = candidate.join(policies, policies.c.id == candidate.c.policy_id)
+
+    # Amount billed up to each candidate's cancel date
+    billed_totals = select([candidate.c.id.label('invoice_id'),
+                            candidate.c.policy_id.label('policy_id'),
+                            func.sum(billed.c.amount_due).label('amount')],
+                           from_obj=candidates.join(billed, and_(
+                               billed.c.policy_id == candidate.c.policy_id,
+                               billed.c.deleted == False,
+                               billed.c.bill_date <= candidate.c.cancel_date)))\
+        .where(and_(*conditions))\
+        .group_by(candidate.c.id, candidate.c.policy_id)\
+        .alias('billed_totals')
+
+    # Amount paid up to each candidate's cancel date
+    paid_totals = select([candidate.c.id.label('invoice_id'),
+                          func.sum(paid.c.amount_paid).label('amount')],
+                         from_obj=candidates.join(paid, and_(
+                             paid.c.policy_id == candidate.c.policy_id,
+                             paid.c.transaction_date <= candidate.c.cancel_date)))\
+        .where(and_(*conditions))\
+        .group_by(candidate.c.id)\
+        .alias('paid_totals')
+
+    query = select([billed_totals.c.policy_id],
+                   from_obj=billed_totals.outerjoin(
+                       paid_totals, paid_totals.c.invoice_id == billed_totals.c.invoice_id))\
+        .where(billed_totals.c.amount - func.coalesce(paid_totals.c.amount, 0) != 0)\
+        .distinct()\
+        .order_by(billed_totals.c.policy_id)
+
+    return [row[0] for row in session.execute(query)]
+
+
+def policies_pending_cancellation(date_cursor=None, policy_ids=None, session=None):
+    """
+     Return a {policy_id: bool} dict of
+     evaluate_cancellation_pending_due_to_non_pay for many policies,
+     fetched with one query per chunk of policy ids. Queries run on
+     session, db.session by default.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    session = session or db.session
+
+    if policy_ids is None:
+        policy_ids = [policy_id for policy_id, in session.query(Policy.id)]
+
+    pending = {}
+    for chunk in chunks(set(policy_ids), POLICY_ID_CHUNK_SIZE):
+        pending.update(dict.fromkeys(chunk, False))
+        entries = session.execute(_pending_cancellation_entries(date_cursor, chunk))
+        for policy_id, policy_entries in groupby(entries, lambda entry: entry[0]):
+            pending[policy_id] = _is_pending_cancellation(
+                (entry_date, due_date) for _, entry_date, due_date in policy_entries)
+    return pending
+
+
+def _pending_cancellation_entries(date_cursor, policy_ids):
+    """
+     Select (policy_id, date, due_date) rows for the invoices that are
+     past due but not yet cancelled on date_cursor, merged with the
+     payments that could have paid them. Payments have no due_date.
+     Rows are sorted by policy and date, invoices before payments
+     made on the same day.
+    """
+    invoices = Invoice.__table__
+    payments = Payment.__table__
+
+    past_due = select([invoices.c.policy_id.label('policy_id'),
+                       invoices.c.bill_date.label('entry_date'),
+                       invoices.c.due_date.label('due_date'),
+                       literal(0).label('kind')])\
+        .where(and_(invoices.c.policy_id.in_(policy_ids),
+                    invoices.c.deleted == False,
+                    invoices.c.due_date < date_cursor,
+                    invoices.c.cancel_date > date_cursor))
+
+    # A payment only counts if made on or before an invoice's due date,
+    # so payments on or after date_cursor can never count
+    paid = select([payments.c.policy_id,
+                   payments.c.transaction_date,
+                   null(),
+                   literal(1)])\
+        .where(and_(payments.c.policy_id.in_(policy_ids),
+                    payments.c.transaction_date < date_cursor))
+
+    entries = union_all(past_due, paid).alias('entries')
+    return select([entries.c.policy_id, entries.c.entry_date, entries.c.due_date])\
+        .order_by(entries.c.policy_id, entries.c.entry_date, entries.c.kind)
+
+
+def _is_pending_cancellation(entries):
+    """
+     Walk one policy's (date, due_date) entries in date order. A payment
+     pays every open invoice billed on or before it whose due date has
+     not passed; an open invoice that is already past due when the next
+     payment arrives, or that no payment reaches, was not paid on time.
+    """
+    open_due_dates = []
+    for entry_date, due_date in entries:
+        if due_date is not None:
+            open_due_dates.append(due_date)
+            continue
+
+        if any(open_due_date < entry_date for open_due_date in open_due_dates):
+            return True
+        open_due_dates = []
+
+    return bool(open_due_dates)
+
+
+def cancellation_sweep(date_cursor=None, policy_ids=None, apply=False,
+                       status_code='Non-Payment', description=None,
+                       batch_size=POLICY_ID_CHUNK_SIZE, since=None):
+    """
+     Find every policy that should cancel as of date_cursor and,
+     when apply is set, cancel them the same way cancel_policy does.
+
+     Cancellations are written with set-based updates, one transaction
+     per batch_size policies. Returns the list of policy ids found.
+
+     With since, the date of the previous sweep, only the policies
+     written to since they were last swept, or with an invoice due or
+     cancel date from since to date_cursor, are evaluated; applying
+     the sweep clears their dirty marks.
+    """
+    if status_code not in (u'Fraud', u'Non-Payment', u'Underwriting'):
+        print('Invalid reason chosen')
+        return []
+
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+
+    marks = {}
+    if since is not None and policy_ids is None:
+        marks = dirty_policies()
+        policy_ids = set(marks) | crossed_date_policies(since, date_cursor)
+
+    policy_ids = policies_to_cancel(date_cursor, policy_ids)
+    if not apply:
+        return policy_ids
+
+    values = {'status': u'Canceled',
+              'status_code': status_code,
+              'cancel_date': datetime.now().date()}
+    if description:
+        values['status_desc'] = description
+
+    for batch in chunks(policy_ids, batch_size):
+        cancel_policies(batch, values)
+        invalidate_policies(batch)
+        db.session.commit()
+        logging.info('Canceled %d policies', len(batch))
+
+    clear_dirty(marks)
+    db.session.commit()
+
+    return policy_ids
+
+
+def cancel_policies(policy_ids, values):
+    """
+     Set the status columns in values on many policies, soft delete
+     their invoices and rebuild their ledger entries, without
+     committing. policy_ids must fit in one statement.
+    """
+    policies = Policy.__table__
+    invoices = Invoice.__table__
+    db.session.execute(policies.update()
+                               .where(policies.c.id.in_(policy_ids))
+                               .values(**values))
+    db.session.execute(invoices.update()
+                               .where(invoices.c.policy_id.in_(policy_ids))
+                               .values(deleted=True))
+    rebuild_entries(policy_ids)
+
+
+def onboard_policies(specs, batch_size=POLICY_ID_CHUNK_SIZE):
+    """
+     Create many policies and their invoices at once, for example when
+     migrating a book from another carrier. Each spec is a dict with
+     policy_number, effective_date, annual_premium, billing_schedule,
+     named_insured and agent (contact ids).
+
+     Policies and invoices are written with bulk inserts, one
+     transaction per batch_size policies, and get the same invoices
+     make_invoices would create. Returns a list with the new policy id
+     for each spec, or None for a spec that was rejected.
+    """
+    policy_ids = []
+    for batch in chunks(specs, batch_size):
+        policy_ids.extend(_onboard_batch(batch))
+    return policy_ids
+
+
+def _onboard_batch(specs):
+    policies = Policy.__table__
+    invoices = Invoice.__table__
+
+    # Validate specs and work out their invoices up front
+    accepted = []
+    for spec in specs:
+        schedule = None
+        if _valid_spec(spec):
+            schedule = invoice_schedule(spec['effective_date'],
+                                        spec['annual_premium'],
+                                        spec.get('billing_schedule'))
+        if not schedule:
+            logging.warning('Rejected policy spec %r', spec)
+            accepted.append(None)
+            continue
+        accepted.append((spec, schedule))
+
+    new_policies = [{'policy_number': spec['policy_number'],
+                     'effective_date': spec['effective_date'],
+                     'status': u'Active',
+                     'billing_schedule': spec['billing_schedule'],
+                     'annual_premium': spec['annual_premium'],
+                     'named_insured': spec['named_insured'],
+                     'agent': spec.get('agent')} for spec, _ in filter(None, accepted)]
+    if not new_policies:
+        return [None] * len(specs)
+
+    # SQLite hands out ids in insert order. The insert opens the write
+    # transaction, so once it has run no other writer can add policies
+    # and the new ones are the last ids.
+    db.session.execute(policies.insert(), new_policies)
+    new_ids = [policy_id for policy_id, in db.session.query(Policy.id)
+                                                     .order_by(Policy.id.desc())
+                                                     .limit(len(new_policies))]
+    new_ids.reverse()
+
+    new_invoices = []
+    for policy_id, (_, schedule) in zip(new_ids, filter(None, accepted)):
+        for bill_date, due_date, cancel_date, amount_due in schedule:
+            new_invoices.append({'policy_id': policy_id,
+                                 'bill_date': bill_date,
+                                 'due_date': due_date,
+                                 'cancel_date': cancel_date,
+                                 'amount_due': amount_due,
+                                 'deleted': False})
+    db.session.execute(invoices.insert(), new_invoices)
+
+    # Open allocations and ledger entries for the new invoices
+    allocate_policies(new_ids)
+    rebuild_entries(new_ids)
+    db.session.commit()
+
+    new_ids = iter(new_ids)
+    return [next(new_ids) if entry else None for entry in accepted]
+
+
+def _valid_spec(spec):
+    # A datetime is a date too, but invoice dates must be plain dates
+    effective_date = spec.get('effective_date')
+    annual_premium = spec.get('annual_premium')
+    return (isinstance(effective_date, date) and not isinstance(effective_date, datetime)
+            and isinstance(annual_premium, (int, long)) and not isinstance(annual_premium, bool)
+            and annual_premium > 0
+            and bool(spec.get('policy_number'))
+            and bool(spec.get('named_insured')))
+
 
 ################################
 # The functions below are for the db and
@@ -237,6 +703,8 @@ def build_or_refresh_db():
     db.drop_all()
     db.create_all()
     insert_data()
+    rebuild_allocations()
+    rebuild_ledger()
     print "DB Ready!"
 
 def insert_data():
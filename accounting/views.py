@@ -1,21 +1,36 @@
 # You will probably need more methods from flask but this one is a good start.
-from flask import render_template, jsonify, json, Response
+from flask import render_template, jsonify, json, request, Response, stream_with_context
 
 # Import things from Flask that we need.
-from accounting import app, db
-from accounting.utils import PolicyAccounting
+from accounting import app
+from accounting.aging import aging_report, write_csv
+from accounting.cache import policy_cache
+from accounting.exports import EXPORT_FORMATS, EXPORT_TABLES, export_chunks, export_watermark
+from accounting.metrics import metrics
+from accounting.readonly import read_session
+from accounting.serializers import date_text, policy_response
+from accounting.utils import balance_history, balances_as_of, policies_pending_cancellation
 
 # Import our models
-from models import Contact, Invoice, Policy, Payment
+from models import Invoice, Policy
 from datetime import datetime, date
+from StringIO import StringIO
 
-# Import for SQL exception
-import sqlalchemy
+from sqlalchemy import and_, func, select
+
+# SQLite integers are signed 64 bit; binding a larger one overflows
+def isDbInteger(value):
+    return isinstance(value, (int, long)) and not isinstance(value, bool) and -2 ** 63 <= value < 2 ** 63
 
 @app.route("/")
 def index():
     return render_template('index.html')
 
+# Request, method and SQL metrics in the Prometheus text format
+@app.route("/metrics")
+def getMetrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # Return policy by id and date
 @app.route("/policy/<int:id>/<string:date>")
 def getPolicyByIdAndDate(id, date):
@@ -26,48 +41,265 @@ def getPolicyByIdAndDate(id, date):
     except ValueError as error:
         return Response("Please enter a valid date format mm/dd/yyyy", status=404)
 
-    try:
-        # Get policy
-        policy = Policy.query.filter_by(id=id).one()
-    except sqlalchemy.orm.exc.NoResultFound as error:
+    # Serve the cached response unless the policy changed since
+    key, cached = policy_cache.lookup(id, (date, request.is_xhr))
+    if cached is None:
+        response = serializePolicy(id, dateTime)
+        if isinstance(response, Response):
+            return response
+        cached = policy_cache.store(key, jsonify(response).data)
+
+    # Let the browser revalidate its copy and get a 304 if unchanged
+    response = Response(cached.body, mimetype='application/json')
+    response.set_etag(cached.etag)
+    response.last_modified = cached.last_modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+# Build the response dict for a policy, or an error Response
+def serializePolicy(id, dateTime):
+    # Policy, contacts and invoices in one query and payments in a
+    # second one, straight from column tuples. Responses are cached until
+    # the policy's next write, so they must not come from a snapshot.
+    response = policy_response(id, dateTime.date(), session=read_session(fresh=True))
+    if response is None:
         # Print not found
         return Response("Policy " + str(id) + "was not found", status=404)
 
-    try:
-        # Get insured name
-        insured = Contact.query.filter_by(id=policy.named_insured).one()
-    except sqlalchemy.orm.exc.NoResultFound as error:
+    if response['insured'] is None:
         return Response("Insured not found!", status=404)
 
-    # Get agent name
-    try:
-        agent = Contact.query.filter_by(id=policy.agent).one()
-    except sqlalchemy.orm.exc.NoResultFound as error:
+    if response['agent_name'] is None:
         return Response("Agent not found!", status=404)
 
-    # Serialize policy
-    response = policy.serialize()
+    return response
+
+
+# Balance of a policy at every day from start to end, or with by=event at
+# every invoice and payment. start defaults to the effective date, end to today.
+@app.route("/policy/<int:id>/balances")
+def getPolicyBalanceHistory(id):
+    session = read_session()
+    effective_date = session.query(Policy.effective_date).filter(Policy.id == id).scalar()
+    if effective_date is None:
+        return Response("Policy " + str(id) + " was not found", status=404)
+
+    try:
+        # Validate date formats
+        start = datetime.strptime(request.args['start'], "%Y-%m-%d").date() if request.args.get('start') else effective_date
+        end = datetime.strptime(request.args['end'], "%Y-%m-%d").date() if request.args.get('end') else date.today()
+    except ValueError as error:
+        return Response("Please enter a valid date format yyyy-mm-dd", status=400)
+    if start > end:
+        return Response("start must not be after end", status=400)
+
+    by = request.args.get('by', 'day')
+    if by not in ('day', 'event'):
+        return Response("by must be day or event", status=400)
+
+    limit = app.config['BALANCE_HISTORY_DAY_LIMIT']
+    if by == 'day' and (end - start).days >= limit:
+        return Response("At most %d days can be requested at once" % limit, status=413)
+
+    return jsonify(balance_history(id, start, end, events=by == 'event', session=session))
+
+
+# Return balance, status and pending-cancel flag for many policies
+@app.route("/policies/balances", methods=['POST'])
+def getPolicyBalances():
+    data = request.json
+    if not isinstance(data, dict):
+        return Response("Please send a JSON object", status=400)
+
+    try:
+        # Validate date format
+        dateTime = datetime.strptime(data.get('date') or '', "%Y-%m-%d")
+    except (TypeError, ValueError) as error:
+        return Response("Please enter a valid date format yyyy-mm-dd", status=400)
+
+    # Either a list of policy ids or every policy of an agent
+    session = read_session()
+    errors = []
+    if data.get('agent_id') is not None:
+        if not isDbInteger(data['agent_id']):
+            return Response("agent_id must be a contact id", status=400)
+        policy_ids = [policy_id for policy_id, in session.query(Policy.id)
+                                                         .filter(Policy.agent == data['agent_id'])
+                                                         .order_by(Policy.id)]
+    elif isinstance(data.get('policy_ids'), list):
+        policy_ids = []
+        for policy_id in data['policy_ids']:
+            if isDbInteger(policy_id):
+                policy_ids.append(policy_id)
+            else:
+                errors.append({'id': policy_id, 'error': 'Invalid policy id'})
+    else:
+        return Response("Please send policy_ids or agent_id", status=400)
+
+    limit = app.config['BATCH_POLICY_LIMIT']
+    if len(policy_ids) + len(errors) > limit:
+        return Response("At most %d policies can be requested at once" % limit, status=413)
+
+    # Statuses, balances and pending-cancel flags with one set of queries
+    statuses = {}
+    if policy_ids:
+        statuses = dict(session.query(Policy.id, Policy.status)
+                                  .filter(Policy.id.in_(set(policy_ids))))
+    found_ids = [policy_id for policy_id in policy_ids if policy_id in statuses]
+    balances = balances_as_of(dateTime.date(), found_ids, session=session)
+    pending = policies_pending_cancellation(dateTime.date(), found_ids, session=session)
 
-    # get policy accounting object and account balance
-    pa = PolicyAccounting(policy.id)
-    balance = pa.return_account_balance(dateTime)
-    response['balance'] = balance
+    policies = []
+    for policy_id in policy_ids:
+        if policy_id not in statuses:
+            errors.append({'id': policy_id, 'error': 'Policy not found'})
+            continue
+        policies.append({'id': policy_id,
+                         'balance': balances[policy_id],
+                         'status': statuses[policy_id],
+                         'pending_cancellation': pending[policy_id]})
 
-    # Add agent and insured names to response.
-    response['agent_name'] = agent.name
-    response['insured'] = insured.name
+    return jsonify(date=data['date'], policies=policies, errors=errors)
 
-    # Get all payments for policy
-    payments = Payment.query.filter_by(policy_id=policy.id).all()
 
-    # Add payments
-    all_payments = []
-    for payment in payments:
-        # Serialize payment and add to payments
-        payment_response = payment.serialize()
-        all_payments.append(payment_response)
+# Search policies a page at a time. Pass the returned next cursor as
+# after= to get the following page.
+@app.route("/policies")
+def searchPolicies():
+    policies = Policy.__table__
+    invoices = Invoice.__table__
+
+    try:
+        after = int(request.args.get('after', 0))
+        limit = int(request.args.get('limit', 50))
+    except ValueError as error:
+        return Response("after and limit must be numbers", status=400)
+    if not isDbInteger(after):
+        return Response("after must be a policy id", status=400)
+    limit = max(1, min(limit, app.config['SEARCH_PAGE_LIMIT']))
+
+    include_invoices = request.args.get('invoices', 'summary')
+    if include_invoices not in ('summary', 'none'):
+        return Response("invoices must be summary or none", status=400)
+
+    # Keyset pagination on the primary key instead of OFFSET
+    conditions = [policies.c.id > after]
+    prefix = request.args.get('policy_number')
+    if prefix:
+        escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        conditions.append(policies.c.policy_number.like(escaped + '%', escape='\\'))
+    for name in ('status', 'billing_schedule'):
+        if request.args.get(name):
+            conditions.append(policies.c[name] == request.args[name])
+    for name in ('agent', 'named_insured'):
+        if request.args.get(name):
+            try:
+                contact_id = int(request.args[name])
+            except ValueError as error:
+                contact_id = None
+            if not isDbInteger(contact_id):
+                return Response(name + " must be a contact id", status=400)
+            conditions.append(policies.c[name] == contact_id)
+
+    columns = [policies.c.id, policies.c.policy_number, date_text(policies.c.effective_date),
+               date_text(policies.c.cancel_date), policies.c.status, policies.c.billing_schedule,
+               policies.c.annual_premium, policies.c.named_insured, policies.c.agent]
+
+    # Summarize non-deleted invoices in the same query instead of loading them
+    if include_invoices == 'summary':
+        live_invoices = and_(invoices.c.policy_id == policies.c.id, invoices.c.deleted == False)
+        columns.append(select([func.count(invoices.c.id)]).where(live_invoices)
+                                                            .as_scalar().label('invoice_count'))
+        columns.append(select([func.coalesce(func.sum(invoices.c.amount_due), 0)]).where(live_invoices)
+                                                                                  .as_scalar().label('invoice_total'))
+
+    query = select(columns, from_obj=policies)\
+        .where(and_(*conditions))\
+        .order_by(policies.c.id)\
+        .limit(limit + 1)
+
+    def generate():
+        yield '{"policies": ['
+        last_id = None
+        for count, row in enumerate(read_session().execute(query)):
+            if count == limit:
+                # There is another page after this one
+                break
+            last_id = row.id
+            policy = {
+                'id': row.id,
+                'policy_number': row.policy_number,
+                'effective_date': row.effective_date,
+                'cancel_date': 'None' if row.cancel_date is None else row.cancel_date,
+                'status': row.status,
+                'billing_schedule': row.billing_schedule,
+                'annual_premium': row.annual_premium,
+                'named_insured': row.named_insured,
+                'agent': row.agent
+            }
+            if include_invoices == 'summary':
+                policy['invoice_count'] = row.invoice_count
+                policy['invoice_total'] = row.invoice_total
+            yield (', ' if count else '') + json.dumps(policy)
+        else:
+            last_id = None
+        yield '], "next": %s}' % json.dumps(last_id)
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+# Receivables aging per agent and billing schedule, as JSON or format=csv
+@app.route("/reports/aging")
+def getAgingReport():
+    try:
+        # Validate date format, default to today
+        dateTime = datetime.strptime(request.args.get('date'), "%Y-%m-%d") if request.args.get('date') else None
+    except ValueError as error:
+        return Response("Please enter a valid date format yyyy-mm-dd", status=400)
+
+    if request.args.get('format', 'json') not in ('json', 'csv'):
+        return Response("format must be json or csv", status=400)
+
+    report = aging_report(dateTime.date() if dateTime else None, session=read_session())
+    if request.args.get('format') != 'csv':
+        return jsonify(report)
+
+    output = StringIO()
+    write_csv(report, output)
+    return Response(output.getvalue(), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=aging-%s.csv' % report['date']})
+
+
+# Stream a whole table, or the rows after a watermark, as gzip-compressed
+# CSV or newline-delimited JSON
+@app.route("/exports/<string:table>")
+def getExport(table):
+    if table not in EXPORT_TABLES:
+        return Response("No export for " + table, status=404)
+
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return Response("format must be csv or ndjson", status=400)
+
+    try:
+        after_id = int(request.args.get('after_id', 0))
+        # Validate date format
+        since = datetime.strptime(request.args['since'], "%Y-%m-%d").date() if request.args.get('since') else None
+    except ValueError as error:
+        return Response("after_id must be a number and since a date yyyy-mm-dd", status=400)
+    if not isDbInteger(after_id):
+        return Response("after_id must be a row id", status=400)
+    if since is not None and table != 'payments':
+        return Response("Only payments can be exported since a date", status=400)
 
-    # Add payments to response.
-    response['payments'] = all_payments
+    # Rows added while streaming are left for the next export
+    session = read_session()
+    watermark = export_watermark(table, after_id, since, session=session)
+    through_id = watermark['last_id'] or after_id
+    headers = {'Content-Disposition': 'attachment; filename=%s.%s.gz' % (table, export_format),
+               'X-Export-Last-Id': str(through_id)}
 
-    return jsonify(response)
+    return Response(stream_with_context(export_chunks(table, export_format, after_id, since, through_id,
+                                                      session=session)),
+                    mimetype='application/gzip', headers=headers)
@@ -0,0 +1,22 @@
+"""
+#######################################################
+Benchmarks for Accounting. Importing this package points
+the app at BENCHMARK_DATABASE_URI, a scratch SQLite
+database unless it is set, whatever ACCOUNTING_DATABASE_URI
+says, so benchmarks never touch the app's db. Generating a
+book drops every table, and refuses to when the app was
+pointed elsewhere before this package was imported.
+
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.balances --policies 100000
+    python -m benchmarks.cancellations --policies 100000
+    python -m benchmarks.payments --payments 2000 --clients 8
+    python -m benchmarks.serialization --invoices 10000
+#######################################################
+"""
+import os
+import tempfile
+
+os.environ.setdefault('BENCHMARK_DATABASE_URI',
+                      'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.sqlite'))
+os.environ['ACCOUNTING_DATABASE_URI'] = os.environ['BENCHMARK_DATABASE_URI']
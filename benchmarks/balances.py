@@ -0,0 +1,43 @@
+#!/usr/bin/env python2.7
+"""
+ Compare balances_as_of with one return_account_balance per policy.
+
+     python -m benchmarks.balances --policies 100000
+"""
+import argparse
+import time
+from datetime import date
+
+from benchmarks.generator import generate_book
+from accounting.utils import PolicyAccounting, balances_as_of
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--policies', type=int, default=100000)
+    parser.add_argument('--sample', type=int, default=1000,
+                        help='policies timed with return_account_balance')
+    args = parser.parse_args()
+
+    date_cursor = date(2015, 6, 1)
+    generate_book(args.policies)
+
+    start = time.time()
+    balances = balances_as_of(date_cursor)
+    book_seconds = time.time() - start
+
+    sample = range(1, min(args.sample, args.policies) + 1)
+    start = time.time()
+    for policy_id in sample:
+        balance = PolicyAccounting(policy_id).return_account_balance(date_cursor)
+        assert balance == balances[policy_id]
+    sample_seconds = time.time() - start
+    per_policy_seconds = sample_seconds / len(sample) * args.policies
+
+    print 'policies:                      %d' % args.policies
+    print 'balances_as_of:                %.3fs' % book_seconds
+    print 'return_account_balance (est.): %.3fs' % per_policy_seconds
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python2.7
+"""
+ Time cancellation_sweep over a whole book against evaluate_cancel
+ run one policy at a time.
+
+     python -m benchmarks.cancellations --policies 100000
+"""
+import argparse
+import time
+from datetime import date
+
+from benchmarks.generator import generate_book
+from accounting.utils import PolicyAccounting, cancellation_sweep
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--policies', type=int, default=100000)
+    parser.add_argument('--sample', type=int, default=200,
+                        help='policies timed with evaluate_cancel')
+    args = parser.parse_args()
+
+    date_cursor = date(2015, 6, 1)
+    generate_book(args.policies)
+
+    start = time.time()
+    candidates = set(cancellation_sweep(date_cursor))
+    sweep_seconds = time.time() - start
+
+    sample = range(1, min(args.sample, args.policies) + 1)
+    start = time.time()
+    for policy_id in sample:
+        should_cancel = bool(PolicyAccounting(policy_id).evaluate_cancel(date_cursor))
+        assert should_cancel == (policy_id in candidates)
+    sample_seconds = time.time() - start
+    per_policy_seconds = sample_seconds / len(sample) * args.policies
+
+    print 'policies:               %d' % args.policies
+    print 'candidates:             %d' % len(candidates)
+    print 'cancellation_sweep:     %.3fs' % sweep_seconds
+    print 'evaluate_cancel (est.): %.3fs' % per_policy_seconds
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python2.7
+"""
+ Deterministic synthetic book of business. The same seed and size
+ always produce the same contacts, policies, invoices and payments.
+
+     python -m benchmarks.generator --invoices 100000 --seed 1
+"""
+import argparse
+import os
+import random
+from datetime import date, timedelta
+
+from accounting import app, db
+from accounting.allocations import rebuild_allocations
+from accounting.ledger import rebuild_ledger
+from accounting.models import Contact, Invoice, Payment
+from accounting.utils import onboard_policies
+
+# Share of policies on each billing schedule and its invoices per year
+SCHEDULE_MIX = [('Annual', 0.2, 1), ('Two-Pay', 0.2, 2), ('Quarterly', 0.3, 4), ('Monthly', 0.3, 12)]
+
+# Policies per agent
+BOOK_SIZE = 200
+
+# Rows inserted per statement
+INSERT_CHUNK_SIZE = 10000
+
+
+def policies_for_invoices(num_invoices):
+    """
+     Number of policies that gives about num_invoices invoices.
+    """
+    invoices_per_policy = sum(share * count for _, share, count in SCHEDULE_MIX)
+    return max(1, int(num_invoices / invoices_per_policy))
+
+
+def generate_book(num_policies, seed=0, as_of=date(2016, 1, 1)):
+    """
+     Replace the db with a book of num_policies policies effective in
+     2015, with payments posted up to as_of. Most invoices are paid on
+     time, some late and some never. Returns the new policy ids.
+     Refuses to run on any db but BENCHMARK_DATABASE_URI.
+    """
+    if app.config['SQLALCHEMY_DATABASE_URI'] != os.environ.get('BENCHMARK_DATABASE_URI'):
+        raise RuntimeError('Refusing to replace %s, the app was configured before benchmarks '
+                           'was imported' % app.config['SQLALCHEMY_DATABASE_URI'])
+    rng = random.Random(seed)
+
+    db.drop_all()
+    db.create_all()
+
+    # Contacts get ids in insert order in an empty db
+    num_agents = max(1, num_policies / BOOK_SIZE)
+    contacts = [{'name': 'Agent %d' % i, 'role': u'Agent'} for i in range(num_agents)]
+    contacts.extend({'name': 'Insured %d' % i, 'role': u'Named Insured'} for i in range(num_policies))
+    for start in range(0, len(contacts), INSERT_CHUNK_SIZE):
+        db.session.execute(Contact.__table__.insert(), contacts[start:start + INSERT_CHUNK_SIZE])
+    db.session.commit()
+
+    specs = []
+    for i in range(num_policies):
+        schedule = _pick_schedule(rng)
+        if rng.random() < 0.8:
+            effective_date = date(2015, rng.randint(1, 12), 1)
+        else:
+            effective_date = date(2015, rng.randint(1, 12), rng.randint(1, 28))
+        specs.append({'policy_number': 'Policy %07d' % i,
+                      'effective_date': effective_date,
+                      'annual_premium': rng.randint(20, 400) * 10,
+                      'billing_schedule': schedule,
+                      'named_insured': num_agents + i + 1,
+                      'agent': rng.randint(1, num_agents)})
+    policy_ids = onboard_policies(specs)
+
+    # Pay invoices on time, late or never
+    insureds = dict((policy_id, spec['named_insured']) for policy_id, spec in zip(policy_ids, specs))
+    invoices = Invoice.__table__
+    payments = []
+    for invoice in db.session.execute(invoices.select().order_by(invoices.c.id)):
+        roll = rng.random()
+        if roll < 0.85:
+            paid_on = invoice.bill_date + timedelta(days=rng.randint(0, (invoice.due_date - invoice.bill_date).days))
+        elif roll < 0.95:
+            paid_on = invoice.due_date + timedelta(days=rng.randint(1, 20))
+        else:
+            continue
+        if paid_on > as_of:
+            continue
+        payments.append({'policy_id': invoice.policy_id,
+                         'contact_id': insureds[invoice.policy_id],
+                         'amount_paid': invoice.amount_due,
+                         'transaction_date': paid_on})
+        if len(payments) == INSERT_CHUNK_SIZE:
+            db.session.execute(Payment.__table__.insert(), payments)
+            payments = []
+    if payments:
+        db.session.execute(Payment.__table__.insert(), payments)
+    db.session.commit()
+
+    rebuild_allocations(policy_ids)
+    rebuild_ledger(policy_ids)
+    return policy_ids
+
+
+def _pick_schedule(rng):
+    roll = rng.random()
+    for schedule, share, _ in SCHEDULE_MIX:
+        if roll < share:
+            return schedule
+        roll -= share
+    return SCHEDULE_MIX[-1][0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--invoices', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    policy_ids = generate_book(policies_for_invoices(args.invoices), args.seed)
+    print 'Generated %d policies, %d invoices, %d payments in %s' % (
+        len(policy_ids), Invoice.query.count(), Payment.query.count(), db.engine.url)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python2.7
+"""
+ Payments per second with concurrent clients: default SQLite settings
+ with a commit per payment, the tuned SQLITE_PRAGMAS profile with a
+ commit per payment, and the tuned profile with group commit.
+
+     python -m benchmarks.payments --payments 2000 --clients 8
+"""
+import argparse
+import threading
+import time
+from datetime import date
+
+from benchmarks.generator import generate_book
+from accounting import app, db
+from accounting.utils import PolicyAccounting
+from accounting.writer import GroupCommitWriter
+
+# SQLite's own defaults, for comparison with the profile in config.py
+DEFAULT_PRAGMAS = [('journal_mode', 'DELETE'), ('synchronous', 'FULL')]
+
+
+def make_payment(policy_id):
+    pa = PolicyAccounting(policy_id)
+    pa.make_payment(contact_id=pa.policy.agent, date_cursor=date(2015, 12, 1), amount=1)
+
+
+def payments_per_second(policy_ids, num_clients, writer=None):
+    """
+     Post one payment per policy id from num_clients threads and
+     return the rate. With a writer, clients submit payments to it and
+     wait for them to commit.
+    """
+    def client(client_policy_ids):
+        try:
+            for policy_id in client_policy_ids:
+                if writer is None:
+                    make_payment(policy_id)
+                else:
+                    writer.submit(make_payment, policy_id).result()
+        finally:
+            db.session.remove()
+
+    threads = [threading.Thread(target=client, args=(policy_ids[i::num_clients],))
+               for i in range(num_clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(policy_ids) / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--policies', type=int, default=2000)
+    parser.add_argument('--payments', type=int, default=2000, help='payments per run')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent client threads')
+    args = parser.parse_args()
+
+    policy_ids = generate_book(args.policies)
+    payment_policy_ids = [policy_ids[i % len(policy_ids)] for i in range(args.payments)]
+    tuned_pragmas = app.config['SQLITE_PRAGMAS']
+
+    runs = [('default pragmas, commit per payment', DEFAULT_PRAGMAS, False),
+            ('tuned pragmas, commit per payment', tuned_pragmas, False),
+            ('tuned pragmas, group commit', tuned_pragmas, True)]
+    for name, pragmas, group_commit in runs:
+        # NullPool opens a new connection per checkout, so the profile applies at once
+        app.config['SQLITE_PRAGMAS'] = pragmas
+        db.session.remove()
+
+        writer = GroupCommitWriter().start() if group_commit else None
+        try:
+            rate = payments_per_second(payment_policy_ids, args.clients, writer)
+        finally:
+            if writer is not None:
+                writer.stop()
+        print '%-40s %8.1f payments/s' % (name, rate)
+
+
+if __name__ == '__main__':
+    main()
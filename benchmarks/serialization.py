@@ -0,0 +1,85 @@
+#!/usr/bin/env python2.7
+"""
+ Compare the ORM serialize methods with the column tuple serializers,
+ for every policy view response and for the whole invoice table, and
+ check that both produce the same JSON.
+
+     python -m benchmarks.serialization --invoices 10000
+"""
+import argparse
+import time
+from datetime import date
+
+from flask import jsonify
+from sqlalchemy.orm import joinedload, subqueryload
+
+from benchmarks.generator import generate_book, policies_for_invoices
+from accounting import app, db
+from accounting.models import Invoice, Policy
+from accounting.serializers import invoice_dicts, policy_response
+
+DATE_CURSOR = date(2015, 9, 1)
+
+
+def account_balance(invoices, payments, date_cursor):
+    # The balance of loaded invoices and payments, by the same rules as
+    # return_account_balance
+    due_now = sum(invoice.amount_due for invoice in invoices
+                  if not invoice.deleted and invoice.bill_date <= date_cursor)
+    paid = sum(payment.amount_paid for payment in payments
+               if payment.transaction_date <= date_cursor)
+    return due_now - paid
+
+
+def orm_response(policy_id):
+    # The policy view's response as it was built from ORM instances
+    policy = Policy.query.options(joinedload('insured_contact'),
+                                  joinedload('agent_contact'),
+                                  joinedload('invoices'),
+                                  subqueryload('payments'))\
+                         .filter_by(id=policy_id).one()
+    response = policy.serialize()
+    response['balance'] = account_balance(policy.invoices, policy.payments, DATE_CURSOR)
+    response['agent_name'] = policy.agent_contact.name
+    response['insured'] = policy.insured_contact.name
+    response['payments'] = [payment.serialize() for payment in policy.payments]
+    return response
+
+
+def timed(fn):
+    # Start each run from an empty identity map
+    db.session.expunge_all()
+    start = time.time()
+    result = fn()
+    return result, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--invoices', type=int, default=10000)
+    args = parser.parse_args()
+
+    policy_ids = generate_book(policies_for_invoices(args.invoices))
+    num_invoices = db.session.query(Invoice).count()
+
+    with app.test_request_context():
+        orm_bodies, orm_views = timed(lambda: [jsonify(orm_response(policy_id)).data
+                                               for policy_id in policy_ids])
+        fast_bodies, fast_views = timed(lambda: [jsonify(policy_response(policy_id, DATE_CURSOR)).data
+                                                 for policy_id in policy_ids])
+        orm_invoices, orm_table = timed(lambda: jsonify(invoices=[invoice.serialize() for invoice
+                                                                  in Invoice.query.order_by(Invoice.id)]).data)
+        fast_invoices, fast_table = timed(lambda: jsonify(invoices=invoice_dicts()).data)
+
+    assert orm_bodies == fast_bodies, 'policy responses differ'
+    assert orm_invoices == fast_invoices, 'invoice JSON differs'
+
+    print 'policies: %d, invoices: %d' % (len(policy_ids), num_invoices)
+    print '%-28s %8s %8s %8s' % ('', 'orm', 'tuples', 'speedup')
+    print '%-28s %7.3fs %7.3fs %7.1fx' % ('policy view, every policy', orm_views, fast_views,
+                                         orm_views / fast_views)
+    print '%-28s %7.3fs %7.3fs %7.1fx' % ('all invoices', orm_table, fast_table, orm_table / fast_table)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python2.7
+"""
+ Time each PolicyAccounting operation and the policy endpoint on
+ synthetic books of several sizes, and write the results as JSON.
+ Pass an earlier results file as --baseline to report regressions.
+
+     python -m benchmarks.suite --sizes 1000,100000,1000000 --output results.json
+     python -m benchmarks.suite --output new.json --baseline results.json
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+from datetime import date, datetime
+
+from benchmarks.generator import generate_book, policies_for_invoices
+from accounting import app, db
+from accounting.aging import aging_report
+from accounting.cache import policy_cache
+from accounting.utils import PolicyAccounting, balances_as_of, policies_pending_cancellation, \
+                             policies_to_cancel
+
+DATE_CURSOR = date(2015, 9, 1)
+
+
+def time_calls(fn, args_list):
+    """
+     Call fn once per argument tuple and return timing statistics in
+     milliseconds.
+    """
+    timings = []
+    for args in args_list:
+        start = time.time()
+        fn(*args)
+        timings.append((time.time() - start) * 1000)
+    timings.sort()
+    return {'calls': len(timings),
+            'mean_ms': sum(timings) / len(timings),
+            'p50_ms': timings[len(timings) / 2],
+            'p95_ms': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+            'max_ms': timings[-1]}
+
+
+def run_size(num_invoices, samples, seed):
+    policy_ids = generate_book(policies_for_invoices(num_invoices), seed)
+    rng = random.Random(seed)
+    shuffled = rng.sample(policy_ids, len(policy_ids))
+    sample = [(policy_id,) for policy_id in shuffled[:samples]]
+    client = app.test_client()
+
+    def view(policy_id):
+        policy_cache.backend.clear()
+        response = client.get('/policy/%d/%s' % (policy_id, DATE_CURSOR))
+        assert response.status_code == 200
+
+    def make_payment(policy_id):
+        PolicyAccounting(policy_id).make_payment(date_cursor=DATE_CURSOR, amount=1)
+
+    def make_invoices(policy_id):
+        PolicyAccounting(policy_id).make_invoices()
+
+    def change_billing_schedule(policy_id):
+        pa = PolicyAccounting(policy_id)
+        pa.change_billing_schedule('Quarterly' if pa.policy.billing_schedule == 'Monthly' else 'Monthly')
+
+    def cancel_policy(policy_id):
+        PolicyAccounting(policy_id).cancel_policy('Canceled', 'Underwriting')
+
+    results = {
+        '__init__': time_calls(PolicyAccounting, sample),
+        'return_account_balance': time_calls(
+            lambda policy_id: PolicyAccounting(policy_id).return_account_balance(DATE_CURSOR), sample),
+        'evaluate_cancellation_pending_due_to_non_pay': time_calls(
+            lambda policy_id: PolicyAccounting(policy_id).evaluate_cancellation_pending_due_to_non_pay(DATE_CURSOR),
+            sample),
+        'evaluate_cancel': time_calls(
+            lambda policy_id: PolicyAccounting(policy_id).evaluate_cancel(DATE_CURSOR), sample),
+        'policy_view': time_calls(view, sample),
+        'balances_as_of': time_calls(balances_as_of, [(DATE_CURSOR,)]),
+        'policies_pending_cancellation': time_calls(policies_pending_cancellation, [(DATE_CURSOR,)]),
+        'policies_to_cancel': time_calls(policies_to_cancel, [(DATE_CURSOR,)]),
+        'aging_report': time_calls(aging_report, [(DATE_CURSOR,)]),
+    }
+
+    # Writes last so the reads see the generated book, each on policies
+    # of its own so no write is timed on another's leftovers
+    writes = [('make_payment', make_payment),
+              ('make_invoices', make_invoices),
+              ('change_billing_schedule', change_billing_schedule),
+              ('cancel_policy', cancel_policy)]
+    write_size = max(1, min(samples, len(shuffled) / len(writes)))
+    for index, (name, write) in enumerate(writes):
+        set_aside = shuffled[index * write_size:(index + 1) * write_size] or shuffled[:1]
+        results[name] = time_calls(write, [(policy_id,) for policy_id in set_aside])
+    db.session.remove()
+    return {'policies': len(policy_ids), 'invoices': num_invoices, 'operations': results}
+
+
+def compare(results, baseline, threshold):
+    """
+     Return (size, operation, baseline ms, new ms) for every operation
+     whose mean got slower by more than threshold (e.g. 0.2 for 20%).
+    """
+    regressions = []
+    for size, run in sorted(results['sizes'].items()):
+        old_run = baseline['sizes'].get(size)
+        if not old_run:
+            continue
+        for operation, stats in sorted(run['operations'].items()):
+            old_stats = old_run['operations'].get(operation)
+            if old_stats and stats['mean_ms'] > old_stats['mean_ms'] * (1 + threshold):
+                regressions.append((size, operation, old_stats['mean_ms'], stats['mean_ms']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1000,100000',
+                        help='comma separated invoice counts, e.g. 1000,100000,1000000')
+    parser.add_argument('--samples', type=int, default=100, help='policies timed per operation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', help='earlier results file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown reported as a regression, 0.2 is 20%%')
+    args = parser.parse_args()
+
+    results = {'created': datetime.now().isoformat(),
+               'python': platform.python_version(),
+               'seed': args.seed,
+               'samples': args.samples,
+               'sizes': {}}
+    for size in [int(size) for size in args.sizes.split(',')]:
+        results['sizes'][str(size)] = run_size(size, args.samples, args.seed)
+        for operation, stats in sorted(results['sizes'][str(size)]['operations'].items()):
+            print '%9d invoices  %-46s %10.3f ms' % (size, operation, stats['mean_ms'])
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        for size, operation, old_ms, new_ms in regressions:
+            print 'REGRESSION %s invoices %s: %.3f ms -> %.3f ms' % (size, operation, old_ms, new_ms)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()